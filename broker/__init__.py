@@ -4,6 +4,7 @@ from .connection import connect_to_IB, disconnect_from_IB
 from .trademanager import *
 from .functions import get_index_spot, get_term_structure
 from . utils import FXCache
+from .accountstate import AccountState, AccountSnapshot
 from .portfoliomanager import PortfolioManager
 from .utilityfunctions import *
 
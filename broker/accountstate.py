@@ -0,0 +1,79 @@
+# ATS/broker/accountstate.py
+
+import threading, datetime
+from dataclasses import dataclass, replace
+from ib_async import IB
+
+# Account value tags we keep track of and the snapshot field they map to
+ACCOUNT_TAGS = {'EquityWithLoanValue': 'equity',
+                'NetLiquidation': 'net_liquidation',
+                'AvailableFunds': 'available_funds',
+                'TotalCashValue': 'cash',
+                'InitMarginReq': 'init_margin',
+                'MaintMarginReq': 'maint_margin'}
+
+@dataclass(frozen=True)
+class AccountSnapshot:
+    '''Immutable view of the account values, all in the base currency.'''
+    equity: float = 0.0
+    net_liquidation: float = 0.0
+    available_funds: float = 0.0
+    cash: float = 0.0
+    init_margin: float = 0.0
+    maint_margin: float = 0.0
+    base_currency: str = ''
+    timestamp: datetime.datetime = None
+
+class AccountState:
+    '''Keeps an AccountSnapshot of one account up to date from IB's account value updates.
+
+    The account values are subscribed once; every update of a tracked tag publishes a new snapshot.
+    Readers (also on other threads) just take the current `snapshot` attribute, no requests involved.'''
+
+    def __init__(self, ib_client: IB, account_id=None):
+        self.ib = ib_client
+        self.account_id = account_id if account_id else self.ib.managedAccounts()[0]
+        self.values = {}  # (tag, currency) -> value
+        self.lock = threading.Lock()
+        self.snapshot = AccountSnapshot()
+
+        for value in self.ib.accountValues(self.account_id):
+            self.store(value)
+        if not self.values:
+            # Account updates not received yet, seed the snapshot from the account summary once
+            for value in self.ib.accountSummary(self.account_id):
+                self.store(value)
+        self.publish()
+
+        self.ib.accountValueEvent += self.on_account_value
+
+    def store(self, value):
+        if value.account != self.account_id or value.tag not in ACCOUNT_TAGS:
+            return False
+        try:
+            self.values[(value.tag, value.currency)] = float(value.value)
+        except ValueError:
+            return False
+        return True
+
+    def on_account_value(self, value):
+        with self.lock:
+            if self.store(value):
+                self.publish()
+
+    def publish(self):
+        # The currency of the equity tag is the base currency; per-currency entries of other tags are ignored
+        base_currency = next((currency for tag, currency in self.values if tag == 'EquityWithLoanValue' and currency != 'BASE'),
+                             self.snapshot.base_currency)
+        fields = {}
+        for tag, field in ACCOUNT_TAGS.items():
+            value = self.values.get((tag, 'BASE'), self.values.get((tag, base_currency)))
+            if value is not None:
+                fields[field] = value
+        self.snapshot = replace(self.snapshot, base_currency=base_currency, timestamp=datetime.datetime.now(), **fields)
+
+    def get_snapshot(self):
+        return self.snapshot
+
+    def cancel(self):
+        self.ib.accountValueEvent -= self.on_account_value
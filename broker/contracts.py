@@ -0,0 +1,231 @@
+# ATS/broker/contracts.py
+
+import threading, json, ast, inspect
+import numpy as np
+import pandas as pd
+import ib_async
+from ib_async import Contract, util
+
+from data_and_research import ac
+
+# Typed ArcticDB columns a contract is stored in: column -> (Contract attribute, dtype, missing value)
+CONTRACT_COLUMNS = {'contract_conId': ('conId', 'int64', 0),
+                    'contract_secType': ('secType', object, ''),
+                    'contract_symbol': ('symbol', object, ''),
+                    'contract_expiry': ('lastTradeDateOrContractMonth', object, ''),
+                    'contract_strike': ('strike', 'float64', 0.0),
+                    'contract_right': ('right', object, ''),
+                    'contract_multiplier': ('multiplier', object, ''),
+                    'contract_exchange': ('exchange', object, ''),
+                    'contract_currency': ('currency', object, '')}
+
+_contracts = {}  # conId -> Contract, shared by all components of the process
+_lock = threading.RLock()
+
+def cache_contract(contract):
+    '''Adds a (qualified) contract to the process-wide conId cache.'''
+    if contract is not None and contract.conId:
+        with _lock:
+            _contracts.setdefault(contract.conId, contract)
+    return contract
+
+def get_contract(con_id):
+    return _contracts.get(con_id)
+
+# Classes a legacy contract string may construct: the ib_async contracts and the objects nested in them
+REPR_CLASSES = {name: cls for name, cls in vars(ib_async).items() if inspect.isclass(cls) and issubclass(cls, Contract)}
+REPR_CLASSES.update(ComboLeg=ib_async.ComboLeg, DeltaNeutralContract=ib_async.DeltaNeutralContract, TagValue=ib_async.TagValue)
+
+def _repr_value(node):
+    '''Value of an expression of a repr: literals, lists/tuples and calls of REPR_CLASSES, nothing else.'''
+    if isinstance(node, ast.Call):
+        if not isinstance(node.func, ast.Name) or node.func.id not in REPR_CLASSES:
+            raise ValueError(f"{ast.unparse(node.func)} is not a contract class")
+        args = [_repr_value(arg) for arg in node.args]
+        kwargs = {keyword.arg: _repr_value(keyword.value) for keyword in node.keywords if keyword.arg}
+        if len(kwargs) != len(node.keywords):
+            raise ValueError("** arguments are not allowed")
+        return REPR_CLASSES[node.func.id](*args, **kwargs)
+    if isinstance(node, (ast.List, ast.Tuple)):
+        values = [_repr_value(element) for element in node.elts]
+        return values if isinstance(node, ast.List) else tuple(values)
+    return ast.literal_eval(node)
+
+def parse_contract(contract):
+    '''Converts a stored contract back to the contract object. Strings are the legacy str() format, e.g.
+    "Stock(symbol='AAPL', exchange='SMART', currency='USD')"; they are parsed, never evaluated.'''
+    if not isinstance(contract, str):
+        return cache_contract(contract) if isinstance(contract, Contract) else None
+    if not contract:
+        return None
+    try:
+        return cache_contract(_repr_value(ast.parse(contract, mode='eval').body))
+    except Exception as e:
+        print(f"Could not parse contract {contract}: {e}")
+        return None
+
+def encode_contracts(df, column='contract'):
+    '''Replaces the contract column of df by the typed CONTRACT_COLUMNS.'''
+    df = df.copy()
+    contracts = [parse_contract(contract) for contract in df[column]] if column in df.columns else [None] * len(df)
+    for name, (attribute, dtype, missing) in CONTRACT_COLUMNS.items():
+        values = [getattr(contract, attribute) if contract is not None else missing for contract in contracts]
+        df[name] = np.array([missing if value is None else value for value in values], dtype=dtype)
+    return df.drop(columns=[column], errors='ignore')
+
+def decode_contract(con_id, sec_type, symbol, expiry, strike, right, multiplier, exchange, currency):
+    '''Rebuilds a contract from its columns, a dictionary lookup for every conId seen before.'''
+    if con_id:
+        contract = _contracts.get(con_id)
+        if contract is not None:
+            return contract
+    contract = Contract.create(conId=int(con_id), secType=sec_type, symbol=symbol, lastTradeDateOrContractMonth=expiry,
+                               strike=float(strike), right=right, multiplier=multiplier, exchange=exchange, currency=currency)
+    return cache_contract(contract)
+
+def decode_contracts(df, column='contract'):
+    '''Replaces the CONTRACT_COLUMNS of df by a column of contract objects. Rows without encoded
+    contract (written before the columnar encoding) fall back to the legacy string column.'''
+    if 'contract_conId' not in df.columns:
+        if column in df.columns:
+            df = df.copy()
+            df[column] = [parse_contract(contract) for contract in df[column]]
+        return df
+
+    df = df.copy()
+    encoded = df['contract_secType'].fillna('').astype(bool).to_numpy()
+    legacy = df[column] if column in df.columns else pd.Series([None] * len(df), index=df.index)
+    fields = [df[name].fillna(missing).tolist() for name, (_, _, missing) in CONTRACT_COLUMNS.items()]
+
+    df[column] = [decode_contract(*values) if is_encoded else parse_contract(old)
+                  for is_encoded, old, *values in zip(encoded, legacy, *fields)]
+    return df.drop(columns=list(CONTRACT_COLUMNS))
+
+########################### QUALIFICATION CACHE ###########################
+
+class QualificationCache:
+    '''Qualified contracts keyed by the contract spec they were requested with, persisted to ArcticDB.
+
+    A spec that was qualified once (by any IB client of the process, or before a restart) is filled in
+    from the cache instead of a round-trip to TWS. Entries are invalidated when the contract has expired,
+    and contracts without expiry (stocks, FX, ...) are re-qualified after max_age_days.'''
+
+    def __init__(self, library, symbol='qualified', max_age_days=30):
+        self.library = library
+        self.symbol = symbol
+        self.max_age = pd.Timedelta(days=max_age_days)
+        self.lock = threading.Lock()
+        self.entries = {}  # spec key -> (Contract, expiry, qualified_at)
+        self.load()
+
+    @staticmethod
+    def spec_key(contract):
+        return json.dumps(util.dataclassNonDefaults(contract), sort_keys=True, default=str)
+
+    @staticmethod
+    def expiry(contract):
+        '''Last trading day of a contract, NaT if it does not expire.'''
+        expiry = contract.lastTradeDateOrContractMonth[:8]
+        if len(expiry) == 8:
+            return pd.Timestamp(expiry)
+        elif len(expiry) == 6:
+            return pd.Timestamp(expiry + '01') + pd.offsets.MonthEnd(0)
+        return pd.NaT
+
+    def is_valid(self, expiry, qualified_at, now):
+        if pd.isna(expiry):
+            return now - qualified_at < self.max_age
+        return expiry >= now.normalize()
+
+    def load(self):
+        if not self.library.has_symbol(self.symbol):
+            return
+        try:
+            df = self.library.read(self.symbol).data
+        except Exception as e:
+            print(f"Could not load qualified contracts: {e}")
+            return
+
+        now = pd.Timestamp.now()
+        for key, contract, expiry, qualified_at in zip(df['key'], df['contract'], df['expiry'], df['qualified_at']):
+            if self.is_valid(expiry, qualified_at, now):
+                self.entries[key] = (cache_contract(Contract.create(**json.loads(contract))), expiry, qualified_at)
+
+        # Drop invalid and superseded entries from the library once in a while
+        if len(df) > 2 * max(len(self.entries), 1):
+            self.save_all()
+
+    def lookup(self, contract):
+        with self.lock:
+            entry = self.entries.get(self.spec_key(contract))
+        if entry is None or not self.is_valid(entry[1], entry[2], pd.Timestamp.now()):
+            return None
+        return entry[0]
+
+    def store(self, pairs):
+        '''Caches (spec key, qualified contract) pairs and appends them to ArcticDB.'''
+        now = pd.Timestamp.now()
+        rows = []
+        with self.lock:
+            for key, contract in pairs:
+                expiry = self.expiry(contract)
+                contract = Contract.create(**util.dataclassNonDefaults(contract))  # the caller may still change its own copy
+                self.entries[key] = (cache_contract(contract), expiry, now)
+                rows.append({'key': key, 'contract': json.dumps(util.dataclassNonDefaults(contract), default=str),
+                             'conId': int(contract.conId), 'expiry': expiry, 'qualified_at': now})
+            if not rows:
+                return
+            try:
+                self.library.append(self.symbol, self.to_frame(rows))
+            except Exception as e:
+                print(f"Could not save qualified contracts: {e}")
+
+    def save_all(self):
+        with self.lock:
+            rows = [{'key': key, 'contract': json.dumps(util.dataclassNonDefaults(contract), default=str),
+                     'conId': int(contract.conId), 'expiry': expiry, 'qualified_at': qualified_at}
+                    for key, (contract, expiry, qualified_at) in self.entries.items()]
+            self.library.write(self.symbol, self.to_frame(rows), prune_previous_versions=True)
+
+    @staticmethod
+    def to_frame(rows):
+        df = pd.DataFrame(rows, columns=['key', 'contract', 'conId', 'expiry', 'qualified_at'])
+        df['expiry'] = pd.to_datetime(df['expiry'])
+        df['qualified_at'] = pd.to_datetime(df['qualified_at'])
+        return df
+
+    async def qualify_async(self, ib, *contracts):
+        '''Qualifies contracts in-place like ib.qualifyContractsAsync, asking TWS only for the specs not in the cache.
+        Returns the contracts in the same order, None where a contract could not be qualified.'''
+        result = list(contracts)
+        misses = []
+        for i, contract in enumerate(contracts):
+            cached = self.lookup(contract)
+            if cached is not None:
+                util.dataclassUpdate(contract, cached)
+            else:
+                misses.append((i, self.spec_key(contract)))
+
+        if misses:
+            qualified = await ib.qualifyContractsAsync(*[contracts[i] for i, _ in misses])
+            for (i, _), contract in zip(misses, qualified):
+                result[i] = contract
+            self.store([(key, contracts[i]) for (i, key), contract in zip(misses, qualified) if contract])
+        return result
+
+_qualification_cache = None
+
+def get_qualification_cache():
+    '''Returns the qualification cache of the process, stored in the ArcticDB library 'contracts'.'''
+    global _qualification_cache
+    with _lock:
+        if _qualification_cache is None:
+            _qualification_cache = QualificationCache(ac.get_library('contracts', create_if_missing=True))
+    return _qualification_cache
+
+async def qualify_contracts_async(ib, *contracts):
+    return await get_qualification_cache().qualify_async(ib, *contracts)
+
+def qualify_contracts(ib, *contracts):
+    '''Cached drop-in replacement for ib.qualifyContracts(*contracts).'''
+    return ib.run(qualify_contracts_async(ib, *contracts))
@@ -6,6 +6,8 @@ from ib_async import *
 # from gui.log import add_log
 import datetime
 
+from .contracts import qualify_contracts
+
 # util.startLoop()  # Needed in script mode
 # ib = IB()
 # try:
@@ -36,15 +38,15 @@ def get_term_structure(future_symbol,index_symbol, exchange=None, yf = False, ib
         
         if exchange is None:
             contracts = [Future(future_symbol, lastTradeDateOrContractMonth=exp) for exp in monthly_expirations]
-            qualified_contracts = ib.qualifyContracts(*contracts)
+            qualified_contracts = [contract for contract in qualify_contracts(ib, *contracts) if contract]
         else:
             try:
                 contracts = [Future(symbol=future_symbol, exchange=exchange,lastTradeDateOrContractMonth=exp) for exp in monthly_expirations]
-                qualified_contracts = ib.qualifyContracts(*contracts)
+                qualified_contracts = [contract for contract in qualify_contracts(ib, *contracts) if contract]
             except:
                 contracts = [Future(symbol=future_symbol, exchange=exchange, lastTradeDateOrContractMonth=exp) 
                             for exp in monthly_expirations if exp[-1] in ['3','6','9','12']]
-                qualified_contracts = ib.qualifyContracts(*contracts)
+                qualified_contracts = [contract for contract in qualify_contracts(ib, *contracts) if contract]
         ib.sleep(1)
 
         # Set market data type to delayed frozen data
@@ -55,7 +57,7 @@ def get_term_structure(future_symbol,index_symbol, exchange=None, yf = False, ib
             # Prepare data collection
         else:
             idx = Index(index_symbol)
-            ib.qualifyContracts(idx)
+            qualify_contracts(ib, idx)
             idx_details = ib.reqMktData(idx)
             ib.sleep(5)
             spot = idx_details.last
@@ -0,0 +1,51 @@
+# ATS/broker/marketdata.py
+
+import asyncio, math
+import numpy as np
+from ib_async import IB
+
+from .contracts import qualify_contracts_async
+
+def has_price(value):
+    return isinstance(value, float) and not math.isnan(value) and value > 0
+
+async def fetch_market_prices_async(ib: IB, contracts, timeout=3.0):
+    '''Fetches the market price of many contracts at once.
+
+    All contracts are qualified in one call and their snapshots are requested concurrently. Instead of
+    sleeping, we wait on ticker updates until every contract has a price or the deadline has passed.
+    Returns a float array aligned with contracts, NaN where no price arrived (or the contract is None).'''
+    prices = np.full(len(contracts), np.nan)
+    positions = [i for i, contract in enumerate(contracts) if contract is not None]
+    if not positions:
+        return prices
+
+    loop = asyncio.get_event_loop()
+    deadline = loop.time() + timeout
+
+    qualified = await asyncio.wait_for(qualify_contracts_async(ib, *[contracts[i] for i in positions]), timeout)
+    ib.reqMarketDataType(4)  # Dynamic data
+    tickers = {i: ib.reqMktData(contract, '', True, False) for i, contract in zip(positions, qualified) if contract}
+
+    pending = set(tickers)
+    while pending:
+        remaining = deadline - loop.time()
+        if remaining <= 0:
+            break
+        try:
+            await asyncio.wait_for(ib.pendingTickersEvent, remaining)
+        except asyncio.TimeoutError:
+            break
+        pending = {i for i in pending if not has_price(tickers[i].marketPrice())}
+
+    for i, ticker in tickers.items():
+        price = ticker.marketPrice()
+        if not has_price(price):
+            price = ticker.close  # e.g. outside trading hours
+        if has_price(price):
+            prices[i] = price
+    return prices
+
+def fetch_market_prices(ib: IB, contracts, timeout=3.0):
+    '''Blocking version of fetch_market_prices_async.'''
+    return ib.run(fetch_market_prices_async(ib, contracts, timeout))
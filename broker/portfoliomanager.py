@@ -1,30 +1,75 @@
 # ATS/broker/portfoliomanager.py
 
 import pandas as pd
+import numpy as np
 # import pandas_market_calendars as mcal
-import math
+import math, atexit
 from ib_async import *
 import datetime
 import yfinance as yf
 from arcticdb import Arctic, QueryBuilder
 
 from data_and_research import ac
-from .utils import FXCache, create_position_dict, create_trade_entry ,calculate_pnl, detect_duplicate_trade
+from data_and_research.storage import get_append_batcher
+from .utils import FXCache, ExecutionIndex, create_position_dict, create_trade_entry ,calculate_pnl, detect_duplicate_trade, get_pnl_multiplier, merge_trade_context
+from .contracts import encode_contracts, decode_contracts, parse_contract
+from .reconciliation import reconcile_positions, update_market_values
+from .marketdata import fetch_market_prices
+from .accountstate import AccountState
+from .positionbook import PositionBook, latest_positions, changed_positions
+
+# Deltas stamped this long before a snapshot are read again on load: a row can be stamped before the snapshot
+# but enter the book after it. Re-reading rows the snapshot contains is harmless, the latest row per position wins.
+SNAPSHOT_OVERLAP = pd.Timedelta(minutes=5)
 
 class PortfolioManager:
-    def __init__(self, ib_client: IB,arctic = None):
+    def __init__(self, ib_client: IB,arctic = None, storage_mode='snapshot', snapshot_interval=100):
+        '''storage_mode: 'snapshot' stores changed positions in the append-only account symbol and keeps a compacted
+                         snapshot of the current positions in '<account>_snapshot'; 'append' appends every
+                         reconciled portfolio to the account symbol (legacy layout).
+           snapshot_interval: number of position updates after which a new snapshot is written.'''
         self.ib = ib_client
         self.fx_cache = FXCache(ib_client)
-        self.base = [entry.currency for entry in self.ib.accountSummary() if entry.tag == "EquityWithLoanValue"][0]
+        self.account_id = self.ib.managedAccounts()[0]
+        self.account_state = AccountState(ib_client, self.account_id)
+        self.base = self.account_state.snapshot.base_currency
         self.arctic = arctic if arctic else ac
         self.portfolio_library = self.arctic.get_library('portfolio', create_if_missing=True)
         self.pnl_library = self.arctic.get_library('pnl', create_if_missing=True)
+        self.append_batcher = get_append_batcher()  # groups the small appends of the portfolio and PnL symbols
 
-        self.account_id = self.ib.managedAccounts()[0]
+        self.storage_mode = storage_mode
+        self.snapshot_symbol = f"{self.account_id}_snapshot"
+        self.snapshot_interval = snapshot_interval
+        self.updates_since_snapshot = 0
+
+        # Execution ids of all processed trades, used to detect duplicate fills
+        self.execution_index = ExecutionIndex(self.portfolio_library, f"{self.account_id}_executions", history_symbol=self.account_id)
+
+        # Resident book of the latest positions, written through to ArcticDB in the background
+        self.position_book = PositionBook(writer=self.save_portfolio)
+        self.position_book.load(self.load_portfolio_from_adb())
+        atexit.register(self.flush)
+
+        # Stream the FX rates of all portfolio currencies, the first reconciliation needs them. Until a pair ticks,
+        # the rate stored with its positions is used
+        self.fx_cache.seed(self.stored_fx_rates())
+        self.fx_cache.warm_up([(item.contract.currency, self.base) for item in self.ib.portfolio()])
     
+    def stored_fx_rates(self):
+        '''{(currency, base): rate} of the latest positions in the book.'''
+        df = self.position_book.to_frame()
+        if df.empty or 'fx_rate' not in df.columns:
+            return {}
+        rates = pd.to_numeric(df['fx_rate'], errors='coerce').groupby(df['currency']).last()
+        return {(currency, self.base): rate for currency, rate in rates.dropna().items()}
+
+    @property
+    def total_equity(self):
+        return self.account_state.snapshot.equity
+
     def _create_strategy_entry_in_portfolio_lib_(self,strategy,symbol,quantity):
         '''Function for TESTING PURPOSES ONLY.'''
-        self.total_equity =  sum(float(entry.value) for entry in self.ib.accountSummary() if entry.tag == "EquityWithLoanValue")
 
         item = [item for item in self.ib.portfolio() if item.contract.symbol == symbol][0]
         if not item:
@@ -37,11 +82,10 @@ class PortfolioManager:
 
         df = self.fx_cache.convert_marketValue_to_base(df, self.base)
         df['% of nav'] = df['marketValue_base'] / self.total_equity * 100
-        self.save_portfolio(df)
+        self.record_positions(df)
 
     def get_positions_from_ib(self):
         '''this function gets all portfolio positions in a dataframe format without strategy assignment'''
-        self.total_equity =  sum(float(entry.value) for entry in self.ib.accountSummary() if entry.tag == "EquityWithLoanValue")
         portfolio_data = []
 
         for item in self.ib.portfolio():
@@ -81,197 +125,108 @@ class PortfolioManager:
         return df_final_sorted
 
     def match_ib_positions_with_arcticdb(self):
-        if self.account_id in self.portfolio_library.list_symbols():
-            df_ac = self.load_portfolio_from_adb()
-        else:
-            df_ib = self.get_positions_from_ib()
-            self.save_portfolio(df_ib)
+        df_ac = self.position_book.to_frame()
+        df_ib = self.get_positions_from_ib()
+
+        if df_ac.empty:
+            self.position_book.load(df_ib)
+            self.position_book.write_through(df_ib)
+            self.write_snapshot()
             return df_ib
 
-        df_ib = self.get_positions_from_ib()
-        df_merged = pd.DataFrame()
-
-        # Iterate through the positions obtained from Interactive Brokers
-        for _, row in df_ib.iterrows():
-            symbol = row['symbol']
-            asset_class = row['asset class']
-
-            strategy_entries_in_ac = df_ac[(df_ac['symbol'] == symbol) & (df_ac['asset class'] == asset_class)]
-            
-            if strategy_entries_in_ac.empty: # no database entry, add position
-                # print(f"{asset_class}:{symbol} not in ArcticDB. Appending df_ib row to df_merged")
-                df_merged = pd.concat([df_merged, pd.DataFrame([row])])
-            else:
-                strategy_entry_updated = self.update_and_aggregate_data(strategy_entries_in_ac, row)
-                # print(f"{asset_class}:{symbol} in ArcticDB. Updated and aggregating data")
-                df_merged = pd.concat([df_merged, strategy_entry_updated])
-                
-                if row['position'] - strategy_entry_updated.position.sum() != 0:
-                    # Handle the residual and concat to df_merged
-                    # print(f"{asset_class}:{symbol} IB position does not equal ArcticDB's Position")
-                    residual = self.handle_residual(strategy_entries_in_ac, row)
-                    print("this is df_merged before concatenating the residual: ")
-                    print(df_merged)
-                    df_merged = pd.concat([df_merged, residual])
-                    print("this is df_merged after concatenating the residual: ")
-                    print(df_merged)
- 
-        # Now, handle ArcticDB positions that aren't represented in the broker's data (e.g., strategies with net-zero positions)
-        for _, row in df_ac.iterrows():
-            symbol = row['symbol']
-            asset_class = row['asset class']
-
-            # Check if this position is not already accounted for in df_merged, then update market data
-            if df_merged[(df_merged['symbol'] == symbol) & (df_merged['asset class'] == asset_class)].empty:
-                # Update the market data for stale entries
-                row = self.update_market_data_for_arcticdb_positions(row)
-
-                # Otherwise, maintain the strategy-specific position, even if the broker doesn't report it
-                df_merged = pd.concat([df_merged, pd.DataFrame([row])])
-
-        self.save_portfolio(df_merged)
+        df_merged = reconcile_positions(df_ib, df_ac, self.total_equity, refresh_stale=self.refresh_stale_positions)
+        self.position_book.load(df_merged)
+
+        if self.storage_mode == 'snapshot':
+            # Only positions that changed go to the log, the market data lives in the snapshot
+            self.position_book.write_through(changed_positions(df_merged, df_ac))
+            self.write_snapshot()
+        else:
+            self.position_book.write_through(df_merged)
         self.save_account_pnl()
         
         return df_merged
-    
-    def update_and_aggregate_data(self, df_ac, row):
-        '''Function to update ArcticDB dataframe entries with current market data.
-        Will also combine same strategy symbol positions that resulted from discretionary/ manual trades.''' 
-        self.total_equity = sum(float(entry.value) for entry in self.ib.accountSummary() if entry.tag == "EquityWithLoanValue")
-        output_df = df_ac.copy()
-        output_df.index = [row.name + pd.to_timedelta(i, unit='ns') for i in range(len(output_df))]
-
-        # output_df.index = output_df.index + pd.to_timedelta(range(len(output_df)), unit='ns')
-        # output_df['timestamp'] = row['timestamp'] if 'timestamp' in row else row.name
-        # output_df['timestamp'] = output_df['timestamp'] + pd.to_timedelta(range(len(output_df)), unit='ns')
-        output_df['marketPrice'] = row['marketPrice']
-
-        # if position amounts in ArcticDB and the actual portfolio do not match for the same symbol 
-        # and there is only one strategy entry, we simply combine them. Else we handle the residual later
-        if (output_df['position'].sum() != row.position): 
-                filter_mask = output_df['strategy'] == row['strategy']
-                missing_amount = row.position - output_df['position'].sum()
-
-                if len(output_df.loc[filter_mask, 'position'] > 0):
-                    # Calculate the new average cost
-                    total_cost = row.averageCost * row.position
-                    total_cost_in_ac = (output_df['averageCost'] * output_df['position']).sum()
-                    res_averageCost = (total_cost - total_cost_in_ac) / missing_amount
-
-                    output_df.loc[filter_mask, 'averageCost'] = (output_df.loc[filter_mask, 'averageCost'] * output_df.loc[filter_mask, 'position'] 
-                                                                + res_averageCost * missing_amount) / (output_df.loc[filter_mask, 'position'] + missing_amount)
-                    output_df.loc[filter_mask, 'position'] += missing_amount 
-
-        output_df['marketValue'] = output_df['marketPrice'] * output_df['position']
-        output_df['marketValue_base'] = output_df['marketValue'] / row['fx_rate']
-        output_df['% of nav'] = (output_df['marketValue_base'] / self.total_equity) * 100
-        output_df['unrealizedPNL'] = output_df['marketPrice'] - output_df['averageCost']
-
-        if len(output_df) == 1:
-            output_df['pnl %'] = calculate_pnl(row.marketPrice, output_df.averageCost.item(), output_df.position.item(), row.contract)
-        else:   # Handle multiple entries
-            output_df['pnl %'] = output_df.apply(lambda x: calculate_pnl(x.marketPrice, x.averageCost, x.position, row.contract), axis=1)
-            
-        return output_df
-
-    def update_market_data_for_arcticdb_positions(self, row):
-        '''Function to update market data (marketPrice, marketValue, unrealizedPNL, etc.) for ArcticDB entries 
-        that are not found in broker data.'''
-        
-        contract = eval(row['contract'])  # Convert the contract string back to the contract object
-        self.ib.qualifyContracts(contract)
-
-        fx_rate = self.fx_cache.get_fx_rate(contract.currency,self.base)
-        row['fx_rate'] = fx_rate
 
-        # Request live market data for the contract
-        market_data = self.ib.reqMktData(contract, '', False, False)
-        self.ib.sleep(1)  # Ensure sufficient time for data to populate
-        
-        # Update market-related fields
-        row['marketPrice'] = market_data.marketPrice()
-        row['marketValue'] = row['marketPrice'] * row['position']
-        row['marketValue_base'] = row['marketValue'] / row['fx_rate']
-        row['unrealizedPNL'] = (row['marketPrice'] - row['averageCost']) * row['position']
-        row['timestamp'] = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        
-        # You can update other fields as necessary (e.g., `% of nav`)
-        row['% of nav'] = (row['marketValue_base'] / self.total_equity) * 100
-        return row
+    def refresh_stale_positions(self, df_stale):
+        '''Updates the market data (marketPrice, marketValue, unrealizedPNL, etc.) of ArcticDB entries
+        that are not found in broker data. All prices are fetched in one batch.'''
+        df = df_stale.copy()
+        contracts = [parse_contract(contract) for contract in df['contract']]
+        prices = fetch_market_prices(self.ib, contracts)
 
-    def handle_residual(self,strategy_entries_in_ac, row):
-        total_equity =  sum(float(entry.value) for entry in self.ib.accountSummary() if entry.tag == "EquityWithLoanValue")
+        # Keep the last known rate of currencies without a quote yet
+        fx_rates = {currency: self.fx_cache.get_fx_rate(currency, self.base, default=np.nan) for currency in df['currency'].unique()}
+        df['fx_rate'] = df['currency'].map(fx_rates).astype(float).fillna(df['fx_rate'])
 
-        # Calculate the residual position
-        total_position = row['position']
-        assigned_position_sum = strategy_entries_in_ac['position'].sum()
-        residual_position = total_position - assigned_position_sum
+        # Keep the last known price where no new one arrived
+        df['marketPrice'] = np.where(np.isnan(prices), df['marketPrice'].to_numpy(dtype=float), prices)
+        multiplier = np.array([get_pnl_multiplier(contract) for contract in contracts], dtype=float)
+        return update_market_values(df, self.total_equity, multiplier)
 
-        # No residual to handle
-        if residual_position == 0:
+    def load_portfolio_from_adb(self):
+        '''Function that loads latest saved portfolio from ArcticDB.
+        Reads the latest snapshot plus the deltas appended after it, or the recent history if there is no snapshot.'''
+        has_history = self.portfolio_library.has_symbol(self.account_id)
+
+        if self.portfolio_library.has_symbol(self.snapshot_symbol):
+            snapshot = self.portfolio_library.read(self.snapshot_symbol)
+            as_of = pd.Timestamp(snapshot.metadata['as_of'])
+            frames = [snapshot.data]
+            if has_history:
+                frames.append(self.portfolio_library.read(self.account_id, date_range=(as_of - SNAPSHOT_OVERLAP, None)).data)
+            frames = [frame for frame in frames if not frame.empty]
+            df = pd.concat(frames) if frames else pd.DataFrame()
+        elif has_history:
+            today = datetime.date.today()
+            df = self.portfolio_library.read(f"{self.account_id}",date_range=(today - pd.Timedelta(days=10), None)).data
+            if df.empty:
+                df = self.portfolio_library.read(f"{self.account_id}",row_range=(-5000,9999)).data
+        else:
             return pd.DataFrame()
 
-        # Calculate the weighted average cost for assigned positions
-        weighted_avg_costs = (strategy_entries_in_ac['averageCost'] * strategy_entries_in_ac['position']).sum()
-        total_weighted_cost = row['averageCost'] * total_position
-
-        # Calculate the average cost for the residual position
-        residual_avg_cost = (total_weighted_cost - weighted_avg_costs) / residual_position
-
-        # Calculate updated market values for the residual
-        market_price = row['marketPrice']
-        residual_market_value = residual_position * market_price
-        residual_percent_nav = ((residual_market_value / row.fx_rate) / total_equity) * 100
-        pnl_percent = calculate_pnl(market_price,residual_avg_cost,residual_position,row.contract)
-
-        # Prepare the residual row data
-        residual_row = {
-            'symbol': row['symbol'],
-            'asset class': row['asset class'],
-            'position': residual_position,
-            'timestamp': datetime.datetime.now(),
-            '% of nav': residual_percent_nav,
-            'averageCost': residual_avg_cost,
-            'marketPrice': market_price,
-            'pnl %': pnl_percent,
-            'strategy': '',  # This can be updated to assign a strategy later
-            'contract': row['contract'],
-            'trade': '',
-            'trade_context': '',
-            'open_dt': datetime.date.today().isoformat(),
-            'close_dt': '',
-            'deleted': False,
-            'delete_dt': '',
-            'marketValue': residual_market_value,
-            'unrealizedPNL': (market_price - residual_avg_cost) * residual_position,
-            'currency': row.currency,
-            'realizedPNL': 0.0,  # Assuming no realized P&L for the residual; update as needed
-            'account': row['account'],
-            'marketValue_base': residual_market_value / row.fx_rate,
-            'fx_rate': row.fx_rate}
-
-        df = pd.DataFrame([residual_row])
-        df.set_index('timestamp', inplace=True)
-        print(f"this is the residual df: {df}")
-        return df
+        return decode_contracts(latest_positions(df))
 
-    def load_portfolio_from_adb(self):
-        '''Function that loads latest saved portfolio from ArcticDB'''
-        today = datetime.date.today()
-        df = self.portfolio_library.read(f"{self.account_id}",date_range=(today - pd.Timedelta(days=10), None)).data
-        if df.empty:
-            df = self.portfolio_library.read(f"{self.account_id}",row_range=(-5000,9999)).data
+    def flush(self, timeout=30.0):
+        '''Writes the queued position changes and then the batched appends to ArcticDB (on shutdown and at exit).'''
+        if not self.position_book.flush(timeout):
+            print(f"Position changes still queued after {timeout} seconds, they are not saved")
+        self.append_batcher.flush()
 
-        # Slicing for only active positions
-        df = df[df['deleted'] != True].copy()
+    def record_positions(self, df):
+        '''Applies new or changed positions to the position book and queues them for ArcticDB.
+        Writes a new snapshot every snapshot_interval updates.'''
+        self.position_book.upsert(df)
+        self.position_book.write_through(df)
 
-        # Create a column of our index, to recreate the index later after grouping
-        df['timestamp'] = df.index
-        
-        # Group by symbol, strategy and asset class to find their last updated value
-        latest_portfolio = df.sort_index().groupby(['symbol', 'strategy', 'asset class']).last().reset_index()
-        latest_portfolio.set_index('timestamp',drop=True, inplace=True)
-        return latest_portfolio
+        self.updates_since_snapshot += 1
+        if self.updates_since_snapshot >= self.snapshot_interval:
+            self.write_snapshot()
+
+    def write_snapshot(self):
+        '''Queues a snapshot of the current position book.'''
+        if self.storage_mode != 'snapshot':
+            return
+        # The book content and as_of are taken together: no position can change in between
+        with self.position_book.lock:
+            df = self.position_book.to_frame()
+            as_of = datetime.datetime.now()
+        self.position_book.write_through(df, writer=lambda df: self.save_snapshot(df, as_of))
+        self.updates_since_snapshot = 0
+
+    def save_snapshot(self, df, as_of):
+        """
+        Save the compacted current positions to '<account>_snapshot', replacing the previous snapshot.
+        as_of is the time the snapshot was taken; deltas stamped after as_of - SNAPSHOT_OVERLAP are applied on load.
+        The deltas queued before the snapshot are written first, so the log is never behind a snapshot.
+        """
+        try:
+            self.append_batcher.flush()
+            if not df.empty:
+                df = self.normalize_columns(df)
+                df = df[df['position'] != 0]
+            self.portfolio_library.write(self.snapshot_symbol, df, metadata={'as_of': as_of.isoformat()}, prune_previous_versions=True)
+        except Exception as e:
+            print(f"Error occurred while saving the snapshot: {e}")
 
     def save_portfolio(self, df_merged):
         """
@@ -281,7 +236,7 @@ class PortfolioManager:
         1. Check if DataFrame is empty.
         2. Normalize the DataFrame columns.
         3. Drop rows where the position is zero.
-        4. Save to ArcticDB using append or write based on existence.
+        4. Queue the rows for a batched append (or write if the symbol doesn't exist yet).
         """
         if df_merged.empty:
             print("DataFrame is empty. Nothing to save.")
@@ -294,14 +249,8 @@ class PortfolioManager:
             # Step 3: Drop rows where the position is zero
             df_merged = df_merged[df_merged['position'] != 0]
 
-            # Step 4: Save to ArcticDB
-            if self.account_id in self.portfolio_library.list_symbols():
-                print(f"Updating ArcticDB entry {self.account_id} in library 'portfolio'")
-                # Use 'append' with 'validate_index=True' to ensure no duplicate indices
-                self.portfolio_library.append(f'{self.account_id}', df_merged, validate_index=True)
-            else:
-                print(f"Creating an arcticdb entry {self.account_id} in library 'portfolio'")
-                self.portfolio_library.write(f'{self.account_id}',df_merged,prune_previous_versions = True,validate_index=True)
+            # Step 4: Save to ArcticDB, batched with other appends
+            self.append_batcher.append(self.portfolio_library, self.account_id, df_merged)
         except Exception as e:
             print(f"Error occurred while saving: {e}")
 
@@ -319,8 +268,8 @@ class PortfolioManager:
         """
         df = df.copy()
 
-        # Convert critical columns to string
-        df['contract'] = df['contract'].astype(str)
+        # Store contracts in typed columns, convert critical columns to string
+        df = encode_contracts(df)
         df['trade'] = df['trade'].astype(str)
         df['trade_context'] = df['trade_context'].astype(str)
 
@@ -346,49 +295,41 @@ class PortfolioManager:
         pnl_data = {'total_equity': self.total_equity,'account_id': self.account_id}
         pnl_df = pd.DataFrame([pnl_data], index=[current_time])
         try:
-            # Append the new data to the 'pnl' library, creating it if it doesn't exist
-            if self.account_id in self.pnl_library.list_symbols():
-                self.pnl_library.append(self.account_id, pnl_df)
-            else:
-                self.pnl_library.write(self.account_id, pnl_df)
-            print(f"Equity value saved to 'pnl' library for account {self.account_id}")
+            # Queue the row for a batched append to the 'pnl' library
+            self.append_batcher.append(self.pnl_library, self.account_id, pnl_df)
         except Exception as e:
             print(f"Error saving equity value to 'pnl' library: {e}")
 
     def delete_symbol(self,symbol, asset_class, position, strategy):
-        q = QueryBuilder()
-        q = q[(q['symbol']==symbol) & (q['asset class']==asset_class) &
-              (q['strategy']==strategy) & (q['deleted']==False)]
-        
-        df = self.portfolio_library.read(f"{self.account_id}",query_builder=q).data
+        df = self.position_book.get(self.account_id, symbol, asset_class, strategy)
+        if df.empty:
+            print(f"{asset_class}:{symbol} under '{strategy}' not found in the portfolio.")
+            return
 
+        df.index = [pd.Timestamp(datetime.datetime.now())]
         df['deleted'] = True
         df['delete_dt'] = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')  # Convert to string
 
-        self.save_portfolio(df)
+        self.record_positions(df)
 
     ########################### PROCESSING NEW TRADES HERE ###########################
     # This part of the portfoliomanager handles incoming trades from the strategy manager queue 
 
     def process_new_trade(self, strategy_symbol, trade):
-            '''Function that processes an ib_insync trade object and stores it in the ArcticDB'''
-            # Create a Dataframe compatible with our ArcticDB data structure
-            trade_df = create_trade_entry(self,strategy_symbol, trade)
-            
+            '''Function that processes an ib_insync trade object and stores it in the ArcticDB.
+            Only the executions not processed before are booked, a trade can be delivered again with more fills.'''
             # Check for duplicate trades and exit function if True
             if detect_duplicate_trade(self,trade):
                 return
 
-            # Read the current portfolio data
-            if self.account_id in self.portfolio_library.list_symbols():
-                df_ac_active = self.load_portfolio_from_adb()
-            else:
-                df_ac_active = pd.DataFrame()
+            # Create a Dataframe compatible with our ArcticDB data structure
+            trade_df = create_trade_entry(self,strategy_symbol, trade, self.execution_index.new_fills(trade))
 
+            # Look up the current position in the resident position book
+            account = trade_df['account'].iloc[0]
             symbol = trade.contract.symbol
             asset_class = trade.contract.secType
-            existing_position = df_ac_active[(df_ac_active['symbol'] == symbol) & (df_ac_active['asset class'] == asset_class) 
-                                            & (df_ac_active['strategy'] == strategy_symbol)]
+            existing_position = self.position_book.get(account, symbol, asset_class, strategy_symbol)
     
             if existing_position.empty:
                 # Simply append new position if it doesn't exist
@@ -396,56 +337,37 @@ class PortfolioManager:
                 processed_trade_df = trade_df
                 
             else:
-                if len(existing_position) > 1:
-                    print(existing_position)
-                    print(f"Error: More than one entry of {asset_class}:{symbol} under '{strategy_symbol}'.")
+                if existing_position.position.item() + trade_df.position.item() == 0:
+                    print(f"Processing a new trade: Closing {symbol} in strategy '{strategy_symbol}'")
+                    self.close_position(existing_position, trade_df)
+                    self.execution_index.add(trade)
                     return
                 else:
-                    if existing_position.position.item() + trade_df.position.item() == 0:
-                        print(f"Processing a new trade: Closing {symbol} in strategy '{strategy_symbol}'")
-                        self.close_position(existing_position, trade_df)
-                        return
-                    else:
-                        # Aggregating new trade to an existing position that's not a close
-                        print(f"Processing a new trade: Aggregating {symbol} to strategy '{strategy_symbol}'")
-                        processed_trade_df = self.aggregate_positions(existing_position, trade_df)
+                    # Aggregating new trade to an existing position that's not a close
+                    print(f"Processing a new trade: Aggregating {symbol} to strategy '{strategy_symbol}'")
+                    processed_trade_df = self.aggregate_positions(existing_position, trade_df)
                 
-            # Save the updated positions
-            self.save_portfolio(processed_trade_df)
+            # Update the book and save the updated positions
+            self.record_positions(processed_trade_df)
+            self.execution_index.add(trade)
     
     def close_position(self,existing_position, trade_df):
-        q = QueryBuilder()
-
-        if isinstance(existing_position, pd.DataFrame): # when coming from process_new_trade()
-            q = q[(q['symbol'] == existing_position.iloc[0]['symbol']) & \
-                        (q['asset class'] == existing_position.iloc[0]['asset class']) & \
-                        (q['strategy'] == existing_position.iloc[0]['strategy']) & \
-                        (q['deleted'] == False)]
-            
-        elif isinstance(existing_position, dict): # when coming from the GUI
-            q = q[(q['symbol'] == existing_position['symbol']) & \
-                (q['asset class'] == existing_position['asset class']) & \
-                (q['strategy'] == existing_position['strategy']) & \
-                (q['deleted'] == False)]
-        
-        df = self.portfolio_library.read(f'{self.account_id}',query_builder=q).data
+        if isinstance(existing_position, dict): # when coming from the GUI
+            existing_position = self.position_book.get(existing_position.get('account', self.account_id), existing_position['symbol'],
+                                                       existing_position['asset class'], existing_position['strategy'])
+            if existing_position.empty:
+                print("Position to close not found in the portfolio.")
+                return
 
-        # Select the latest matching entry to update the other columns
-        df_to_update = df.copy()
+        # The latest entry of the position is updated and stored as closed
+        df_to_update = existing_position.copy()
+        df_to_update.index = [pd.Timestamp(datetime.datetime.now())]
 
         df_to_update['marketValue_base'] = 0.0
         df_to_update['% of nav'] = 0.0
         
-        if not df_to_update['trade_context'].iloc[0]:
-            trade_context = trade_df['trade_context'].iloc[0]
-        elif isinstance(eval(df_to_update['trade_context'].iloc[0]), list):
-            trade_context = eval(df_to_update['trade_context'].iloc[0])
-            trade_context.append(trade_df['trade_context'].iloc[0])
-        else:
-            trade_context = [df_to_update['trade_context'].iloc[0], trade_df['trade_context'].iloc[0]]
-        
         df_to_update['trade'] = trade_df['trade'].iloc[0]
-        df_to_update['trade_context'] = str(trade_context)
+        df_to_update['trade_context'] = merge_trade_context(df_to_update['trade_context'].iloc[0], trade_df['trade_context'].iloc[0])
         df_to_update['close_dt'] = datetime.date.today().isoformat()
         df_to_update['marketValue'] = 0.0
         df_to_update['unrealizedPNL'] = 0.0
@@ -454,7 +376,7 @@ class PortfolioManager:
         df_to_update['deleted'] = True
         df_to_update['delete_dt'] = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
 
-        self.save_portfolio(df_to_update)
+        self.record_positions(df_to_update)
         print(f"Closed position for {existing_position.iloc[0]['symbol']} {existing_position.iloc[0]['asset class']} with strategy {existing_position.iloc[0]['strategy']}")
 
     def aggregate_positions(self, existing_position, trade_df):
@@ -481,15 +403,7 @@ class PortfolioManager:
         df_merged['unrealizedPNL'] = (df_merged['marketPrice'] - df_merged['averageCost']) * df_merged['position']
 
         # Handle trade context
-        if not existing_position['trade_context'].iloc[0]:
-            trade_context = trade_df['trade_context'].iloc[0]
-        elif isinstance(eval(existing_position['trade_context'].iloc[0]), list):
-            trade_context = eval(existing_position['trade_context'].iloc[0])
-            trade_context.append(trade_df['trade_context'].iloc[0])  
-        else:
-            trade_context = [existing_position['trade_context'].iloc[0], trade_df['trade_context'].iloc[0]]
-        
-        df_merged['trade_context'] = str(trade_context)
+        df_merged['trade_context'] = merge_trade_context(existing_position['trade_context'].iloc[0], trade_df['trade_context'].iloc[0])
         df_merged['trade'] = trade_df['trade'].iloc[0]
         return df_merged
 
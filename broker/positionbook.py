@@ -0,0 +1,123 @@
+# ATS/broker/positionbook.py
+
+import threading, queue
+import pandas as pd
+
+BOOK_KEYS = ['account', 'symbol', 'asset class', 'strategy']
+
+def latest_positions(df):
+    '''Folds portfolio history (or a snapshot plus the deltas written after it) into the latest
+    active row per (symbol, strategy, asset class).'''
+    if df.empty:
+        return df
+
+    # Create a column of our index, to recreate the index later after grouping
+    df = df.copy()
+    df['timestamp'] = df.index
+
+    # Group by symbol, strategy and asset class to find their last updated value
+    latest_portfolio = df.sort_index().groupby(['symbol', 'strategy', 'asset class']).last().reset_index()
+    latest_portfolio.set_index('timestamp',drop=True, inplace=True)
+
+    # Slicing for only active positions
+    return latest_portfolio[latest_portfolio['deleted'] != True].copy()
+
+def changed_positions(df_new, df_old, columns=('position', 'averageCost')):
+    '''Returns the rows of df_new that are new or whose position or average cost differ from df_old.'''
+    if df_old.empty or df_new.empty:
+        return df_new
+    keys = [key for key in BOOK_KEYS if key in df_new.columns and key in df_old.columns]
+    old = df_old[keys + list(columns)].drop_duplicates(keys, keep='last')
+    merged = df_new[keys + list(columns)].merge(old, on=keys, how='left', suffixes=('', '_old'))
+    mask = pd.Series(False, index=merged.index)
+    for column in columns:
+        mask |= merged[column].ne(merged[f'{column}_old'])
+    return df_new[mask.to_numpy()]
+
+class PositionBook:
+    '''In-memory book of the latest position per (account, symbol, asset class, strategy).
+
+    The book is loaded once from ArcticDB and then changed incrementally, so looking up or updating
+    a position costs a dictionary access instead of a read of the portfolio history. Changes are
+    written through to ArcticDB by a background thread that calls writer(df) for every queued frame.'''
+
+    def __init__(self, writer=None):
+        self.positions = {}
+        self.lock = threading.RLock()
+        self.writer = writer
+        self.write_queue = queue.Queue()
+
+        if writer:
+            self.writer_thread = threading.Thread(target=self.process_writes, daemon=True)
+            self.writer_thread.start()
+
+    @staticmethod
+    def key(row):
+        return tuple(row.get(column, '') for column in BOOK_KEYS)
+
+    def load(self, df):
+        '''Replaces the content of the book with the positions of a DataFrame indexed by timestamp.'''
+        with self.lock:
+            self.positions = {}
+            self._upsert(df)
+
+    def upsert(self, df):
+        '''Adds or replaces the positions contained in df. Rows with a zero position or flagged as
+        deleted are removed from the book.'''
+        with self.lock:
+            self._upsert(df)
+
+    def _upsert(self, df):
+        for row in df.reset_index(names='timestamp').to_dict('records'):
+            key = self.key(row)
+            if row.get('deleted') == True or row.get('position') == 0:
+                self.positions.pop(key, None)
+            else:
+                self.positions[key] = row
+
+    def get(self, account, symbol, asset_class, strategy):
+        '''Returns the position as a single row DataFrame indexed by timestamp, or an empty DataFrame.'''
+        with self.lock:
+            row = self.positions.get((account, symbol, asset_class, strategy))
+        if row is None:
+            return pd.DataFrame()
+        return pd.DataFrame([row]).set_index('timestamp')
+
+    def remove(self, account, symbol, asset_class, strategy):
+        with self.lock:
+            return self.positions.pop((account, symbol, asset_class, strategy), None)
+
+    def to_frame(self):
+        '''Returns all positions of the book as a DataFrame indexed by timestamp.'''
+        with self.lock:
+            rows = list(self.positions.values())
+        if not rows:
+            return pd.DataFrame()
+        return pd.DataFrame(rows).set_index('timestamp')
+
+    def __len__(self):
+        return len(self.positions)
+
+    ########################### WRITE-THROUGH TO ARCTICDB ###########################
+
+    def write_through(self, df, writer=None):
+        '''Queues a frame for the background writer. Another writer than the default one can be passed.'''
+        writer = writer or self.writer
+        if df is None or not writer:
+            return
+        self.write_queue.put((writer, df))
+
+    def process_writes(self):
+        while True:
+            writer, df = self.write_queue.get(block=True)
+            try:
+                writer(df)
+            except Exception as e:
+                print(f"Error writing positions to ArcticDB: {e}")
+            finally:
+                self.write_queue.task_done()
+
+    def flush(self, timeout=None):
+        '''Blocks until the writer processed all queued frames, at most timeout seconds. Returns False on timeout.'''
+        with self.write_queue.all_tasks_done:
+            return self.write_queue.all_tasks_done.wait_for(lambda: not self.write_queue.unfinished_tasks, timeout)
@@ -0,0 +1,74 @@
+# ATS/broker/pricing.py
+# Vectorized Black-Scholes pricing of European options. All functions broadcast over NumPy arrays, so
+# one call prices every option of a portfolio in every risk scenario.
+
+import numpy as np
+from statistics import NormalDist
+
+try:
+    from scipy.special import ndtr as norm_cdf
+except ImportError:
+    def norm_cdf(x):
+        '''Standard normal CDF from the Chebyshev approximation of erfc (relative error < 1.2e-7).'''
+        x = np.asarray(x, dtype=float)
+        z = np.abs(x) / np.sqrt(2)
+        t = 1 / (1 + 0.5 * z)
+        erfc = t * np.exp(-z * z - 1.26551223 + t * (1.00002368 + t * (0.37409196 + t * (0.09678418 + t * (-0.18628806
+                          + t * (0.27886807 + t * (-1.13520398 + t * (1.48851587 + t * (-0.82215223 + t * 0.17087277)))))))))
+        return np.where(x >= 0, 1 - 0.5 * erfc, 0.5 * erfc)
+
+def norm_pdf(x):
+    return np.exp(-0.5 * np.square(x)) / np.sqrt(2 * np.pi)
+
+def norm_ppf(p):
+    return NormalDist().inv_cdf(p)
+
+def d1_d2(spot, strike, years, vol, rate=0.0, dividend=0.0):
+    vol_sqrt_t = vol * np.sqrt(years)
+    d1 = (np.log(spot / strike) + (rate - dividend + 0.5 * vol * vol) * years) / vol_sqrt_t
+    return d1, d1 - vol_sqrt_t
+
+def bs_price(spot, strike, years, vol, is_call, rate=0.0, dividend=0.0):
+    '''Black-Scholes price. is_call is a bool (array); expired options (years <= 0) are worth their intrinsic value.'''
+    spot, strike, years, vol, is_call = np.broadcast_arrays(*map(np.asarray, (spot, strike, years, vol, is_call)))
+    live = (years > 0) & (vol > 0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        d1, d2 = d1_d2(spot, strike, np.where(live, years, 1.0), np.where(live, vol, 1.0), rate, dividend)
+        sign = np.where(is_call, 1.0, -1.0)
+        price = sign * (spot * np.exp(-dividend * years) * norm_cdf(sign * d1) - strike * np.exp(-rate * years) * norm_cdf(sign * d2))
+    intrinsic = np.maximum(np.where(is_call, spot - strike, strike - spot), 0.0)
+    return np.where(live, price, intrinsic)
+
+def bs_delta(spot, strike, years, vol, is_call, rate=0.0, dividend=0.0):
+    spot, strike, years, vol, is_call = np.broadcast_arrays(*map(np.asarray, (spot, strike, years, vol, is_call)))
+    live = (years > 0) & (vol > 0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        d1, _ = d1_d2(spot, strike, np.where(live, years, 1.0), np.where(live, vol, 1.0), rate, dividend)
+        delta = np.exp(-dividend * years) * np.where(is_call, norm_cdf(d1), norm_cdf(d1) - 1)
+    expired = np.where(is_call, (spot > strike) * 1.0, (spot < strike) * -1.0)
+    return np.where(live, delta, expired)
+
+def bs_vega(spot, strike, years, vol, rate=0.0, dividend=0.0):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        d1, _ = d1_d2(spot, strike, years, vol, rate, dividend)
+        return spot * np.exp(-dividend * years) * norm_pdf(d1) * np.sqrt(years)
+
+def implied_vol(price, spot, strike, years, is_call, rate=0.0, dividend=0.0, initial=0.3, iterations=50, tolerance=1e-8):
+    '''Implied volatilities of many options at once (Newton steps, bisection where Newton leaves the bracket).
+    NaN where the price is outside the no-arbitrage bounds.'''
+    price, spot, strike, years, is_call = np.broadcast_arrays(*map(lambda x: np.asarray(x, dtype=float), (price, spot, strike, years, is_call)))
+    is_call = is_call.astype(bool)
+    low, high = np.full(price.shape, 1e-4), np.full(price.shape, 5.0)
+    vol = np.full(price.shape, initial)
+    for _ in range(iterations):
+        error = bs_price(spot, strike, years, vol, is_call, rate, dividend) - price
+        low, high = np.where(error < 0, vol, low), np.where(error > 0, vol, high)
+        vega = bs_vega(spot, strike, years, vol, rate, dividend)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            step = vol - error / vega
+        vol = np.where((step > low) & (step < high), step, 0.5 * (low + high))
+        if np.all(np.abs(error) < tolerance):
+            break
+    valid = (price >= bs_price(spot, strike, years, 1e-4, is_call, rate, dividend) - tolerance) & \
+            (price <= bs_price(spot, strike, years, 5.0, is_call, rate, dividend) + tolerance) & (years > 0)
+    return np.where(valid, vol, np.nan)
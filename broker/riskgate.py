@@ -0,0 +1,289 @@
+# ATS/broker/riskgate.py
+# Local pre-trade risk checks. RiskState holds the book in the form the checks need (quantity and unit
+# exposures per contract, exposure per underlying, sector and strategy, gross/net exposure and short put
+# notional), rebuilt from the resident position book every few seconds. Checking an order is a handful of
+# dictionary lookups and additions on that state instead of a whatIfOrder round trip to TWS; whatIfOrder
+# remains the slow-path confirmation of margin-heavy orders (RiskManager.pre_trade_check).
+
+import math, threading, time
+from dataclasses import dataclass, field
+
+from ib_async.util import UNSET_DOUBLE
+
+from data_and_research.utils import strategies_table
+from data_and_research.metadata import get_symbol_metadata
+from .contracts import parse_contract
+
+RISK_LIMITS = {'max_gross': 2.0,              # gross exposure / equity
+               'max_net': 1.5,                # |net exposure| / equity
+               'max_position': 0.25,          # |exposure of one underlying| / equity
+               'max_sector': 0.5,             # |exposure of one sector| / equity
+               'max_short_put': 1.0,          # notional of the short puts / equity
+               'allocation_tolerance': 0.02,  # a strategy may exceed its max_weight by this share of equity
+               'confirm_above': 0.1}          # orders changing the exposure by more than this share of equity get a whatIfOrder
+LIMIT_OF = {'gross': 'max_gross', 'net': 'max_net', 'position': 'max_position', 'sector': 'max_sector', 'short_put': 'max_short_put'}
+OPTION_TYPES = {'OPT', 'FOP'}
+
+def contract_key(contract):
+    return contract.conId or (contract.symbol, contract.secType, contract.lastTradeDateOrContractMonth, contract.strike, contract.right, contract.currency)
+
+def contract_units(contract, price, fx):
+    '''Per unit of position, in base currency: (market value, exposure, short put notional, underlying symbol).
+    Exposure counts futures with their notional and options with their strike notional in the direction
+    of their delta (taken as +-1), a conservative stand-in for delta exposure that needs no market data.'''
+    multiplier = float(contract.multiplier or (100 if contract.secType in OPTION_TYPES else 1))
+    value = (price if price is not None and math.isfinite(price) else 0.0) * multiplier * fx
+    if contract.secType in OPTION_TYPES:
+        is_put = contract.right.startswith('P')
+        notional = contract.strike * multiplier * fx
+        return value, -notional if is_put else notional, notional if is_put else 0.0, contract.symbol
+    return value, value, 0.0, contract.symbol
+
+@dataclass
+class RiskState:
+    '''The book as sums in base currency. Changed in place by RiskGate.apply (fills of the book, reserved orders).'''
+    equity: float = 0.0
+    available_funds: float = 0.0
+    gross: float = 0.0
+    net: float = 0.0
+    short_put: float = 0.0
+    units: dict = field(default_factory=dict)                # contract key -> contract_units()
+    quantities: dict = field(default_factory=dict)           # contract key -> position of the account
+    strategy_quantities: dict = field(default_factory=dict)  # (strategy, contract key) -> position of the strategy
+    strategy_gross: dict = field(default_factory=dict)       # strategy -> sum of |market value|
+    underlyings: dict = field(default_factory=dict)          # symbol -> exposure
+    sectors: dict = field(default_factory=dict)              # sector -> exposure
+    sector_of: dict = field(default_factory=dict)            # symbol -> sector
+    fx: dict = field(default_factory=dict)                   # currency -> base currency per unit
+    bounds: dict = field(default_factory=dict)               # strategy -> (target, min, max) weight
+    reserved: dict = field(default_factory=dict)             # id of a reserved order -> (contract key, strategy, quantity)
+    built: float = 0.0
+
+@dataclass(frozen=True)
+class RiskCheck:
+    '''Result of a pre-trade check. confirm: the order is margin-heavy, what_if: OrderState of the slow path.'''
+    passed: bool
+    violations: tuple = ()
+    exposure: float = 0.0
+    confirm: bool = False
+    what_if: object = None
+
+class RiskGate:
+    '''Checks orders against allocation bounds, gross/net exposure, concentration, sector caps and short put
+    notional using cached state only.
+
+    The state is rebuilt from the portfolio manager's position book, account snapshot and FX cache when it is
+    older than max_age seconds (or after invalidate()). bounds: allocation bounds per strategy, by default
+    those of get_strategy_allocation_bounds (the cached strategies table).'''
+
+    def __init__(self, portfolio_manager, limits=None, metadata=None, bounds=None, max_age=5.0):
+        self.portfolio_manager = portfolio_manager
+        self.limits = {**RISK_LIMITS, **(limits or {})}
+        self.metadata = metadata if metadata else get_symbol_metadata()
+        self.bounds = bounds
+        self.max_age = max_age
+        self.state = None
+        self.sectors = {}  # symbol -> sector of symbols looked up outside the book
+        self.lock = threading.RLock()
+
+    def invalidate(self):
+        self.state = None
+
+    def get_state(self):
+        state = self.state
+        if state is None or time.monotonic() - state.built > self.max_age:
+            with self.lock:
+                if self.state is None or time.monotonic() - self.state.built > self.max_age:
+                    self.state = self.build_state()
+                state = self.state
+        return state
+
+    def build_state(self):
+        pm = self.portfolio_manager
+        snapshot = pm.account_state.snapshot
+        state = RiskState(equity=snapshot.equity, available_funds=snapshot.available_funds, built=time.monotonic())
+        if self.bounds is not None:
+            state.bounds = dict(self.bounds)
+        else:
+            strategies = strategies_table.get()
+            state.bounds = dict(strategies['bounds']) if strategies else {}
+
+        book = pm.position_book.to_frame()
+        if book.empty:
+            return state
+        rates = pm.fx_cache.get_fx_rates([(currency, pm.base) for currency in book['currency'].dropna().unique()])
+        state.fx = {currency: 1 / rate for (currency, _), rate in rates.items() if rate}
+        sectors = self.metadata.map_sectors(book['symbol'].unique())
+        state.sector_of = {symbol: sector for symbol, sector in zip(book['symbol'].unique(), sectors) if isinstance(sector, str)}
+
+        for row in book.to_dict('records'):
+            contract = parse_contract(row['contract'])
+            if contract is None:
+                continue
+            rate = row.get('fx_rate')
+            fx = state.fx.get(contract.currency) or (1 / rate if rate and math.isfinite(rate) else 1.0)
+            key = contract_key(contract)
+            state.units.setdefault(key, contract_units(contract, row.get('marketPrice'), fx))
+            self.apply(state, key, row.get('strategy') or '', row['position'])
+        return state
+
+    def changes(self, state, key, units, strategy, quantity):
+        '''{measure: (before, after)} of trading quantity of the contract for strategy.'''
+        unit_value, unit_exposure, unit_put, symbol = units
+        before = state.quantities.get(key, 0.0)
+        after = before + quantity
+        held = state.strategy_quantities.get((strategy, key), 0.0)
+        exposure = quantity * unit_exposure
+        sector = state.sector_of.get(symbol)
+        changes = {'gross': (state.gross, state.gross - abs(before * unit_exposure) + abs(after * unit_exposure)),
+                   'net': (state.net, state.net + exposure),
+                   'position': (state.underlyings.get(symbol, 0.0), state.underlyings.get(symbol, 0.0) + exposure),
+                   'short_put': (state.short_put, state.short_put + (max(-after, 0.0) - max(-before, 0.0)) * unit_put),
+                   'allocation': (state.strategy_gross.get(strategy, 0.0),
+                                  state.strategy_gross.get(strategy, 0.0) + (abs(held + quantity) - abs(held)) * abs(unit_value))}
+        if sector:
+            changes['sector'] = (state.sectors.get(sector, 0.0), state.sectors.get(sector, 0.0) + exposure)
+        return changes
+
+    def apply(self, state, key, strategy, quantity, units=None):
+        '''Adds quantity of the contract for strategy to the state.'''
+        units = state.units.setdefault(key, units) if units else state.units[key]
+        changes = self.changes(state, key, units, strategy, quantity)
+        state.gross, state.net, state.short_put = changes['gross'][1], changes['net'][1], changes['short_put'][1]
+        state.underlyings[units[3]] = changes['position'][1]
+        state.strategy_gross[strategy] = changes['allocation'][1]
+        if 'sector' in changes:
+            state.sectors[state.sector_of[units[3]]] = changes['sector'][1]
+        state.quantities[key] = state.quantities.get(key, 0.0) + quantity
+        state.strategy_quantities[(strategy, key)] = state.strategy_quantities.get((strategy, key), 0.0) + quantity
+
+    def reference_price(self, contract, order):
+        '''Price used for contracts outside the book: the limit price, else the last price of a streaming ticker.'''
+        if order.lmtPrice not in (None, UNSET_DOUBLE) and order.lmtPrice > 0:
+            return order.lmtPrice
+        ticker = self.portfolio_manager.ib.ticker(contract)
+        price = ticker.marketPrice() if ticker else math.nan
+        return price if math.isfinite(price) and price > 0 else None
+
+    def fx_rate(self, state, currency):
+        '''Base currency per unit of currency, None while the pair has no rate yet.'''
+        fx = state.fx.get(currency)
+        if fx is None:
+            pm = self.portfolio_manager
+            rate = pm.fx_cache.get_fx_rate(currency, pm.base)
+            if not rate:
+                return None
+            fx = state.fx.setdefault(currency, 1 / rate)
+        return fx
+
+    def sector(self, state, symbol):
+        if symbol not in state.sector_of:
+            if symbol not in self.sectors:
+                self.sectors[symbol] = self.metadata.sector(symbol, resolve=False)
+            if self.sectors[symbol]:
+                state.sector_of[symbol] = self.sectors[symbol]
+        return state.sector_of.get(symbol)
+
+    def check_order(self, contract, order, strategy=None, price=None, reserve=False):
+        '''Checks an order (strategy: order.orderRef by default) against the limits. An order only violates a
+        limit if it is beyond the limit afterwards and increases the measure, so risk-reducing orders pass.
+        price: reference price for contracts outside the book (see reference_price).
+        reserve: add a passing order to the state, so the next orders (e.g. of a basket) are checked on top of it.'''
+        state = self.get_state()
+        strategy = order.orderRef if strategy is None else strategy
+        quantity = order.totalQuantity if order.action == 'BUY' else -order.totalQuantity
+        key = contract_key(contract)
+        units = state.units.get(key)
+        if units is None:
+            price = price if price is not None else self.reference_price(contract, order)
+            if price is None and contract.secType not in OPTION_TYPES:
+                return RiskCheck(False, (f"No reference price for {contract.symbol}",), confirm=True)
+            fx = self.fx_rate(state, contract.currency)
+            if fx is None:
+                return RiskCheck(False, (f"No FX rate for {contract.currency}",), confirm=True)
+            units = contract_units(contract, price, fx)
+        self.sector(state, units[3])
+
+        equity = state.equity
+        if not equity or equity <= 0:
+            return RiskCheck(False, ("No account equity to check the order against",), confirm=True)
+
+        violations = []
+        changes = self.changes(state, key, units, strategy, quantity)
+        for measure, (before, after) in changes.items():
+            if measure == 'allocation':
+                bounds = state.bounds.get(strategy)
+                if not bounds or bounds[2] <= 0:
+                    continue  # no (or no valid) max_weight
+                limit = bounds[2] + self.limits['allocation_tolerance']
+            else:
+                limit = self.limits[LIMIT_OF[measure]]
+            if abs(after) > limit * equity and abs(after) > abs(before):
+                violations.append(f"{measure} {abs(after) / equity:.1%} of equity exceeds {limit:.1%}")
+
+        exposure = quantity * units[1]
+        before = state.quantities.get(key, 0.0)
+        sells_options = contract.secType in OPTION_TYPES and before + quantity < min(before, 0.0)
+        confirm = abs(exposure) > self.limits['confirm_above'] * equity or sells_options
+        if reserve and not violations:
+            with self.lock:
+                self.apply(state, key, strategy, quantity, units)
+                state.reserved[id(order)] = (key, strategy, quantity)
+        return RiskCheck(not violations, tuple(violations), exposure, confirm)
+
+    def release(self, order):
+        '''Takes back the reservation of an order that was rejected after check_order passed it (e.g. by whatIfOrder).
+        Nothing to do if the state was rebuilt since, a rebuilt state only contains the book.'''
+        with self.lock:
+            state = self.state
+            reservation = state.reserved.pop(id(order), None) if state else None
+            if reservation:
+                key, strategy, quantity = reservation
+                self.apply(state, key, strategy, -quantity)
+
+def benchmark(n_positions=500, runs=100000):
+    '''Times check_order against a synthetic book of n_positions stocks and options in 10 strategies.'''
+    import types
+    import numpy as np
+    import pandas as pd
+    from ib_async import Stock, Option, MarketOrder, LimitOrder
+    from .accountstate import AccountSnapshot
+    from .positionbook import PositionBook
+
+    rng = np.random.default_rng(0)
+    rows = []
+    for i in range(n_positions):
+        if i % 5:
+            contract = Stock(f'S{i:03d}', 'SMART', 'USD', conId=i + 1)
+            price, position = rng.uniform(20, 300), int(rng.integers(-200, 500))
+        else:
+            contract = Option(f'S{i + 1:03d}', '20271217', 100.0, 'P', 'SMART', multiplier='100', currency='USD', conId=i + 1)
+            contract.secType = 'OPT'
+            price, position = rng.uniform(1, 10), -int(rng.integers(1, 5))
+        rows.append({'timestamp': pd.Timestamp.now(), 'account': 'U1', 'symbol': contract.symbol, 'asset class': contract.secType,
+                     'strategy': f'STRAT{i % 10}', 'contract': contract, 'position': position, 'marketPrice': price,
+                     'currency': 'USD', 'fx_rate': 1.0})
+    book = PositionBook()
+    book.load(pd.DataFrame(rows).set_index('timestamp'))
+    pm = types.SimpleNamespace(position_book=book, base='USD', ib=None,
+                               account_state=types.SimpleNamespace(snapshot=AccountSnapshot(equity=2e7, available_funds=1e7)),
+                               fx_cache=types.SimpleNamespace(get_fx_rates=lambda pairs: {pair: 1.0 for pair in pairs}))
+    sectors = {f'S{i:03d}': ['Technology', 'Energy', 'Finance', 'Health'][i % 4] for i in range(n_positions + 1)}
+    metadata = types.SimpleNamespace(map_sectors=lambda symbols: [sectors.get(symbol) for symbol in symbols],
+                                     sector=lambda symbol, resolve=False: sectors.get(symbol))
+    gate = RiskGate(pm, metadata=metadata, bounds={f'STRAT{i}': (0.1, 0.05, 0.2) for i in range(10)}, max_age=3600)
+
+    start = time.perf_counter()
+    gate.get_state()
+    print(f"State of {n_positions} positions built in {(time.perf_counter() - start) * 1000:.1f} ms")
+    orders = [(rows[i]['contract'], MarketOrder('BUY', 100), f'STRAT{i % 10}') for i in range(0, n_positions, 7)]
+    orders.append((Stock('NEW', 'SMART', 'USD', conId=10 ** 6), LimitOrder('BUY', 1000, 50.0), 'STRAT0'))
+    start = time.perf_counter()
+    for i in range(runs):
+        contract, order, strategy = orders[i % len(orders)]
+        check = gate.check_order(contract, order, strategy)
+    print(f"check_order: {(time.perf_counter() - start) / runs * 1e6:.1f} us per order")
+    print(gate.check_order(Stock('S001', 'SMART', 'USD', conId=2), MarketOrder('BUY', 200000), 'STRAT1'))
+
+if __name__ == "__main__":
+    benchmark()
@@ -1,26 +1,108 @@
 # IB-Multi-Strategy-ATS/broker/riskmanager.py
 from ib_async import *
+import asyncio
 import pandas as pd
 import numpy as np
 from datetime import datetime, timedelta
+from dataclasses import replace
 import yfinance as yf
 
 from data_and_research import ac
+from data_and_research.metadata import SymbolMetadata, get_symbol_metadata
+from .contracts import qualify_contracts, parse_contract
+from .marketdata import fetch_market_prices, fetch_market_prices_async
+from .pricing import implied_vol
+from .var import ReturnMatrix, portfolio_var, covariance, correlation
+from .stress import stress_pnl
+from .riskgate import RiskGate, RiskCheck
 
 class RiskManager:
     def __init__(self, ib_client: IB, portfolio_manager = None, arctic = None):
         self.ib = ib_client
         self.arctic = arctic if arctic else ac
-        lib = self.arctic.get_library('univ')
-        self.uni = lib.read('us_equities').data
+        self.metadata = SymbolMetadata(arctic) if arctic else get_symbol_metadata()
+        self.return_matrix = None   # daily returns of VaR and correlations, cached between calls
+        self.var_contracts = {}     # return symbol -> contract whose IB bars are used if not in 'us_equities'
+        self.correlation_cache = {} # (day, symbols, days, shrinkage) -> (correlation, covariance)
+        self.stress_positions = None # positions of the last stress test
         if portfolio_manager:
             self.portfolio_manager = portfolio_manager
             self.fx_cache = self.portfolio_manager.fx_cache
             self.base = self.portfolio_manager.base
             self.account_id = self.portfolio_manager.account_id
-
-    def pre_trade_check(self, contract, order):
-        return self.ib.whatIfOrder(contract,order)
+            self.account_state = self.portfolio_manager.account_state
+        self.risk_gate = RiskGate(portfolio_manager, metadata=self.metadata) if portfolio_manager else None
+
+    def pre_trade_check(self, contract, order, confirm=None, reserve=False, ib=None):
+        ''' Checks an order with the local risk gate (cached book, no TWS requests), see riskgate.RiskGate.check_order.
+        Param: confirm: True: always confirm with whatIfOrder, False: never, None: only margin-heavy orders
+                        (large exposure, selling options) or orders that could not be checked locally.
+               reserve: count a passing order in the gate's state, for the next orders of a basket.
+               ib: connection for the TWS requests (the order's own, e.g. a strategy's), this one by default.
+
+        Output: RiskCheck with passed, violations and the whatIfOrder OrderState (what_if) if it was confirmed.
+        Blocks on TWS requests, use pre_trade_check_async inside the event loop.'''
+        ib = ib if ib else self.ib
+        if self.risk_gate is None:
+            # Without a portfolio manager there is no local state to check against
+            return self.confirm_order(contract, order, RiskCheck(True, confirm=True), ib)
+        check = self.risk_gate.check_order(contract, order, reserve=reserve)
+        if not check.passed and check.violations[0].startswith('No reference price'):
+            [price] = fetch_market_prices(ib, [contract])
+            if not np.isnan(price):
+                check = self.risk_gate.check_order(contract, order, price=float(price), reserve=reserve)
+        if confirm or (confirm is None and check.confirm and check.passed):
+            check = self.confirm_order(contract, order, check, ib)
+            if not check.passed:
+                self.risk_gate.release(order)
+        return check
+
+    async def pre_trade_check_async(self, contract, order, confirm=None, reserve=False, ib=None):
+        '''Async version of pre_trade_check: market data and whatIfOrder are awaited instead of blocking.'''
+        ib = ib if ib else self.ib
+        if self.risk_gate is None:
+            return await self.confirm_order_async(contract, order, RiskCheck(True, confirm=True), ib)
+        check = self.risk_gate.check_order(contract, order, reserve=reserve)
+        if not check.passed and check.violations[0].startswith('No reference price'):
+            [price] = await fetch_market_prices_async(ib, [contract])
+            if not np.isnan(price):
+                check = self.risk_gate.check_order(contract, order, price=float(price), reserve=reserve)
+        if confirm or (confirm is None and check.confirm and check.passed):
+            check = await self.confirm_order_async(contract, order, check, ib)
+            if not check.passed:
+                self.risk_gate.release(order)
+        return check
+
+    def confirm_order(self, contract, order, check, ib=None):
+        ''' Slow path: the margin impact of the order from TWS (whatIfOrder), see margin_check.'''
+        try:
+            what_if = (ib if ib else self.ib).whatIfOrder(contract, order)
+        except Exception as e:
+            what_if = e
+        return self.margin_check(contract, check, what_if)
+
+    async def confirm_order_async(self, contract, order, check, ib=None):
+        '''Async version of confirm_order.'''
+        try:
+            what_if = await (ib if ib else self.ib).whatIfOrderAsync(contract, order)
+        except Exception as e:
+            what_if = e
+        return self.margin_check(contract, check, what_if)
+
+    def margin_check(self, contract, check, what_if):
+        ''' Fails the check if whatIfOrder failed (what_if is its exception) or if the initial margin after
+        the order would exceed the equity with loan value.'''
+        try:
+            if isinstance(what_if, Exception):
+                raise what_if
+            init_margin, equity = float(what_if.initMarginAfter), float(what_if.equityWithLoanAfter)
+        except Exception as e:
+            print(f"whatIfOrder failed for {contract.symbol}: {e}")
+            return replace(check, passed=False, violations=check.violations + (f"whatIfOrder failed: {e}",))
+        violations = check.violations
+        if init_margin > equity:
+            violations += (f"initial margin {init_margin:,.0f} after the order exceeds the equity with loan value {equity:,.0f}",)
+        return replace(check, passed=not violations, violations=violations, what_if=what_if)
     
     def get_portfolio_data(self):
         portfolio = pd.DataFrame(self.ib.portfolio())
@@ -39,23 +121,8 @@ class RiskManager:
         put_option_rows = [row for _,row in self.portfolio.iterrows() if row['contract'].right == 'P' and np.sign(row['position']) == -1]
         short_put_df = pd.DataFrame(put_option_rows)
 
-        def get_sector(symbol, source='yf' or 'universe'):
-            if source == 'yf':
-                info = yf.Ticker(symbol).info
-                try:
-                    sector = info['sector']
-                    return sector
-                except KeyError:
-                    return None
-            elif source == 'universe':
-                # Check if the symbol exists in the DataFrame
-                if symbol in univ['Symbol'].values:
-                    sector = univ.loc[univ['Symbol'] == symbol, 'Sector'].values[0]
-                    return sector
-                else:
-                    return None
-        
-        short_put_df['sector'] = short_put_df['symbol'].apply(lambda x: get_sector(x,source='universe'))
+        # Sectors of the universe only: ETFs are not in the universe and have no sector
+        short_put_df['sector'] = self.metadata.map_sectors(short_put_df['symbol'])
         
         if exclude_ETFs:
             short_put_df = short_put_df[short_put_df['sector'].notna()].reset_index(drop=True)
@@ -64,7 +131,7 @@ class RiskManager:
         for symbol in short_put_df['symbol'].unique():
             # Create Stock contract
             contract = Stock(symbol, 'SMART', 'USD')
-            self.ib.qualifyContracts(contract)
+            qualify_contracts(self.ib, contract)
             [ticker] = self.ib.reqTickers(contract)
 
             price = ticker.marketPrice() if ticker.marketPrice() is not None else ticker.close
@@ -82,53 +149,170 @@ class RiskManager:
         self.short_put_df =short_put_df[['contract','symbol','sector','strike','stockprice','position','marketValue','averageCost','exposure_level1','exposure_level2','expected_dollar_return']]
         return self.short_put_df, {'Total Exposure': self.short_put_df.exposure_level1.sum(), 'Total Exposure at Risk': self.short_put_df.exposure_level2.sum(), 'Total Expected Dollar Return': self.short_put_df.expected_dollar_return.sum()}
 
-    def calculate_portfolio_var(self, confidence_level=0.95, time_horizon=1):
-        # Implement Value at Risk calculation
-        pass
-
-    def calculate_position_correlations(self):
-        # Implement correlation calculation between positions
-        pass
+    def calculate_portfolio_var(self, confidence_level=0.95, time_horizon=1, option_mode='delta', years=5):
+        ''' Historical, filtered historical and parametric VaR and Expected Shortfall of the portfolio in base currency.
+        Param: option_mode: 'delta' (options as delta exposure) or 'full' (Black-Scholes revaluation per scenario).
+
+        Output: DataFrame with VaR and ES (positive = loss) per method.'''
+        positions = self.get_var_positions()
+        if positions.empty:
+            return pd.DataFrame(columns=['VaR', 'ES'])
+        var_df, missing = portfolio_var(positions, self.get_return_matrix(years), confidence_level, time_horizon, option_mode)
+        if missing:
+            print(f"No price history for {missing}, these positions are not part of the VaR")
+        if 'fx' in positions.columns and positions['fx'].isna().any():
+            print(f"No FX rate yet for {sorted(set(positions.loc[positions['fx'].isna(), 'symbol']))}, these positions are not part of the VaR")
+        return var_df
+
+    def get_var_positions(self):
+        ''' The portfolio in the format of var.portfolio_var: stocks by symbol, options on their underlying
+        (implied volatility from the option price), other contracts as their own price series.'''
+        return self.build_positions(self.get_portfolio_data())
+
+    def stress_test_portfolio(self, scenarios, refresh=True, rate=0.0):
+        ''' P&L in base currency of every strategy in every scenario, the whole book repriced at once.
+        Param: scenarios: DataFrame with one row per scenario and columns of stress.SHOCKS (equity, vol, rate, fx,
+                          vix, vix_slope, days; missing ones are 0) or 'fx:<currency>', e.g. from stress.scenario_grid().
+               refresh: if False, the positions of the previous call are reused (no requests to TWS).
+
+        Output: DataFrame scenarios x strategies, plus the 'Total' column.'''
+        if refresh or self.stress_positions is None:
+            self.stress_positions = self.get_stress_positions()
+        if self.stress_positions.empty:
+            return pd.DataFrame(0.0, index=scenarios.index, columns=['Total'])
+        pnl, missing = stress_pnl(self.stress_positions, scenarios, getattr(self, 'base', 'USD'), rate)
+        if missing:
+            print(f"No price or implied volatility for {missing}, these positions are not part of the stress test")
+        return pnl
+
+    def get_stress_positions(self):
+        ''' The positions per strategy (resident position book of the portfolio manager, else the IB portfolio)
+        in the format of stress.stress_pnl.'''
+        if not hasattr(self, 'portfolio_manager'):
+            return self.build_positions(self.get_portfolio_data())
+        book = self.portfolio_manager.position_book.to_frame()
+        if book.empty:
+            return pd.DataFrame()
+        book = book.assign(contract=[parse_contract(contract) for contract in book['contract']])
+        return self.build_positions(book[book['contract'].notna()])
+
+    def build_positions(self, portfolio):
+        ''' Positions of a frame with contract, position, marketPrice (and strategy) columns in the format of
+        var.portfolio_var and stress.stress_pnl.'''
+        portfolio = portfolio[portfolio['position'] != 0]
+        if portfolio.empty:
+            return pd.DataFrame()
+        fx_rates = {}
+        if hasattr(self, 'fx_cache'):
+            # Without a rate yet the positions of a currency are reported as incomplete instead of priced at 1.0
+            fx_rates = {currency: 1 / self.fx_cache.get_fx_rate(currency, self.base, default=np.nan) for currency in {c.currency for c in portfolio['contract']}}
+
+        rows = []
+        for _, row in portfolio.iterrows():
+            contract = row['contract']
+            position = {'quantity': row['position'], 'price': row['marketPrice'], 'fx': fx_rates.get(contract.currency, 1.0),
+                        'strategy': row.get('strategy', ''), 'sec_type': contract.secType, 'currency': contract.currency,
+                        'underlying': contract.symbol}
+            position['symbol'] = self.get_return_symbol(contract)
+            if contract.lastTradeDateOrContractMonth:
+                expiry = pd.Timestamp(contract.lastTradeDateOrContractMonth[:8]) + pd.Timedelta(hours=16)
+                position['years'] = max((expiry - pd.Timestamp.now()).total_seconds() / (365 * 86400), 0.0)
+            if contract.secType == 'STK':
+                position['multiplier'] = 1.0
+            elif contract.secType == 'OPT':
+                position.update(multiplier=float(contract.multiplier or 100), right=contract.right, strike=contract.strike)
+            else:
+                position['multiplier'] = float(contract.multiplier or 1)
+            rows.append(position)
+        positions = pd.DataFrame(rows)
+
+        if 'right' in positions.columns:
+            is_option = positions['right'].notna()
+            underlyings = positions.loc[is_option, 'symbol'].unique().tolist()
+            currencies = {row['contract'].symbol: row['contract'].currency for _, row in portfolio.iterrows()}
+            prices = fetch_market_prices(self.ib, [Stock(symbol, 'SMART', currencies[symbol]) for symbol in underlyings])
+            positions.loc[is_option, 'underlying_price'] = positions.loc[is_option, 'symbol'].map(dict(zip(underlyings, prices)))
+            options = positions[is_option]
+            positions.loc[is_option, 'iv'] = implied_vol(options['price'], options['underlying_price'], options['strike'],
+                                                         options['years'], options['right'] == 'C')
+        return positions
+
+    def get_return_matrix(self, years=5):
+        if self.return_matrix is None or self.return_matrix.years != years:
+            stock_lib = self.arctic.get_library('us_equities') if 'us_equities' in self.arctic.list_libraries() else None
+            self.return_matrix = ReturnMatrix(stock_lib, years, fetch_closes=self.fetch_closes)
+            self.correlation_cache = {}
+        return self.return_matrix
+
+    def get_return_symbol(self, contract):
+        ''' The symbol of the price series a position moves with: stocks and options their (underlying) symbol,
+        other contracts (futures, FX, ...) their own series.'''
+        if contract.secType in ('STK', 'OPT'):
+            return contract.symbol
+        symbol = f"{contract.localSymbol or contract.symbol} {contract.secType}"
+        self.var_contracts[symbol] = contract
+        return symbol
+
+    def fetch_closes(self, symbols):
+        ''' Daily closes from IB of the symbols that are not in 'us_equities', all requested concurrently.'''
+        years = self.return_matrix.years if self.return_matrix else 5
+
+        async def request(contract):
+            what_to_show = 'ADJUSTED_LAST' if contract.secType == 'STK' else 'MIDPOINT' if contract.secType == 'CASH' else 'TRADES'
+            return await self.ib.reqHistoricalDataAsync(contract, endDateTime='', durationStr=f'{years} Y',
+                                                        barSizeSetting='1 day', whatToShow=what_to_show, useRTH=True)
+
+        async def request_all():
+            contracts = [self.var_contracts.get(symbol, Stock(symbol, 'SMART', 'USD')) for symbol in symbols]
+            return await asyncio.gather(*[request(contract) for contract in contracts], return_exceptions=True)
+
+        closes = {}
+        for symbol, bars in zip(symbols, self.ib.run(request_all())):
+            if isinstance(bars, Exception):
+                print(f"Error fetching the price history of {symbol}: {bars}")
+            elif bars:
+                df = pd.DataFrame(bars)
+                closes[symbol] = pd.Series(df['close'].to_numpy(), index=pd.to_datetime(df['date']))
+        return closes
+
+    def calculate_correlation_matrix(self, symbols, days=252, shrinkage=None):
+        ''' Correlation and covariance matrix of the daily returns of symbols over the last days, computed from
+        the cached return matrix and cached per trading day.
+        Param: shrinkage: None, an intensity in [0, 1] or 'ledoit_wolf' (shrinkage towards the scaled identity).
+
+        Output: (correlation DataFrame, covariance DataFrame) of the symbols with price history.'''
+        symbols = list(dict.fromkeys(symbols))
+        today = pd.Timestamp.today().normalize()
+        key = (today, tuple(symbols), days, shrinkage)
+        if key not in self.correlation_cache:
+            returns, known = self.get_return_matrix().dense(symbols, days)
+            cov, _ = covariance(returns, shrinkage)
+            self.correlation_cache = {cached: value for cached, value in self.correlation_cache.items() if cached[0] == today}
+            self.correlation_cache[key] = (pd.DataFrame(correlation(cov), index=known, columns=known),
+                                           pd.DataFrame(cov, index=known, columns=known))
+        return self.correlation_cache[key]
 
     def analyze_sector_exposure(self):
         portfolio = self.get_portfolio_data()
-        sector_exposure = {}
-        total_value = 0
+        stocks = portfolio[portfolio['asset_class'] == Stock].copy()
+        stocks['position_value'] = stocks['position'] * stocks['marketPrice']
 
-        for _, row in portfolio[portfolio['asset_class'] == Stock].iterrows():
+        # One join with the symbol metadata (yfinance lookups of unknown symbols are cached)
+        stocks['Sector'] = self.metadata.map_sectors(stocks['symbol'], resolve=True).astype(object)
+        for index, row in stocks[stocks['Sector'].isna()].iterrows():
             contract = row['contract']
-            contract = Stock(contract.symbol, 'SMART', contract.currency)
-            print(contract)
-            sector = self.get_sector_from_contract(contract)
-            position_value = row['position'] * row['marketPrice']
-            
-            if sector not in sector_exposure:
-                sector_exposure[sector] = 0
-            sector_exposure[sector] += position_value
-            total_value += position_value
-
-        # Calculate percentage exposure for each sector
-        for sector in sector_exposure:
-            sector_exposure[sector] = (sector_exposure[sector] / total_value) * 100
+            stocks.at[index, 'Sector'] = self.get_sector_from_contract(Stock(contract.symbol, 'SMART', contract.currency))
 
-        # Sort sectors by exposure percentage in descending order
-        sorted_exposure = sorted(sector_exposure.items(), key=lambda x: x[1], reverse=True)
-
-        # Create a DataFrame for better visualization
-        exposure_df = pd.DataFrame(sorted_exposure, columns=['Sector', 'Exposure (%)'])
-        exposure_df.set_index('Sector', inplace=True)
+        # Percentage exposure for each sector, sorted by exposure in descending order
+        sector_exposure = stocks.groupby(stocks['Sector'].fillna('None'))['position_value'].sum()
+        exposure_df = (sector_exposure / stocks['position_value'].sum() * 100).sort_values(ascending=False).to_frame('Exposure (%)')
+        exposure_df.index.name = 'Sector'
 
         return exposure_df
             
     def get_sector_from_contract(self,contract):
-        ''' Function that tries to retrieve sector information. Starts with ArcticDB, then tries to retrieve data from IB and Yahoo Finance as a fallback.'''
-        def get_sector_from_uni(contract):
-            try:
-                sector = self.uni[self.uni.Symbol==contract.symbol].Sector.values[0]
-                return sector
-            except:
-                return None
-        
+        ''' Function that tries to retrieve sector information. Starts with the symbol metadata (universe and cached lookups),
+        then tries to retrieve data from IB and Yahoo Finance as a fallback and caches what it found.'''
         def get_isin_from_contract(contract):
             import xml.etree.ElementTree as ET
             fundamentals = self.ib.reqFundamentalData(contract, reportType='ReportSnapshot')
@@ -156,20 +340,21 @@ class RiskManager:
                     sector = yf.Ticker(contract.symbol).info['category']
                 return sector
         
-        sector = ''
-        sector = get_sector_from_uni(contract) 
+        sector = self.metadata.sector(contract.symbol, resolve=False)
         if not sector:
-            sector = get_sector_from_yf(contract)
+            try:
+                sector = get_sector_from_yf(contract)
+            except Exception as e:
+                print(f"Error retrieving the sector of {contract.symbol}: {e}")
+                sector = None
+            if sector:
+                self.metadata.add(contract.symbol, sector)
         return sector
 
     def calculate_beta(self):
         # Calculate portfolio beta
         pass
 
-    def stress_test_portfolio(self, scenarios):
-        # Implement stress testing for various market scenarios
-        pass
-
     def calculate_sharpe_ratio(self):
         # Calculate Sharpe ratio for the portfolio
         pass
@@ -203,40 +388,30 @@ class RiskManager:
                                     barSizeSetting=bar_size, whatToShow='ADJUSTED_LAST', useRTH=True)
         return pd.DataFrame(bars)
 
-    def calculate_position_correlations(self):
-        spy = Stock('SPY', 'SMART', 'USD')
-        tlt = Stock('TLT', 'SMART', 'USD')
-
-        spy_data = self.get_historical_data(spy)
-        tlt_data = self.get_historical_data(tlt)
-
-        spy_returns = spy_data['close'].pct_change().dropna()
-        tlt_returns = tlt_data['close'].pct_change().dropna()
-
-        correlations = {}
-
-        # Get the portfolio positions
+    def calculate_position_correlations(self, days=252, shrinkage=None):
+        ''' Correlation of every position with SPY (equity-like) and TLT (bond-like), signed by the position direction.
+        All return series come from one correlation matrix (see calculate_correlation_matrix).'''
+        benchmarks = ['SPY', 'TLT']
         portfolio = pd.DataFrame(self.ib.portfolio())
+        if portfolio.empty:
+            print("No correlations were calculated. Check the contracts and data availability.")
+            return None
         portfolio['symbol'] = portfolio['contract'].apply(lambda x: x.symbol)
+        portfolio['return_symbol'] = portfolio['contract'].apply(self.get_return_symbol)
+
+        corr, _ = self.calculate_correlation_matrix(portfolio['return_symbol'].tolist() + benchmarks, days, shrinkage)
+        missing = [symbol for symbol in benchmarks if symbol not in corr.index]
+        if missing:
+            print(f"No price history for {missing}, no correlations were calculated.")
+            return None
 
+        correlations = {}
         for _, row in portfolio.iterrows():
-            try:
-                contract = row['contract']
-                hist_data = self.get_historical_data(contract)
-                returns = hist_data['close'].pct_change().dropna()
-                
-                aligned_data = pd.concat([returns, spy_returns, tlt_returns], axis=1, join='inner')
-                aligned_data.columns = ['asset', 'SPY', 'TLT']
-                
-                corr_spy = aligned_data['asset'].corr(aligned_data['SPY'])
-                corr_tlt = aligned_data['asset'].corr(aligned_data['TLT'])
-                
-                position_sign = np.sign(row['position'])
-                correlations[row['symbol']] = {
-                    'SPY': corr_spy * position_sign,
-                    'TLT': corr_tlt * position_sign}
-            except Exception as e:
-                print(f"Error processing {row['symbol']}: {str(e)}")
+            if row['return_symbol'] not in corr.index:
+                print(f"Error processing {row['symbol']}: no price history")
+                continue
+            position_sign = np.sign(row['position'])
+            correlations[row['symbol']] = {benchmark: corr.at[row['return_symbol'], benchmark] * position_sign for benchmark in benchmarks}
         if not correlations:
             print("No correlations were calculated. Check the contracts and data availability.")
             return None
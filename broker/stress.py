@@ -0,0 +1,159 @@
+# ATS/broker/stress.py
+# Scenario stress tests of the portfolio. A scenario is one row of shocks (equity return, volatility and rate
+# shifts, FX returns, a shift of the VIX futures term structure); the whole book is repriced in all scenarios
+# at once, options with Black-Scholes and stocks and futures linearly, and the P&L is summed per strategy.
+
+import numpy as np
+import pandas as pd
+
+from .pricing import bs_price
+
+# Shocks of a scenario and their defaults. 'fx:<currency>' columns add a return of that currency against the base
+SHOCKS = {'equity': 0.0,     # return of equity underlyings (times the position's beta, 1.0 by default)
+          'vol': 0.0,        # shift of the implied volatilities (0.1 = +10 vol points)
+          'rate': 0.0,       # shift of the interest rate
+          'fx': 0.0,         # return of every foreign currency against the base currency
+          'vix': 0.0,        # parallel shift of the VIX futures curve in index points
+          'vix_slope': 0.0,  # additional VIX points per month to expiry (negative: the front moves most)
+          'days': 0.0}       # calendar days that pass (option time decay)
+VIX_SYMBOLS = {'VIX', 'VXM', 'VX'}
+MARGINED = {'FUT'}  # settled daily: FX moves translate the P&L only, not the notional
+MIN_VOL = 0.01
+
+def scenario_grid(**shocks):
+    '''All combinations of the given shock values, e.g. scenario_grid(equity=np.linspace(-0.3, 0.1, 41), vol=[0, 0.1, 0.2]).'''
+    index = pd.MultiIndex.from_product([np.atleast_1d(values) for values in shocks.values()], names=list(shocks))
+    return index.to_frame(index=False)
+
+def scenario_columns(scenarios, currencies, base_currency):
+    '''The shocks of all scenarios as arrays; fx becomes a scenarios x currencies matrix.'''
+    unknown = [column for column in scenarios.columns if column not in SHOCKS and not str(column).startswith('fx:')]
+    if unknown:
+        raise ValueError(f"Unknown shocks {unknown}, use {list(SHOCKS)} or 'fx:<currency>'")
+    shocks = {name: scenarios[name].to_numpy(dtype=float) if name in scenarios.columns else np.full(len(scenarios), default)
+              for name, default in SHOCKS.items()}
+    fx = np.zeros((len(scenarios), len(currencies)))
+    for i, currency in enumerate(currencies):
+        if currency != base_currency:
+            fx[:, i] = shocks['fx'] + (scenarios[f'fx:{currency}'].to_numpy(dtype=float) if f'fx:{currency}' in scenarios.columns else 0.0)
+    shocks['fx'] = fx
+    return shocks
+
+def stress_pnl(positions, scenarios, base_currency='USD', rate=0.0, chunk_size=2000):
+    '''P&L in base currency of every strategy in every scenario.
+
+    positions: one row per position with strategy, symbol (the underlying for options), sec_type, currency,
+    quantity, multiplier, price, fx (base currency per unit of the position's currency) and optionally beta,
+    underlying (contract symbol, if symbol is another price series) and years (to expiry, used by the VIX
+    term structure shift); option rows also have right ('C'/'P'), strike, iv and underlying_price.
+    Positions on VIX_SYMBOLS move with the VIX curve instead of 'equity'.
+    scenarios: one row per scenario with columns of SHOCKS (missing ones are 0) and 'fx:<currency>'.
+    Returns (DataFrame scenarios x strategies plus 'Total', symbols of positions with incomplete data).'''
+    strategies, codes = np.unique(positions['strategy'].fillna('').replace('', 'Unassigned').to_numpy(dtype=str), return_inverse=True)
+    currencies, currency_codes = np.unique(positions['currency'].to_numpy(dtype=str), return_inverse=True)
+    membership = np.zeros((len(positions), len(strategies)))
+    membership[np.arange(len(positions)), codes] = 1.0
+
+    quantity = positions['quantity'].to_numpy(dtype=float) * positions['multiplier'].to_numpy(dtype=float)
+    fx_now = positions['fx'].to_numpy(dtype=float) if 'fx' in positions.columns else np.ones(len(positions))
+    beta = positions['beta'].fillna(1.0).to_numpy(dtype=float) if 'beta' in positions.columns else np.ones(len(positions))
+    years = positions['years'].fillna(0.0).to_numpy(dtype=float) if 'years' in positions.columns else np.zeros(len(positions))
+    is_vix = positions['underlying' if 'underlying' in positions.columns else 'symbol'].isin(VIX_SYMBOLS).to_numpy()
+    margined = positions['sec_type'].isin(MARGINED).to_numpy()
+    is_option = positions['right'].isin(['C', 'P']).to_numpy() if 'right' in positions.columns else np.zeros(len(positions), dtype=bool)
+
+    spot = positions['price'].to_numpy(dtype=float)
+    if is_option.any():
+        spot = np.where(is_option, positions['underlying_price'].to_numpy(dtype=float) if 'underlying_price' in positions.columns else np.nan, spot)
+        options = positions[is_option]
+        strike, iv = options['strike'].to_numpy(dtype=float), options['iv'].to_numpy(dtype=float)
+        is_call = (options['right'] == 'C').to_numpy()
+        value_now = spot.copy()
+        value_now[is_option] = bs_price(spot[is_option], strike, years[is_option], iv, is_call, rate)
+    else:
+        value_now = spot
+    value_now = quantity * value_now
+    incomplete = ~np.isfinite(value_now) | ~np.isfinite(fx_now)
+    if is_option.any():
+        incomplete[is_option] |= ~np.isfinite(iv)  # without an implied volatility bs_price would return the intrinsic value
+        complete = ~incomplete[is_option]
+        strike, iv, is_call = strike[complete], iv[complete], is_call[complete]
+
+    shocks = scenario_columns(scenarios, currencies, base_currency)
+    fx = shocks['fx']
+
+    # Stocks and futures not on the VIX are linear in the shocks: their P&L is a product of the scenario matrix
+    # with their exposures summed per (currency, strategy). Their prices are not floored at 0 (equity * beta < -1)
+    linear = ~is_option & ~is_vix & ~incomplete
+    exposure = fx_now * value_now
+    funded, beta_weighted = np.zeros((len(currencies), len(strategies))), np.zeros((len(currencies), len(strategies)))
+    np.add.at(funded, (currency_codes[linear & ~margined], codes[linear & ~margined]), exposure[linear & ~margined])
+    np.add.at(beta_weighted, (currency_codes[linear], codes[linear]), (exposure * beta)[linear])
+    pnl = fx @ funded + shocks['equity'][:, None] * ((1 + fx) @ beta_weighted)
+
+    # Options and VIX futures are repriced in every scenario (scenarios x positions), in chunks of scenarios
+    dense = (is_option | is_vix) & ~incomplete
+    if dense.any():
+        spot, quantity, beta, years = spot[dense], quantity[dense], beta[dense], years[dense]
+        fx_now, value_now, margined, option = fx_now[dense], value_now[dense], margined[dense], is_option[dense]
+        is_vix, currency_codes, membership = is_vix[dense], currency_codes[dense], membership[dense]
+
+        # Local prices only depend on the market shocks, not on FX: every distinct market scenario is priced once
+        market = np.column_stack([shocks[name] for name in ('equity', 'vol', 'rate', 'days', 'vix', 'vix_slope')])
+        market, inverse = np.unique(market, axis=0, return_inverse=True)
+        inverse = inverse.reshape(-1)
+        value_then = np.empty((len(market), len(spot)))
+        for start in range(0, len(market), chunk_size):
+            part = slice(start, start + chunk_size)
+            equity, vol, rate_shift, days, vix, vix_slope = (market[part, i, None] for i in range(market.shape[1]))
+            shocked = np.maximum(np.where(is_vix, spot + vix + vix_slope * years * 12, spot * (1 + equity * beta)), 0.0)
+            value_then[part] = quantity * shocked
+            if option.any():
+                value_then[part, option] = quantity[option] * bs_price(shocked[:, option], strike, np.maximum(years[option] - days / 365, 0.0),
+                                                                       np.maximum(iv + vol, MIN_VOL), is_call, rate + rate_shift)
+
+        # Revaluation in base currency; margined contracts only translate their P&L
+        for start in range(0, len(scenarios), chunk_size):
+            part = slice(start, start + chunk_size)
+            fx_then = fx_now * (1 + fx[part][:, currency_codes])
+            then = value_then[inverse[part]]
+            change = np.where(margined, fx_then * (then - value_now), fx_then * then - fx_now * value_now)
+            pnl[part] += np.nan_to_num(change) @ membership
+
+    result = pd.DataFrame(pnl, index=scenarios.index, columns=strategies)
+    result['Total'] = pnl.sum(axis=1)
+    result.columns.name = 'strategy'
+    return result, sorted(set(positions.loc[incomplete, 'symbol']))
+
+def benchmark(n_positions=500, n_options=100, n_strategies=6, runs=5):
+    '''Times stress_pnl for a synthetic book (stocks, options, VIX futures, two currencies) over a grid of about 10,000 scenarios.'''
+    import time
+    rng = np.random.default_rng(0)
+    n_stocks = n_positions - n_options - 4
+    spot = rng.uniform(20, 500, n_stocks)
+    stocks = pd.DataFrame({'symbol': [f'S{i:03d}' for i in range(n_stocks)], 'sec_type': 'STK', 'quantity': rng.integers(-500, 1000, n_stocks),
+                           'multiplier': 1.0, 'price': spot, 'currency': rng.choice(['USD', 'EUR'], n_stocks, p=[0.8, 0.2])})
+    underlying = rng.integers(0, n_stocks, n_options)
+    options = pd.DataFrame({'symbol': stocks['symbol'].to_numpy()[underlying], 'sec_type': 'OPT', 'quantity': rng.integers(-20, 20, n_options),
+                            'multiplier': 100.0, 'currency': stocks['currency'].to_numpy()[underlying], 'right': rng.choice(['C', 'P'], n_options),
+                            'strike': np.round(spot[underlying] * rng.uniform(0.8, 1.2, n_options)), 'years': rng.uniform(0.02, 1.0, n_options),
+                            'iv': rng.uniform(0.15, 0.6, n_options), 'underlying_price': spot[underlying]})
+    options['price'] = bs_price(options['underlying_price'], options['strike'], options['years'], options['iv'], options['right'] == 'C')
+    futures = pd.DataFrame({'symbol': 'VIX', 'sec_type': 'FUT', 'quantity': -rng.integers(1, 5, 4), 'multiplier': 1000.0,
+                            'price': [17.5, 18.6, 19.4, 20.0], 'currency': 'USD', 'years': [1 / 12, 2 / 12, 3 / 12, 4 / 12]})
+    positions = pd.concat([stocks, options, futures], ignore_index=True)
+    positions['strategy'] = rng.choice([f'STRAT{i}' for i in range(n_strategies)], len(positions))
+    positions['fx'] = np.where(positions['currency'] == 'EUR', 1.08, 1.0)
+
+    scenarios = scenario_grid(equity=np.linspace(-0.3, 0.1, 41), vol=[0.0, 0.05, 0.1, 0.2, 0.3, 0.5, 0.8],
+                              vix=[0, 5, 10, 20, 40], fx=[-0.1, -0.05, -0.02, 0.0, 0.02, 0.05, 0.1])
+    start = time.perf_counter()
+    for _ in range(runs):
+        pnl, missing = stress_pnl(positions, scenarios)
+    elapsed = (time.perf_counter() - start) / runs
+    print(f"{len(positions)} positions ({n_options} options) x {len(scenarios)} scenarios: {elapsed * 1000:.0f} ms per call "
+          f"({elapsed / len(scenarios) * 1e6:.1f} us per scenario)")
+    print(pnl.round(0).join(scenarios).nsmallest(5, 'Total').to_string())
+
+if __name__ == "__main__":
+    benchmark()
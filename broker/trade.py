@@ -2,6 +2,8 @@
 from ib_async import *
 from gui.log import add_log
 
+from .contracts import qualify_contracts
+
 
 def trade(ib, contract, quantity, order_type='MKT', urgency='Patient', orderRef="", limit=None):
     """
@@ -14,7 +16,7 @@ def trade(ib, contract, quantity, order_type='MKT', urgency='Patient', orderRef=
     :param urgency: 'Patient' (default), 'Normal', 'Urgent'
     :param limit: if order_type 'LMT' state limit as float
     """
-    ib.qualifyContracts(contract)
+    qualify_contracts(ib, contract)
 
     # Create order object
     action = 'BUY' if quantity > 0 else 'SELL'
@@ -52,7 +54,7 @@ def roll_future(ib, current_contract, new_contract, orderRef=""):
         :param orderRef: Reference identifier for the order.
     """
     # Qualify contracts
-    ib.qualifyContracts(current_contract,new_contract)
+    qualify_contracts(ib, current_contract, new_contract)
 
     # Define quantity based on current position
     quantity = [pos.position for pos in ib.portfolio() if pos.contract.localSymbol==current_contract.localSymbol][0]
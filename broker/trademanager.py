@@ -1,13 +1,20 @@
 # ATS/broker/trademanager.py
 from ib_async import *
-import time
+import asyncio
+
+from .contracts import qualify_contracts, qualify_contracts_async
+
+# Order states in which TWS has acknowledged the order
+ACK_STATES = {OrderStatus.PreSubmitted, OrderStatus.Submitted} | OrderStatus.DoneStates
 
 class TradeManager:
-    def __init__(self, ib_client,strategy_manager):
+    def __init__(self, ib_client,strategy_manager, risk_manager=None):
         self.ib = ib_client
         self.strategy_manager = strategy_manager
+        # Every order has to pass the pre-trade checks, by default those of the strategy manager's risk manager
+        self.risk_manager = risk_manager if risk_manager else getattr(strategy_manager, 'risk_manager', None)
 
-    def trade(self, contract, quantity, order_type='MKT', algo = True, urgency='Patient', orderRef="", limit=None, useRth = False):
+    def trade(self, contract, quantity, order_type='MKT', algo = True, urgency='Patient', orderRef="", limit=None, useRth = False, ack_timeout=2):
         """
         Place an Order on the exchange via ib_insync.
         :param contract: ib.Contract
@@ -15,9 +22,14 @@ class TradeManager:
         :param order_type: order type such as 'LMT', 'MKT' etc.
         :param urgency: 'Patient' (default), 'Normal', 'Urgent'
         :param limit: if order_type 'LMT' state limit as float
+        :param ack_timeout: seconds to wait at most for TWS to acknowledge the order
         """
-        self.ib.qualifyContracts(contract)
-        
+        trade = self.submit_order(contract, quantity, order_type, algo, urgency, orderRef, limit, useRth)
+        if trade:
+            self.ib.run(self.wait_for_ack(trade, ack_timeout))
+        return trade
+
+    def create_order(self, quantity, order_type='MKT', algo = True, urgency='Patient', orderRef="", limit=None, useRth = False):
         # Create order object
         action = 'BUY' if quantity > 0 else 'SELL'
         totalQuantity = int(abs(quantity))
@@ -40,16 +52,42 @@ class TradeManager:
 
         order.orderRef = orderRef
         order.useRth = useRth
+        return order
+
+    def submit_order(self, contract, quantity, order_type='MKT', algo = True, urgency='Patient', orderRef="", limit=None, useRth = False, qualify=True):
+        """
+        Places an order and returns its Trade immediately, without waiting for TWS.
+        Use wait_for_ack / wait_for_fill to await the order's events. Parameters as in trade().
+        Returns None if the order fails the pre-trade checks of the risk manager.
+        Blocks on TWS requests, use submit_order_async inside the event loop.
+        """
+        if qualify:
+            qualify_contracts(self.ib, contract)
+        order = self.create_order(quantity, order_type, algo, urgency, orderRef, limit, useRth)
+        check = self.risk_manager.pre_trade_check(contract, order, reserve=True, ib=self.ib) if self.risk_manager else None
+        return self.place_order(contract, order, check)
+
+    async def submit_order_async(self, contract, quantity, order_type='MKT', algo = True, urgency='Patient', orderRef="", limit=None, useRth = False, qualify=True):
+        """Async version of submit_order: qualification and pre-trade checks are awaited instead of blocking."""
+        if qualify:
+            await qualify_contracts_async(self.ib, contract)
+        order = self.create_order(quantity, order_type, algo, urgency, orderRef, limit, useRth)
+        check = await self.risk_manager.pre_trade_check_async(contract, order, reserve=True, ib=self.ib) if self.risk_manager else None
+        return self.place_order(contract, order, check)
+
+    def place_order(self, contract, order, check=None):
+        """Places the order unless it failed its pre-trade check and notifies the strategy manager."""
+        if check is not None and not check.passed:
+            print(f"Order {order.action} {order.totalQuantity} {contract.symbol} of '{order.orderRef}' rejected by the pre-trade checks: {'; '.join(check.violations)}")
+            return None
 
         # Place the order
         trade = self.ib.placeOrder(contract, order)
-        time.sleep(1)
-        self.ib.sleep(1)
 
         # Notify the strategy manager about the order placement
         self.strategy_manager.message_queue.put({
             'type': 'order',
-            'strategy': orderRef,
+            'strategy': order.orderRef,
             'trade': trade,
             'contract': contract,
             'order': order,
@@ -58,6 +96,47 @@ class TradeManager:
         
         return trade
 
+    async def submit_basket_async(self, orders, ack_timeout=5):
+        """
+        Submits a basket of orders concurrently: all contracts are qualified in one go, all orders placed
+        right away and then the acknowledgements are awaited together.
+        :param orders: list of dicts with the arguments of trade(), e.g. {'contract': c, 'quantity': 10, 'orderRef': 'S1'}
+        :param ack_timeout: seconds to wait at most for the acknowledgements
+        Returns the list of Trades (None for orders rejected by the pre-trade checks).
+        """
+        await qualify_contracts_async(self.ib, *[order['contract'] for order in orders])
+        # One after the other: every passing order is reserved in the risk gate before the next one is checked
+        trades = [await self.submit_order_async(qualify=False, **order) for order in orders]
+        await asyncio.gather(*[self.wait_for_ack(trade, ack_timeout) for trade in trades if trade])
+        return trades
+
+    def submit_basket(self, orders, ack_timeout=5):
+        """Blocking version of submit_basket_async."""
+        return self.ib.run(self.submit_basket_async(orders, ack_timeout))
+
+    async def wait_for_status(self, trade, statuses, timeout=None):
+        """Waits on the trade's status events until its status is one of statuses. Returns False on timeout."""
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + timeout if timeout is not None else None
+        while trade.orderStatus.status not in statuses:
+            remaining = deadline - loop.time() if deadline is not None else None
+            if remaining is not None and remaining <= 0:
+                return False
+            try:
+                await asyncio.wait_for(trade.statusEvent, remaining)
+            except asyncio.TimeoutError:
+                return False
+        return True
+
+    async def wait_for_ack(self, trade, timeout=5):
+        """Waits until TWS acknowledged (or already finished) the order. Returns False on timeout."""
+        return await self.wait_for_status(trade, ACK_STATES, timeout)
+
+    async def wait_for_fill(self, trade, timeout=None):
+        """Waits until the order is done. Returns True if it was filled, False if it was cancelled or timed out."""
+        await self.wait_for_status(trade, OrderStatus.DoneStates, timeout)
+        return trade.orderStatus.status == OrderStatus.Filled
+
     def roll_future(self, current_contract, new_contract, orderRef=""):
         """
             Roll a futures contract by closing the current contract and opening a new one.
@@ -66,7 +145,7 @@ class TradeManager:
             :param orderRef: Reference identifier for the order.
         """
         # Qualify contracts
-        self.ib.qualifyContracts(current_contract,new_contract)
+        qualify_contracts(self.ib, current_contract, new_contract)
 
         # Define quantity based on current position
         quantity = [pos.position for pos in self.ib.portfolio() if pos.contract.localSymbol==current_contract.localSymbol][0]
@@ -10,6 +10,7 @@ import yfinance as yf
 import asyncio
 from ib_async import *
 from data_and_research import ac
+from data_and_research.metadata import get_symbol_metadata
 from collections import defaultdict
 import matplotlib.pyplot as plt
 
@@ -432,20 +433,10 @@ def get_index_sector_composition(source='yf' or 'universe',symbols=None,index='s
             except:
                 next
     elif source == 'universe':
-        lib = ac.get_library('univ')
-        univ = lib.read('us_equities').data
-
-        for sym in symbols:
-            try:
-                sector = univ.loc[univ['Symbol'] == sym, 'Sector'].values[0]
-                market_cap = univ.loc[univ['Symbol'] == sym, 'Market Cap'].values[0]
-                if math.isnan(market_cap):
-                    next 
-                else:
-                    market_caps = np.append(market_caps, market_cap)
-                sectors = np.append(sectors, sector)
-            except:
-                next
+        # One join of all symbols with the universe, keeping the symbols with sector and market cap
+        metadata = get_symbol_metadata().map_metadata(symbols, ['Sector', 'Market Cap']).dropna()
+        sectors = metadata['Sector'].astype(str).to_numpy()
+        market_caps = metadata['Market Cap'].to_numpy()
 
     # Dictionary to hold capital at risk by sector
     mktcap_by_sector = defaultdict(float)
@@ -3,48 +3,209 @@
 import pandas as pd
 import yfinance as yf
 from ib_async import *
-from arcticdb import QueryBuilder
 
-import math, datetime
+import math, datetime, time, threading, json, ast, asyncio
+
+from .contracts import cache_contract
 
 class FXCache:
-    def __init__(self, ib_client):
+    '''FX rates from streaming IB tickers, one subscription per (currency, base_currency) pair.
+
+    Rates are updated on every tick of their ticker. A rate that has not ticked for ttl seconds is stale:
+    it is still served, while a fresh quote is fetched from yfinance on a background thread.
+    get_fx_rates() and get_fx_rate() never wait for data: a pair without any quote yet has no rate until its
+    ticker or the background fallback delivers one. warm_up() waits a bounded time for the first rates at start-up.'''
+    def __init__(self, ib_client, ttl=300):
         self.ib = ib_client
-        self.fx_cache = {}
+        self.ttl = ttl
+        self.fx_cache = {}  # (currency, base_currency) -> (rate, time of the last update)
+        self.tickers = {}
+        self.refreshing = set()
+        self.lock = threading.Lock()
 
-    def get_fx_rate(self, currency, base_currency):
-        # Check if the rate is already cached
-        if (currency, base_currency) in self.fx_cache:
-            return self.fx_cache[(currency, base_currency)]
+    def subscribe(self, pairs):
+        '''Starts a streaming ticker for every pair that is not subscribed yet. Does not wait for data.'''
+        new_pairs = [pair for pair in dict.fromkeys(pairs) if pair[0] != pair[1] and pair not in self.tickers]
+        if not new_pairs:
+            return
+        self.ib.reqMarketDataType(4)  # Dynamic data
+        for currency, base_currency in new_pairs:
+            ticker = self.ib.reqMktData(Forex(base_currency + currency), '', False, False)
+            ticker.updateEvent += lambda ticker, pair=(currency, base_currency): self.on_tick(pair, ticker)
+            self.tickers[(currency, base_currency)] = ticker
 
-        if currency == base_currency:
-            self.fx_cache[(currency, base_currency)] = 1.0
-        else:
-            fx_pair = Forex(base_currency + currency)
-            self.ib.reqMarketDataType(4)  # Dynamic data
-            self.ib.qualifyContracts(fx_pair)
-            rate = self.ib.reqMktData(fx_pair, '', False, False)
-            self.ib.sleep(0.2)  # small delay for data fetch
-
-            if type(rate.marketPrice()) == float and not math.isnan(rate.marketPrice()):
-                self.fx_cache[(currency, base_currency)] = rate.marketPrice()
-            else:
-                # Fallback if no live data
-                ticker = f"{base_currency}{currency}=X"
-                try:
-                    rate = yf.Ticker(ticker).info['ask']
-                    self.fx_cache[(currency, base_currency)] = rate
-                except:
-                    self.fx_cache[(currency, base_currency)] = 1.0  # Default FX rate if all else fails
-
-        return self.fx_cache[(currency, base_currency)]
+    def on_tick(self, pair, ticker):
+        price = ticker.marketPrice()
+        if isinstance(price, float) and not math.isnan(price) and price > 0:
+            with self.lock:
+                self.fx_cache[pair] = (price, time.time())
+
+    def is_stale(self, pair):
+        with self.lock:
+            entry = self.fx_cache.get(pair)
+        return entry is None or time.time() - entry[1] > self.ttl
+
+    def get_fx_rates(self, pairs):
+        '''Returns {(currency, base_currency): rate} for all pairs with a known rate, without blocking.
+        Unknown pairs get subscribed, stale ones refreshed in the background.'''
+        pairs = list(dict.fromkeys(pairs))
+        self.subscribe(pairs)
+
+        rates = {}
+        for pair in pairs:
+            if pair[0] == pair[1]:
+                rates[pair] = 1.0
+                continue
+            with self.lock:
+                entry = self.fx_cache.get(pair)
+            if entry is not None:
+                rates[pair] = entry[0]
+            if entry is None or time.time() - entry[1] > self.ttl:
+                self.refresh_in_background(pair)
+        return rates
+
+    def get_fx_rate(self, currency, base_currency, default=None):
+        '''The last known rate of the pair, also if stale, without blocking. default if there is no rate yet:
+        the pair is then subscribed and a fallback quote fetched in the background.'''
+        pair = (currency, base_currency)
+        return self.get_fx_rates([pair]).get(pair, default)
+
+    def fetch_fx_rate(self, currency, base_currency, default=None):
+        '''Like get_fx_rate, but fetches the fallback quote of a pair without a rate right away. Blocks on
+        yfinance, so only for worker threads (e.g. the strategy manager's message thread), not the event loop.'''
+        rate = self.get_fx_rate(currency, base_currency)
+        if rate is None:
+            rate = self.fetch_fallback_rate((currency, base_currency))
+        return rate if rate is not None else default
+
+    def seed(self, rates):
+        '''Known rates {(currency, base_currency): rate}, e.g. stored with the positions, for pairs without a rate.
+        They are served as stale until a tick or the fallback replaces them.'''
+        with self.lock:
+            for pair, rate in rates.items():
+                if rate and math.isfinite(rate) and pair not in self.fx_cache:
+                    self.fx_cache[pair] = (rate, 0.0)
+
+    async def warm_up_async(self, pairs, timeout=5.0):
+        '''Subscribes the pairs and waits at most timeout seconds until each has a fresh rate: its first tick,
+        else (after half the timeout) the yfinance fallback.'''
+        pairs = [pair for pair in dict.fromkeys(pairs) if pair[0] != pair[1]]
+        self.subscribe(pairs)
+
+        async def first_tick(pair):
+            while self.is_stale(pair):
+                await self.tickers[pair].updateEvent
+
+        async def fresh_rate(pair):
+            try:
+                await asyncio.wait_for(first_tick(pair), timeout / 2)
+            except asyncio.TimeoutError:
+                await asyncio.to_thread(self.fetch_fallback_rate, pair)
+
+        try:
+            await asyncio.wait_for(asyncio.gather(*[fresh_rate(pair) for pair in pairs]), timeout)
+        except asyncio.TimeoutError:
+            pass
+        missing = [f"{base_currency}{currency}" for currency, base_currency in pairs if self.is_stale((currency, base_currency))]
+        if missing:
+            print(f"No fresh FX rate for {missing} after {timeout} seconds, using the last known rates")
+
+    def warm_up(self, pairs, timeout=5.0):
+        '''Blocking version of warm_up_async.'''
+        self.ib.run(self.warm_up_async(pairs, timeout))
+
+    def refresh_in_background(self, pair):
+        with self.lock:
+            if pair in self.refreshing:
+                return
+            self.refreshing.add(pair)
+        threading.Thread(target=self.fetch_fallback_rate, args=(pair,), daemon=True).start()
+
+    def fetch_fallback_rate(self, pair):
+        '''Fallback if no live data: fetches the rate from yfinance and caches it.'''
+        currency, base_currency = pair
+        try:
+            rate = float(yf.Ticker(f"{base_currency}{currency}=X").info['ask'])
+            with self.lock:
+                # A tick that arrived in the meantime is more recent than the fallback quote
+                entry = self.fx_cache.get(pair)
+                if entry is None or time.time() - entry[1] > self.ttl:
+                    self.fx_cache[pair] = (rate, time.time())
+            return rate
+        except Exception as e:
+            print(f"Could not fetch fallback FX rate for {base_currency}{currency}: {e}")
+            return None
+        finally:
+            with self.lock:
+                self.refreshing.discard(pair)
+
+    def cancel(self):
+        '''Cancels all streaming subscriptions.'''
+        for ticker in self.tickers.values():
+            self.ib.cancelMktData(ticker.contract)
+        self.tickers = {}
 
     def convert_marketValue_to_base(self, df, base_currency):
         """Converts all market values in the DataFrame to the base currency."""
-        df['fx_rate'] = df['currency'].map(lambda x: self.get_fx_rate(x, base_currency))
+        currencies = df['currency'].unique()
+        self.subscribe([(currency, base_currency) for currency in currencies])  # all pairs start streaming at once
+        fx_rates = {currency: self.get_fx_rate(currency, base_currency, default=math.nan) for currency in currencies}
+        df['fx_rate'] = df['currency'].map(fx_rates).astype(float)
         df['marketValue_base'] = df['marketValue'] / df['fx_rate']
         return df
 
+class ExecutionIndex:
+    '''Persistent set of the IB execution ids (execId) of all trades processed into the portfolio.
+
+    Membership checks are constant-time set lookups. New ids are appended to a small ArcticDB symbol,
+    which is read once on start-up and compacted when it holds too many duplicate ids.'''
+    def __init__(self, library, symbol, history_symbol=None):
+        self.library = library
+        self.symbol = symbol
+        self.keys = set()
+
+        if self.library.has_symbol(self.symbol):
+            stored = self.library.read(self.symbol).data['key']
+            self.keys = set(stored)
+            if len(stored) > 2 * len(self.keys):
+                self.snapshot()
+        elif history_symbol and self.library.has_symbol(history_symbol):
+            # First start: seed the index with the executions of the trades already stored in the portfolio
+            try:
+                trades = self.library.read(history_symbol, columns=['trade']).data['trade'].astype(str)
+                # Matches the legacy str(trade) format (execId='...') as well as encode_trade ("execId": "...")
+                self.keys = set(trades.str.findall(r'''execId['"]?[=:] ?['"]([^'"]+)['"]''').explode().dropna())
+                self.snapshot()
+            except Exception as e:
+                print(f"Could not seed execution ids from {history_symbol}: {e}")
+
+    @staticmethod
+    def trade_keys(trade):
+        '''Returns the execution ids of a trade, or its permId if it has no fills yet.'''
+        keys = {fill.execution.execId for fill in trade.fills if fill.execution.execId}
+        return keys if keys else {f"permId:{trade.order.permId}"}
+
+    def is_duplicate(self, trade):
+        return self.trade_keys(trade) <= self.keys
+
+    def new_fills(self, trade):
+        '''The fills of a trade whose executions have not been processed yet.'''
+        return [fill for fill in trade.fills if fill.execution.execId not in self.keys]
+
+    def add(self, trade):
+        new_keys = self.trade_keys(trade) - self.keys
+        if not new_keys:
+            return
+        self.keys |= new_keys
+        try:
+            self.library.append(self.symbol, pd.DataFrame({'key': sorted(new_keys)}))
+        except Exception as e:
+            print(f"Error saving execution ids: {e}")
+
+    def snapshot(self):
+        '''Rewrites the stored index with one row per execution id.'''
+        self.library.write(self.symbol, pd.DataFrame({'key': sorted(self.keys)}), prune_previous_versions=True)
+
 def create_position_dict(portfoliomanager,item):
     return {'symbol': item.contract.symbol,
             'asset class': get_asset_class(item),
@@ -68,14 +229,19 @@ def create_position_dict(portfoliomanager,item):
             'realizedPNL': item.realizedPNL,
             'account': item.account,
             'marketValue_base': 0.0,
-            'fx_rate': portfoliomanager.fx_cache.get_fx_rate(item.contract.currency, portfoliomanager.base)}
+            'fx_rate': portfoliomanager.fx_cache.get_fx_rate(item.contract.currency, portfoliomanager.base, default=math.nan)}
 
-def create_trade_entry(portfoliomanager, strategy_symbol,trade):
+def create_trade_entry(portfoliomanager, strategy_symbol,trade, fills=None):
     '''Function to create a Dataframe from ib_insync's trade object
-        for further processing in our arcticDB.'''
-    fx_rate = portfoliomanager.fx_cache.get_fx_rate(trade.contract.currency,portfoliomanager.base)
-    cost = trade.orderStatus.avgFillPrice
-    qty =  trade.order.totalQuantity *(-1) if trade.order.action == 'SELL' else trade.order.totalQuantity 
+        for further processing in our arcticDB.
+        fills: the fills to book (e.g. only the new ones of a partially filled trade), the whole order if None.'''
+    fx_rate = portfoliomanager.fx_cache.fetch_fx_rate(trade.contract.currency,portfoliomanager.base, default=math.nan)
+    shares = sum(fill.execution.shares for fill in fills) if fills else 0
+    if shares:
+        cost = sum(fill.execution.shares * fill.execution.price for fill in fills) / shares
+    else:
+        shares, cost = trade.order.totalQuantity, trade.orderStatus.avgFillPrice
+    qty =  shares *(-1) if trade.order.action == 'SELL' else shares
     value = cost*qty
     value_base = value / fx_rate
     
@@ -89,9 +255,9 @@ def create_trade_entry(portfoliomanager, strategy_symbol,trade):
         'marketPrice': cost,
         'pnl %': 0.0, # to be calculated
         'strategy': strategy_symbol,
-        'contract': str(trade.contract),
-        'trade': str(trade),
-        'trade_context': str(trade),
+        'contract': cache_contract(trade.contract),
+        'trade': encode_trade(trade),
+        'trade_context': merge_trade_context('', encode_trade(trade)),
         'open_dt':datetime.date.today().isoformat(),
         'close_dt': '',
         'deleted': False,
@@ -111,6 +277,41 @@ def create_trade_entry(portfoliomanager, strategy_symbol,trade):
     return trade_df
 
 
+def encode_trade(trade):
+    '''Compact JSON representation of an ib_async trade, stored instead of str(trade).'''
+    return json.dumps({'permId': trade.order.permId,
+                       'orderId': trade.order.orderId,
+                       'conId': trade.contract.conId,
+                       'action': trade.order.action,
+                       'totalQuantity': trade.order.totalQuantity,
+                       'orderType': trade.order.orderType,
+                       'lmtPrice': trade.order.lmtPrice,
+                       'status': trade.orderStatus.status,
+                       'filled': trade.orderStatus.filled,
+                       'avgFillPrice': trade.orderStatus.avgFillPrice,
+                       'fills': [{'execId': fill.execution.execId,
+                                  'time': fill.execution.time,
+                                  'shares': fill.execution.shares,
+                                  'price': fill.execution.price,
+                                  'commission': fill.commissionReport.commission} for fill in trade.fills]}, default=str)
+
+def load_trade_context(trade_context):
+    '''Returns the trades of a stored trade_context as a list. Understands JSON and the legacy str() formats.'''
+    if not trade_context:
+        return []
+    try:
+        context = json.loads(trade_context)
+    except ValueError:
+        try:
+            context = ast.literal_eval(trade_context)  # legacy list of str(trade)
+        except (ValueError, SyntaxError):
+            context = trade_context  # legacy str(trade)
+    return context if isinstance(context, list) else [context]
+
+def merge_trade_context(trade_context, new_trade_context):
+    '''Appends the trades of new_trade_context to those of trade_context.'''
+    return json.dumps(load_trade_context(trade_context) + load_trade_context(new_trade_context), default=str)
+
 def get_asset_class(item):
     if item.contract.secType == "OPT":
         return "Call" if item.contract.right == "C" else "Put" + " " + str(item.contract.strike) + " " + item.contract.lastTradeDateOrContractMonth
@@ -157,12 +358,18 @@ def calculate_pnl(market_price, average_cost, position, contract=None):
     pnl_percent = pnl * (-1) if position < 0 else pnl
     return pnl_percent * 100
 
+def get_pnl_multiplier(contract):
+    '''Returns the multiplier calculate_pnl() applies to the average cost of a contract.'''
+    if isinstance(contract, Option):
+        return 100.0
+    elif isinstance(contract, Future):
+        return float(contract.multiplier)
+    return 1.0
+
 def detect_duplicate_trade(portfoliomanager,trade):
-    '''Function that checks for duplicate trades and returns True if one is found.'''
-    q = QueryBuilder()
-    q = q[(q['trade'] == str(trade))]
-    existing_trade = portfoliomanager.portfolio_library.read(f"{portfoliomanager.account_id}",query_builder=q).data
-
-    if not existing_trade.empty:
-        print(f"Duplicate trade detected: {str(trade)}")
-        return True
\ No newline at end of file
+    '''Function that checks for duplicate trades and returns True if one is found.
+    A trade is a duplicate if all of its executions have been processed before.'''
+    if portfoliomanager.execution_index.is_duplicate(trade):
+        print(f"Duplicate trade detected: {trade.contract.symbol} permId={trade.order.permId}")
+        return True
+    return False
\ No newline at end of file
@@ -0,0 +1,247 @@
+# ATS/broker/var.py
+# Value at Risk, Expected Shortfall and correlations of the portfolio. The daily returns of all underlyings
+# are kept as one cached Date x Symbol matrix (ReturnMatrix); the historical, filtered-historical and
+# parametric VaR/ES of a portfolio are then a few matrix operations over that matrix (portfolio_var), and
+# so are the covariance and correlation matrices (covariance, correlation).
+# Options enter either with their delta exposure or fully revalued with Black-Scholes in every scenario.
+
+import threading
+import numpy as np
+import pandas as pd
+
+from .pricing import bs_price, bs_delta, norm_pdf, norm_ppf
+
+TRADING_DAYS = 252
+EWMA_LAMBDA = 0.94  # RiskMetrics decay of the filtered historical simulation
+METHODS = ['historical', 'filtered_historical', 'parametric']
+
+def ewma_volatility(returns, initial, lam=EWMA_LAMBDA):
+    '''EWMA volatility of every column, sigma[t] estimated from the returns before t (T x N), and the
+    current volatility (after the last return).'''
+    sigma2 = np.empty_like(returns)
+    sigma2[0] = initial ** 2
+    for t in range(1, len(returns)):
+        sigma2[t] = lam * sigma2[t - 1] + (1 - lam) * returns[t - 1] ** 2
+    return np.sqrt(sigma2), np.sqrt(lam * sigma2[-1] + (1 - lam) * returns[-1] ** 2)
+
+class ReturnMatrix:
+    '''Daily returns of the symbols asked for so far, as one Date x Symbol matrix cached between calls.
+
+    Symbols are read from the 'us_equities' library (Close) and, if not found there, from
+    fetch_closes(symbols) -> {symbol: closes} (e.g. IB bars requested concurrently). Only symbols not yet in the matrix are loaded; the matrix is
+    rebuilt the next day. The covariance and filtered (EWMA rescaled) returns are computed once per matrix.'''
+
+    def __init__(self, stock_lib=None, years=5, fetch_closes=None):
+        self.stock_lib = stock_lib
+        self.years = years
+        self.fetch_closes = fetch_closes
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.returns = pd.DataFrame()
+        self.as_of = pd.Timestamp.today().normalize()
+        self.missing = set()
+        self.derived = None
+
+    def load_closes(self, symbols):
+        start = self.as_of - pd.DateOffset(years=self.years, days=7)
+        closes = {}
+        if self.stock_lib is not None:
+            from data_and_research.ohlcv import read_symbols
+            df = read_symbols(self.stock_lib, symbols, columns=['Close'], date_range=(start, None))
+            if not df.empty:
+                closes.update({symbol: frame['Close'] for symbol, frame in df.groupby('Symbol')})
+        missing = [symbol for symbol in symbols if symbol not in closes]
+        if missing and self.fetch_closes is not None:
+            try:
+                fetched = self.fetch_closes(missing)
+                closes.update({symbol: series[series.index >= start] for symbol, series in fetched.items() if series is not None and len(series)})
+            except Exception as e:
+                print(f"Error fetching the price history of {missing}: {e}")
+        return closes
+
+    def get(self, symbols):
+        '''Returns (the derived arrays of the matrix, the column of every symbol (-1 if unknown), the
+        symbols without price history).'''
+        with self.lock:
+            if pd.Timestamp.today().normalize() != self.as_of:
+                self.reset()
+            new = [symbol for symbol in dict.fromkeys(symbols) if symbol not in self.returns.columns and symbol not in self.missing]
+            if new:
+                closes = self.load_closes(new)
+                self.missing.update(symbol for symbol in new if symbol not in closes)
+                if closes:
+                    returns = pd.DataFrame(closes).sort_index().pct_change(fill_method=None)
+                    returns = pd.concat([self.returns, returns], axis=1).sort_index().dropna(how='all')
+                    self.returns = returns.iloc[-self.years * TRADING_DAYS:]
+                    self.derived = None
+            if self.derived is None:
+                self.derived = self.derive()
+            positions = self.returns.columns.get_indexer(list(symbols))
+            return self.derived, positions, [symbol for symbol, position in zip(symbols, positions) if position < 0]
+
+    def dense(self, symbols, days=None):
+        '''The last days returns of the symbols with history as a dense T x N array (0 where a symbol had
+        no return), and these symbols.'''
+        derived, positions, _ = self.get(symbols)
+        known = positions >= 0
+        returns = derived['returns'][:, positions[known]]
+        return returns[-days:] if days else returns, [symbol for symbol, ok in zip(symbols, known) if ok]
+
+    def derive(self):
+        '''Returns as array (NaN -> 0), filtered returns, current EWMA volatility and covariance.'''
+        returns = self.returns.to_numpy(dtype=float)
+        if returns.size == 0:
+            returns = np.zeros((0, self.returns.shape[1]))
+            return {'returns': returns, 'filtered': returns, 'sigma': np.zeros(returns.shape[1]), 'cov': np.zeros((returns.shape[1],) * 2)}
+        observed = ~np.isnan(returns)
+        long_run = np.nan_to_num(np.nanstd(returns, axis=0)) if observed.any() else np.zeros(returns.shape[1])
+        returns = np.where(observed, returns, 0.0)
+        sigma, sigma_now = ewma_volatility(returns, long_run)
+        # Floor: days without returns (holidays, before a listing) would shrink sigma towards 0
+        sigma = np.maximum(sigma, 0.1 * long_run)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            filtered = np.where(sigma > 0, returns / sigma * sigma_now, 0.0)
+        # Pairwise covariance over the days both symbols have returns
+        counts = observed.T.astype(float) @ observed
+        means = returns.sum(axis=0) / np.maximum(observed.sum(axis=0), 1)
+        centered = np.where(observed, returns - means, 0.0)
+        cov = (centered.T @ centered) / np.maximum(counts - 1, 1)
+        return {'returns': returns, 'filtered': filtered, 'sigma': sigma_now, 'cov': cov}
+
+def covariance(returns, shrinkage=None):
+    '''Covariance matrix of the T x N returns. shrinkage blends the sample covariance with the scaled
+    identity (average variance on the diagonal): an intensity in [0, 1], or 'ledoit_wolf' for the
+    intensity that minimizes the expected error (Ledoit & Wolf, 2004). Returns (covariance, intensity).'''
+    t, n = returns.shape
+    centered = returns - returns.mean(axis=0)
+    sample = centered.T @ centered / t
+    if not shrinkage or n == 0:
+        return sample * t / max(t - 1, 1), 0.0
+    mu = np.trace(sample) / n
+    target = mu * np.eye(n)
+    if shrinkage == 'ledoit_wolf':
+        d2 = np.sum((sample - target) ** 2)
+        b2 = (np.sum(np.sum(centered ** 2, axis=1) ** 2) - t * np.sum(sample ** 2)) / t ** 2
+        intensity = float(min(max(b2, 0.0), d2) / d2) if d2 > 0 else 1.0
+    else:
+        intensity = float(shrinkage)
+    return intensity * target + (1 - intensity) * sample, intensity
+
+def correlation(cov):
+    std = np.sqrt(np.diag(cov))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        corr = cov / np.outer(std, std)
+    np.fill_diagonal(corr, 1.0)
+    return corr
+
+def tail_measures(pnl, confidence):
+    '''VaR and ES (positive = loss) of the scenario P&L in the rows of pnl (methods x scenarios).'''
+    if pnl.shape[1] == 0:
+        return np.full(len(pnl), np.nan), np.full(len(pnl), np.nan)
+    ordered = np.sort(pnl, axis=1)
+    tail = max(int(np.floor((1 - confidence) * pnl.shape[1])), 1)
+    return -ordered[:, tail - 1], -ordered[:, :tail].mean(axis=1)
+
+def option_columns(positions):
+    '''Option rows and their fields as arrays.'''
+    is_option = positions['right'].isin(['C', 'P']).to_numpy() if 'right' in positions.columns else np.zeros(len(positions), dtype=bool)
+    options = positions[is_option]
+    fields = {name: options[name].to_numpy(dtype=float) for name in ('underlying_price', 'strike', 'years', 'iv')} if len(options) else {}
+    if len(options):
+        fields['is_call'] = (options['right'] == 'C').to_numpy()
+    return is_option, fields
+
+def portfolio_var(positions, return_matrix, confidence=0.95, horizon=1, option_mode='delta', rate=0.0):
+    '''VaR and ES of positions over horizon days by historical simulation, filtered historical simulation
+    (returns rescaled to the current EWMA volatility) and the parametric (delta-normal) method.
+
+    positions: one row per position with symbol (the underlying for options), quantity, multiplier, price
+    and optionally fx (base currency per unit of the position's currency); option rows also have right ('C'/'P'), strike, years (to expiry), iv and
+    underlying_price. option_mode 'delta' maps options to their delta exposure, 'full' reprices them
+    with Black-Scholes in every scenario (the parametric method always uses deltas).
+    Returns (DataFrame of VaR and ES per method, symbols without price history).'''
+    symbols = positions['symbol'].tolist()
+    derived, columns, missing = return_matrix.get(symbols)
+    known = columns >= 0
+    quantity = positions['quantity'].to_numpy(dtype=float) * positions['multiplier'].to_numpy(dtype=float)
+    if 'fx' in positions.columns:
+        quantity = quantity * positions['fx'].to_numpy(dtype=float)
+    is_option, option = option_columns(positions)
+
+    # Dollar exposure of every position to a 1.0 return of its underlying (options: delta exposure)
+    exposure = quantity * positions['price'].to_numpy(dtype=float)
+    if is_option.any():
+        delta = bs_delta(option['underlying_price'], option['strike'], option['years'], option['iv'], option['is_call'], rate)
+        exposure[is_option] = quantity[is_option] * delta * option['underlying_price']
+    exposure = np.where(known, np.nan_to_num(exposure), 0.0)
+    revalued = known & is_option & (option_mode == 'full')
+
+    n = derived['returns'].shape[1]
+    weights, delta_weights = np.zeros(n), np.zeros(n)
+    np.add.at(weights, columns[known & ~revalued], exposure[known & ~revalued])
+    np.add.at(delta_weights, columns[known], exposure[known])
+
+    scale = np.sqrt(horizon)
+    scenarios = np.stack([derived['returns'], derived['filtered']]) * scale   # 2 x T x N
+    pnl = scenarios @ weights                                                  # 2 x T
+
+    if revalued.any():
+        selected = revalued[is_option]
+        spot, strike = option['underlying_price'][selected], option['strike'][selected]
+        years, iv, is_call = option['years'][selected], option['iv'][selected], option['is_call'][selected]
+        price_now = bs_price(spot, strike, years, iv, is_call, rate)
+        shocked = spot * (1 + scenarios[:, :, columns[revalued]])             # 2 x T x options
+        price_then = bs_price(shocked, strike, np.maximum(years - horizon / TRADING_DAYS, 0.0), iv, is_call, rate)
+        pnl += np.nan_to_num((price_then - price_now) * quantity[revalued]).sum(axis=2)
+
+    var, es = tail_measures(pnl, confidence)
+    sigma = np.sqrt(max(delta_weights @ derived['cov'] @ delta_weights, 0.0)) * scale
+    z = norm_ppf(confidence)
+
+    result = pd.DataFrame({'VaR': np.append(var, z * sigma), 'ES': np.append(es, sigma * norm_pdf(z) / (1 - confidence))}, index=METHODS)
+    result.index.name = 'method'
+    return result, missing
+
+def benchmark(n_positions=300, n_options=60, years=5, runs=10):
+    '''Times portfolio_var for n_positions stocks (plus options on some of them) over years of synthetic
+    daily closes: the first call builds the return matrix, later calls reuse it.'''
+    import time
+    rng = np.random.default_rng(0)
+    dates = pd.bdate_range(end=pd.Timestamp.today().normalize(), periods=years * TRADING_DAYS + 1)
+    symbols = [f'S{i:03d}' for i in range(n_positions)]
+    factor = rng.normal(0, 0.01, len(dates))
+    closes = {symbol: pd.Series(100 * np.exp(np.cumsum(factor * rng.uniform(0.5, 1.5) + rng.normal(0, 0.015, len(dates)))), index=dates)
+              for symbol in symbols}
+
+    positions = pd.DataFrame({'symbol': symbols, 'quantity': rng.integers(-500, 1000, n_positions), 'multiplier': 1.0,
+                              'price': [closes[symbol].iloc[-1] for symbol in symbols]})
+    underlyings = rng.choice(symbols, n_options)
+    spot = np.array([closes[symbol].iloc[-1] for symbol in underlyings])
+    options = pd.DataFrame({'symbol': underlyings, 'quantity': rng.integers(-20, 20, n_options), 'multiplier': 100.0,
+                            'right': rng.choice(['C', 'P'], n_options), 'strike': np.round(spot * rng.uniform(0.8, 1.2, n_options)),
+                            'years': rng.uniform(0.02, 1.0, n_options), 'iv': rng.uniform(0.15, 0.6, n_options), 'underlying_price': spot})
+    options['price'] = bs_price(spot, options['strike'], options['years'], options['iv'], options['right'] == 'C')
+    positions = pd.concat([positions, options], ignore_index=True)
+
+    return_matrix = ReturnMatrix(fetch_closes=lambda symbols: {symbol: closes[symbol] for symbol in symbols if symbol in closes}, years=years)
+    start = time.perf_counter()
+    result, _ = portfolio_var(positions, return_matrix)
+    print(f"{len(positions)} positions, {years} years: first call (builds the return matrix) {time.perf_counter() - start:.3f} s")
+    for mode in ('delta', 'full'):
+        start = time.perf_counter()
+        for _ in range(runs):
+            result, _ = portfolio_var(positions, return_matrix, option_mode=mode)
+        print(f"  option_mode={mode}: {(time.perf_counter() - start) / runs * 1000:.1f} ms per call")
+        print(result.round(0).to_string())
+
+    start = time.perf_counter()
+    for _ in range(runs):
+        returns, known = return_matrix.dense(symbols, days=TRADING_DAYS)
+        cov, intensity = covariance(returns, 'ledoit_wolf')
+        corr = correlation(cov)
+    print(f"{len(known)}x{len(known)} Ledoit-Wolf covariance and correlation over 1 year: {(time.perf_counter() - start) / runs * 1000:.1f} ms per call (intensity {intensity:.3f})")
+
+if __name__ == "__main__":
+    benchmark()
@@ -0,0 +1,293 @@
+# ATS/data_and_research/indicators.py
+# Indicator engine of the US equity data job. All symbols are processed at once on contiguous
+# per-symbol arrays (segments) obtained from one stable sort by Symbol. Every column matches the
+# former groupby/pandas_ta/TA-Lib implementation bit for bit:
+#  - recursive indicators (EMA, ATR) call TA-Lib per symbol array when it is installed; otherwise (and to
+#    continue stored values) the kernels below reproduce TA-Lib's summation order and classic arithmetic,
+#  - rolling windows run through pandas' own kernels with the window bounds of a groupby-rolling,
+#  - the channels keep the shift(1) of the former implementation, which runs over the whole frame.
+
+import time
+import numpy as np
+import pandas as pd
+from pandas.api.indexers import BaseIndexer
+
+try:
+    from numba import njit
+    NUMBA = True
+except ImportError:
+    NUMBA = False
+
+try:
+    import talib
+except ImportError:
+    talib = None
+
+EMA_LENGTHS = {'20D_EMA': 20, '50D_EMA': 50, '200D_EMA': 200}
+ATR_PERIOD = 20
+WINDOW = 20
+RETURN_PERIODS = {'1M': 21, '3M': 63, '6M': 126, '12M': 252}
+
+class Segments:
+    '''Row ranges [starts[i], ends[i]) of the symbols in an array sorted by Symbol.'''
+    def __init__(self, symbols):
+        n = len(symbols)
+        boundaries = np.flatnonzero(symbols[1:] != symbols[:-1]) + 1 if n else np.array([], dtype=np.int64)
+        self.starts = np.r_[0, boundaries].astype(np.int64) if n else np.array([], dtype=np.int64)
+        self.ends = np.r_[boundaries, n].astype(np.int64) if n else np.array([], dtype=np.int64)
+        self.lengths = self.ends - self.starts
+        self.ids = np.repeat(np.arange(len(self.starts)), self.lengths)
+        self.row_starts = self.starts[self.ids]
+        self.n = n
+
+class SegmentWindowIndexer(BaseIndexer):
+    '''Fixed-size trailing windows that don't cross segment boundaries, as in groupby().rolling(window).'''
+    def __init__(self, segments, window_size):
+        super().__init__(window_size=window_size)
+        self.segments = segments
+
+    def get_window_bounds(self, num_values=0, min_periods=None, center=None, closed=None, step=None):
+        end = np.arange(1, num_values + 1, dtype=np.int64)
+        start = np.maximum(end - self.window_size, self.segments.row_starts)
+        return start, end
+
+def rolling(values, segments, window, how):
+    '''Rolling mean/std/max/min per segment with pandas' kernels (min_periods = window).'''
+    return getattr(pd.Series(values).rolling(SegmentWindowIndexer(segments, window), min_periods=window), how)().to_numpy()
+
+def shift(values, segments, periods):
+    '''Shift within each segment.'''
+    result = np.full(len(values), np.nan)
+    rows = np.arange(periods, len(values))
+    valid = rows - periods >= segments.row_starts[rows]
+    result[rows[valid]] = values[rows[valid] - periods]
+    return result
+
+def ffill(values, segments):
+    '''Forward fill within each segment.'''
+    rows = np.where(np.isnan(values), -1, np.arange(len(values)))
+    rows = np.maximum.accumulate(rows) if len(rows) else rows
+    result = np.full(len(values), np.nan)
+    valid = rows >= segments.row_starts
+    result[valid] = values[rows[valid]]
+    return result
+
+def pct_change(values, segments, periods):
+    '''groupby().pct_change(periods): forward filled values over the values periods rows earlier, minus 1.'''
+    filled = ffill(values, segments)
+    return (filled / shift(filled, segments, periods)) - 1
+
+def rank_pct(values, groups):
+    '''Percentile rank (method 'average', NaN kept) of values within each group, as groupby(groups).rank(pct=True).'''
+    order = np.lexsort((values, groups))
+    v, g = values[order], groups[order]
+    n = len(v)
+    result = np.full(n, np.nan)
+    if n == 0:
+        return result
+
+    new_group = np.r_[True, g[1:] != g[:-1]]
+    group_start = np.flatnonzero(new_group)
+    group_id = np.cumsum(new_group) - 1
+    position = np.arange(n) - group_start[group_id]
+    valid = ~np.isnan(v)
+    count = np.bincount(group_id, weights=valid, minlength=len(group_start))
+
+    # Ties share the average of their ranks
+    new_tie = new_group | np.r_[True, v[1:] != v[:-1]]
+    tie_id = np.cumsum(new_tie) - 1
+    tie_first = position[np.flatnonzero(new_tie)]
+    tie_last = np.r_[np.flatnonzero(new_tie)[1:], n] - 1
+    tie_last = position[tie_last]
+    average = ((tie_first[tie_id] + 1) + (tie_last[tie_id] + 1)) / 2
+
+    result[order[valid]] = average[valid] / count[group_id[valid]]
+    return result
+
+########################### RECURSIVE KERNELS ###########################
+
+def first_valid(valid, segments):
+    '''Row of the first valid value of each segment (its end if there is none).'''
+    rows = np.where(valid, np.arange(segments.n), segments.n)
+    return np.minimum.reduceat(rows, segments.starts) if segments.n else rows
+
+def ema(values, segments, length, initial=None):
+    '''TA-Lib EMA per segment: the SMA of the first `length` values (from the first non-NaN value on)
+    seeds the recursion prev = ((x - prev) * k) + prev with k = 2 / (length + 1).
+    initial: optional EMA value before each segment's first row to continue from instead of seeding.'''
+    if initial is None and talib is not None:
+        return _per_segment(talib.EMA, segments, values, timeperiod=length)
+
+    k = 2.0 / (length + 1)
+    result = np.full(segments.n, np.nan)
+    begin = first_valid(~np.isnan(values), segments)
+    if initial is None:
+        seed_rows = begin + length - 1
+        seeded = seed_rows < segments.ends
+        previous = _sequential_sum(values, begin, length, seeded) / length
+        result[seed_rows[seeded]] = previous[seeded]
+        start = seed_rows + 1
+    else:
+        seeded = ~np.isnan(initial)
+        previous = np.asarray(initial, dtype=float).copy()
+        start = segments.starts.copy()
+    _recurse_ema(values, result, start[seeded], segments.ends[seeded], previous[seeded], k)
+    return result
+
+def atr(high, low, close, segments, period, initial=None, initial_close=None):
+    '''TA-Lib ATR (Wilder) per segment: the mean of the first `period` true ranges seeds the
+    recursion prev = ((prev * (period - 1)) + tr) / period.
+    initial/initial_close: optional ATR and close before each segment's first row to continue from.'''
+    n = segments.n
+    if initial is None and talib is not None:
+        return _per_segment(talib.ATR, segments, high, low, close, timeperiod=period)
+
+    result = np.full(n, np.nan)
+    previous_close = shift(close, segments, 1)
+    if initial_close is not None:
+        previous_close[segments.starts] = initial_close
+    # TA-Lib's TRANGE: the greatest of the three, NaN comparisons are False
+    true_range = high - low
+    for candidate in (np.abs(previous_close - high), np.abs(previous_close - low)):
+        true_range = np.where(candidate > true_range, candidate, true_range)
+
+    if initial is None:
+        begin = first_valid(~(np.isnan(high) | np.isnan(low) | np.isnan(close)), segments)
+        seed_rows = begin + period
+        seeded = seed_rows < segments.ends
+        previous = _sequential_sum(true_range, begin + 1, period, seeded) / period
+        result[seed_rows[seeded]] = previous[seeded]
+        start = seed_rows + 1
+    else:
+        seeded = ~np.isnan(initial)
+        previous = np.asarray(initial, dtype=float).copy()
+        start = segments.starts.copy()
+    _recurse_atr(true_range, result, start[seeded], segments.ends[seeded], previous[seeded], float(period))
+    return result
+
+def _per_segment(function, segments, *arrays, **kwargs):
+    '''Calls a TA-Lib function on every segment. Recent TA-Lib builds select FMA variants of the
+    EMA/ATR recursions at runtime, whose rounding the kernels below can't reproduce portably; with
+    TA-Lib installed, full computations therefore go through TA-Lib itself.'''
+    result = np.full(segments.n, np.nan)
+    for start, end in zip(segments.starts, segments.ends):
+        result[start:end] = function(*[values[start:end] for values in arrays], **kwargs)
+    return result
+
+def _sequential_sum(values, begin, length, mask):
+    '''Left-to-right sum of values[begin:begin+length] per segment (TA-Lib's summation order).'''
+    total = np.zeros(len(begin))
+    rows = begin[mask]
+    partial = np.zeros(len(rows))
+    for i in range(length):
+        partial = partial + values[rows + i]
+    total[mask] = partial
+    return total
+
+if NUMBA:
+    @njit(cache=True)
+    def _recurse_ema(values, result, starts, ends, previous, k):
+        for s in range(len(starts)):
+            prev = previous[s]
+            for i in range(starts[s], ends[s]):
+                prev = ((values[i] - prev) * k) + prev
+                result[i] = prev
+
+    @njit(cache=True)
+    def _recurse_atr(true_range, result, starts, ends, previous, period):
+        for s in range(len(starts)):
+            prev = previous[s]
+            for i in range(starts[s], ends[s]):
+                prev = ((prev * (period - 1)) + true_range[i]) / period
+                result[i] = prev
+else:
+    def _recurse_ema(values, result, starts, ends, previous, k):
+        # Steps through all segments at once: in step t every segment longer than t advances one row
+        _step(lambda prev, rows: ((values[rows] - prev) * k) + prev, result, starts, ends, previous)
+
+    def _recurse_atr(true_range, result, starts, ends, previous, period):
+        _step(lambda prev, rows: ((prev * (period - 1)) + true_range[rows]) / period, result, starts, ends, previous)
+
+def _step(update, result, starts, ends, previous):
+    lengths = ends - starts
+    order = np.argsort(-lengths, kind='stable')
+    starts, lengths, prev = starts[order], lengths[order], previous[order].copy()
+    active = len(order)
+    for t in range(lengths.max() if len(lengths) else 0):
+        while active and lengths[active - 1] <= t:
+            active -= 1
+        rows = starts[:active] + t
+        prev[:active] = update(prev[:active], rows)
+        result[rows] = prev[:active]
+
+########################### ENGINE ###########################
+
+def compute_indicators(df):
+    '''Computes all indicator columns of the US equity data job in one pass and returns df with them.
+    df needs Symbol, High, Low and Close columns and a Date index; like before, the channels' shift(1)
+    refers to the previous row of the frame, so df should be sorted by Symbol (and Date within a symbol).'''
+    order = np.argsort(df['Symbol'].to_numpy(), kind='stable')
+    segments = Segments(df['Symbol'].to_numpy()[order])
+    high = df['High'].to_numpy(dtype=float)[order]
+    low = df['Low'].to_numpy(dtype=float)[order]
+    close = df['Close'].to_numpy(dtype=float)[order]
+    dates = df.index.to_numpy()[order].astype('int64')
+
+    columns = {}
+    for column, periods in RETURN_PERIODS.items():
+        columns[column] = pct_change(close, segments, periods)
+    columns['RS IBD'] = 2*columns['3M']+columns['6M']+columns['12M'] # IBD Relative Strength =  2x 3M + 1x 6M + 1x 12M
+    columns['RS Rank'] = rank_pct(columns['RS IBD'], dates)
+    columns['RS Rank 20D MA'] = rolling(columns['RS Rank'], segments, WINDOW, 'mean')
+
+    for column, length in EMA_LENGTHS.items():
+        columns[column] = ema(close, segments, length)
+    columns['ATR'] = atr(high, low, close, segments, ATR_PERIOD)
+    columns['STD'] = rolling(close, segments, WINDOW, 'std')
+
+    columns['KC_Upper'] = global_shift(columns['20D_EMA'] + (columns['ATR'] * 1.5))  # Upper Keltner Channel
+    columns['KC_Lower'] = global_shift(columns['20D_EMA'] - (columns['ATR'] * 1.5))  # Lower Keltner Channel
+    columns['DC_Upper'] = global_shift(rolling(high, segments, WINDOW, 'max'))  # Upper Donchian Channel
+    columns['DC_Lower'] = global_shift(rolling(low, segments, WINDOW, 'min'))  # Lower Donchian Channel
+    columns['BB_Upper'] = global_shift(columns['20D_EMA'] + (columns['STD'] * 2))  # Upper Bollinger Band
+    columns['BB_Lower'] = global_shift(columns['20D_EMA'] - (columns['STD'] * 2))  # Lower Bollinger Band
+
+    # Daily Returns for later aggregation & comparing among sectors
+    columns['1d'] = pct_change(close, segments, 1)
+
+    # Back to the row order of df
+    inverse = np.empty_like(order)
+    inverse[order] = np.arange(len(order))
+    for column, values in columns.items():
+        df[column] = values[inverse]
+    return df
+
+def global_shift(values):
+    '''shift(1) over the whole array, crossing segment boundaries like the former implementation.'''
+    result = np.empty(len(values))
+    if len(values):
+        result[0] = np.nan
+        result[1:] = values[:-1]
+    return result
+
+def benchmark(n_symbols=6000, n_days=2520, seed=0):
+    '''Times compute_indicators on a synthetic universe (default: ~6000 US stocks x 10 years).'''
+    rng = np.random.default_rng(seed)
+    lengths = rng.integers(n_days // 10, n_days + 1, size=n_symbols)
+    dates = pd.bdate_range(end=pd.Timestamp.today().normalize(), periods=n_days)
+    frames = []
+    for i, length in enumerate(lengths):
+        close = 100 * np.exp(np.cumsum(rng.normal(0, 0.02, length)))
+        frames.append(pd.DataFrame({'Symbol': f'S{i:05d}', 'High': close * 1.01, 'Low': close * 0.99, 'Close': close},
+                                   index=pd.DatetimeIndex(dates[-length:], name='Date')))
+    df = pd.concat(frames)
+
+    start = time.perf_counter()
+    compute_indicators(df)
+    elapsed = time.perf_counter() - start
+    print(f"compute_indicators: {n_symbols} symbols, {len(df):,} rows | {elapsed:.2f} s "
+          f"({'TA-Lib' if talib is not None else 'numba' if NUMBA else 'numpy'} EMA/ATR)")
+    return elapsed
+
+if __name__ == "__main__":
+    benchmark()
@@ -0,0 +1,43 @@
+# ATS/data_and_research/jobs/3_compact_portfolio.py
+# This script compacts the account symbols of the 'portfolio' library: it rebuilds the position snapshot
+# of every account from its history, prunes old versions and defragments the append-only delta log.
+
+import argparse
+import pandas as pd
+
+from data_and_research import ac
+from broker.positionbook import latest_positions
+
+SUFFIXES = ('_snapshot', '_executions')
+
+def compact_account(library, account_id):
+    history = library.read(account_id).data
+    if history.empty:
+        print(f"{account_id}: no history, skipped")
+        return
+
+    snapshot = latest_positions(history)
+    snapshot = snapshot[snapshot['position'] != 0]
+    as_of = pd.Timestamp(history.index.max())
+    library.write(f"{account_id}_snapshot", snapshot, metadata={'as_of': as_of.isoformat()}, prune_previous_versions=True)
+
+    library.prune_previous_versions(account_id)
+    if library.is_symbol_fragmented(account_id):
+        library.defragment_symbol_data(account_id)
+    print(f"{account_id}: {len(history)} history rows -> {len(snapshot)} positions in snapshot (as of {as_of})")
+
+def main():
+    parser = argparse.ArgumentParser(description="Compact the account symbols of the 'portfolio' library.")
+    parser.add_argument('accounts', nargs='*', help="Account ids to compact (default: all accounts)")
+    args = parser.parse_args()
+
+    library = ac.get_library('portfolio')
+    accounts = args.accounts or [symbol for symbol in library.list_symbols() if not symbol.endswith(SUFFIXES)]
+    for account_id in accounts:
+        try:
+            compact_account(library, account_id)
+        except Exception as e:
+            print(f"Error compacting {account_id}: {e}")
+
+if __name__ == "__main__":
+    main()
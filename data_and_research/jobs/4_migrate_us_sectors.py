@@ -0,0 +1,61 @@
+# ATS/data_and_research/jobs/4_migrate_us_sectors.py
+# This script migrates a database to the single-source layout of the US equity data: every row of the sector
+# frames ('us_sectors') must be stored per symbol ('us_equities'), after which the sector frames are deleted.
+# Sector views are read from the per-symbol data with data_and_research.ohlcv.read_sector.
+
+import argparse
+import pandas as pd
+
+from data_and_research import ac
+from data_and_research.ohlcv import iter_payloads, write_in_chunks
+
+def migrate_sector(sector_lib, stock_lib, sector, stored_symbols, dry_run=False):
+    '''Writes the symbols of a sector frame that are missing or shorter in the per-symbol library.
+    Returns the number of symbols written.'''
+    df = sector_lib.read(sector).data
+    if df.empty:
+        return 0
+    df = df.sort_values(by='Symbol', axis='index', kind='stable')
+    symbols = df['Symbol'].unique().tolist()
+
+    lengths = {symbol: 0 for symbol in symbols}
+    stored = [symbol for symbol in symbols if symbol in stored_symbols]
+    for symbol, description in zip(stored, stock_lib.get_description_batch(stored)):
+        if hasattr(description, 'row_count'):
+            lengths[symbol] = description.row_count
+
+    counts = df.groupby('Symbol', sort=False).size()
+    missing = set(counts[counts > pd.Series(lengths)].index)
+    if missing and not dry_run:
+        write_in_chunks(stock_lib.write_batch, iter_payloads(df[df['Symbol'].isin(missing)]), prune_previous_versions=True)
+    return len(missing)
+
+def main():
+    parser = argparse.ArgumentParser(description="Migrate the 'us_sectors' frames into the per-symbol 'us_equities' library.")
+    parser.add_argument('--dry-run', action='store_true', help="Only report what would be written")
+    parser.add_argument('--keep', action='store_true', help="Keep the 'us_sectors' library after the migration")
+    args = parser.parse_args()
+
+    if 'us_sectors' not in ac.list_libraries():
+        print("No 'us_sectors' library, nothing to migrate")
+        return
+    sector_lib = ac.get_library('us_sectors')
+    stock_lib = ac.get_library('us_equities', create_if_missing=True)
+    stored_symbols = set(stock_lib.list_symbols())
+
+    failed = False
+    for sector in sector_lib.list_symbols():
+        try:
+            written = migrate_sector(sector_lib, stock_lib, sector, stored_symbols, dry_run=args.dry_run)
+            print(f"{sector}: {written} symbols {'to write' if args.dry_run else 'written'} to 'us_equities'")
+        except Exception as e:
+            failed = True
+            print(f"Error migrating {sector}: {e}")
+
+    if failed or args.dry_run or args.keep:
+        return
+    ac.delete_library('us_sectors')
+    print("Deleted the 'us_sectors' library")
+
+if __name__ == "__main__":
+    main()
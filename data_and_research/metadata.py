@@ -0,0 +1,143 @@
+# ATS/data_and_research/metadata.py
+# Symbol metadata (sector, market cap, name): the universe table (univ/us_equities) indexed by Symbol, plus
+# a persistent cache (univ/symbol_metadata) of what yfinance or IB returned for symbols outside the
+# universe. Lookups are dictionary/index operations; map_sectors() resolves many symbols with one join.
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import pandas as pd
+
+from data_and_research.utils import CachedTable, ac
+
+UNIVERSE_LIBRARY = 'univ'
+UNIVERSE_SYMBOL = 'us_equities'
+CACHE_SYMBOL = 'symbol_metadata'
+COLUMNS = ['Sector', 'Market Cap', 'Name']
+RETRY_DAYS = 30  # symbols no source knew are looked up again after this many days
+
+def index_by_symbol(df):
+    '''The metadata columns indexed by Symbol (first row per symbol), Sector as categorical.'''
+    if df is None or df.empty or 'Symbol' not in df.columns and df.index.name != 'Symbol':
+        return pd.DataFrame(columns=COLUMNS, index=pd.Index([], name='Symbol'))
+    if df.index.name != 'Symbol':
+        df = df.set_index('Symbol')
+    df = df[~df.index.duplicated()].reindex(columns=COLUMNS)
+    df['Sector'] = df['Sector'].astype('category')
+    df['Market Cap'] = pd.to_numeric(df['Market Cap'], errors='coerce')
+    return df
+
+def yfinance_metadata(symbol):
+    '''(sector, market cap, name) from yfinance; ETFs and funds report their category as sector.'''
+    import yfinance as yf
+    info = yf.Ticker(symbol).info
+    sector = info.get('sector') or info.get('category')
+    return sector, info.get('marketCap'), info.get('longName') or info.get('shortName')
+
+class SymbolMetadata:
+    '''Sector, market cap and name per symbol from the universe table and the fallback cache.
+
+    Both tables are kept in memory (CachedTable, reloaded when their ArcticDB version changes). Symbols that
+    are in neither are resolved with resolver(symbol) -> (sector, market cap, name), yfinance by default,
+    concurrently, and the results are written to the cache in one batch.'''
+
+    def __init__(self, arctic=None, resolver=yfinance_metadata, max_workers=8):
+        self.arctic = arctic if arctic else ac
+        self.resolver = resolver
+        self.max_workers = max_workers
+        self.universe = CachedTable(UNIVERSE_SYMBOL, index_by_symbol, library=UNIVERSE_LIBRARY, check_interval=60.0, arctic=self.arctic)
+        self.cache = CachedTable(CACHE_SYMBOL, library=UNIVERSE_LIBRARY, check_interval=60.0, arctic=self.arctic)
+        self.combined = (None, None, None)  # (universe table, cache table, combined table)
+        self.lock = threading.Lock()
+
+    def table(self):
+        '''Universe rows first, then the cached fallback rows of symbols outside the universe.'''
+        universe, cache = self.universe.get(), self.cache.get()
+        if self.combined[0] is universe and self.combined[1] is cache:
+            return self.combined[2]
+        table = universe if universe is not None else index_by_symbol(None)
+        if cache is not None and not cache.empty:
+            # Symbols no source knew are left out, resolve() decides when to look them up again
+            extra = cache[~cache.index.isin(table.index) & cache['Sector'].notna()].reindex(columns=COLUMNS)
+            if not extra.empty:
+                table = pd.concat([table.astype({'Sector': object}), extra])
+                table['Sector'] = table['Sector'].astype('category')
+        self.combined = (universe, cache, table)
+        return table
+
+    def lookup(self, symbol, resolve=True):
+        '''Metadata of one symbol as dict (None if unknown).'''
+        table = self.table()
+        if symbol not in table.index and resolve:
+            self.resolve([symbol])
+            table = self.table()
+        if symbol not in table.index:
+            return None
+        return table.loc[symbol].to_dict()
+
+    def sector(self, symbol, resolve=True):
+        metadata = self.lookup(symbol, resolve)
+        sector = metadata['Sector'] if metadata else None
+        return sector if isinstance(sector, str) else None
+
+    def map_metadata(self, symbols, columns=COLUMNS, resolve=False):
+        '''Metadata of many symbols in one join, aligned with symbols (NaN where unknown).'''
+        symbols = pd.Index(symbols)
+        if resolve:
+            missing = symbols.difference(self.table().index)
+            if len(missing):
+                self.resolve(missing.tolist())
+        return self.table().reindex(symbols)[list(columns)]
+
+    def map_sectors(self, symbols, resolve=False):
+        '''Sectors of many symbols as a Series aligned with symbols.'''
+        sectors = self.map_metadata(symbols, ['Sector'], resolve)['Sector']
+        index = symbols.index if isinstance(symbols, pd.Series) else None
+        return pd.Series(sectors.to_numpy(), index=index, name='Sector')
+
+    def resolve(self, symbols):
+        '''Looks up the symbols with the resolver (concurrently) and caches the results, also the misses.'''
+        with self.lock:
+            cache = self.cache.get()
+            cache = cache if cache is not None else pd.DataFrame(columns=COLUMNS + ['Updated'], index=pd.Index([], name='Symbol'))
+            retry_before = pd.Timestamp.now() - pd.Timedelta(days=RETRY_DAYS)
+            known = cache.index[cache['Sector'].notna() | (pd.to_datetime(cache['Updated']) > retry_before)]
+            symbols = [symbol for symbol in dict.fromkeys(symbols) if symbol not in known]
+            if not symbols:
+                return
+
+            def resolve_one(symbol):
+                try:
+                    return self.resolver(symbol)
+                except Exception as e:
+                    print(f"Error retrieving metadata of {symbol}: {e}")
+                    return None, None, None
+
+            with ThreadPoolExecutor(max_workers=min(self.max_workers, len(symbols))) as executor:
+                results = list(executor.map(resolve_one, symbols))
+            self.store({symbol: result for symbol, result in zip(symbols, results)}, cache)
+
+    def add(self, symbol, sector, market_cap=None, name=None):
+        '''Caches metadata found elsewhere (e.g. IB fundamentals).'''
+        with self.lock:
+            self.store({symbol: (sector, market_cap, name)}, self.cache.get())
+
+    def store(self, results, cache):
+        rows = pd.DataFrame([(symbol, *result) for symbol, result in results.items()], columns=['Symbol'] + COLUMNS).set_index('Symbol')
+        rows['Market Cap'] = pd.to_numeric(rows['Market Cap'], errors='coerce')
+        rows['Updated'] = pd.Timestamp.now()
+        if cache is not None and not cache.empty:
+            rows = pd.concat([cache[~cache.index.isin(rows.index)], rows])
+        rows = rows.astype({'Sector': object, 'Name': object})
+        self.arctic.get_library(UNIVERSE_LIBRARY, create_if_missing=True).write(CACHE_SYMBOL, rows, prune_previous_versions=True)
+        self.cache.invalidate()
+
+_symbol_metadata = None
+_metadata_lock = threading.Lock()
+
+def get_symbol_metadata():
+    '''Returns the symbol metadata service of the process.'''
+    global _symbol_metadata
+    with _metadata_lock:
+        if _symbol_metadata is None:
+            _symbol_metadata = SymbolMetadata()
+    return _symbol_metadata
@@ -0,0 +1,401 @@
+# ATS/data_and_research/ohlcv.py
+# Daily OHLCV data of the US equity universe and its technical indicators, stored per symbol ('us_equities').
+# update_sector() only downloads and computes the bars that are missing; update_sectors() runs the fetch,
+# compute and write stages of many sectors as a pipeline. Sector and cross-sectional views are read from
+# the per-symbol data (read_symbols, read_sector, read_cross_section); the legacy sector frames
+# ('us_sectors') are only maintained if a sector library is passed.
+
+import datetime, os, queue, threading, time
+import multiprocessing
+from itertools import islice
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+import numpy as np
+import pandas as pd
+import yfinance as yf
+import arcticdb as adb
+
+from data_and_research import indicators
+from data_and_research.indicators import EMA_LENGTHS, ATR_PERIOD
+
+LOOKBACK = 300     # stored rows per symbol needed to continue every indicator (12M return = 252 rows)
+OVERLAP_DAYS = 7   # calendar days re-downloaded before the last stored bar to detect adjusted prices
+STALE_DAYS = 30    # symbols whose last bar is older than this (vs. the sector) are reloaded in full
+CHUNK_SIZE = 100   # symbols per download and per batch of reloaded symbols
+
+# Columns that scale with the price level when yfinance re-adjusts the history (dividends, splits)
+PRICE_COLUMNS = ['Open', 'High', 'Low', 'Close', '20D_EMA', '50D_EMA', '200D_EMA', 'ATR', 'STD',
+                 'KC_Upper', 'KC_Lower', 'DC_Upper', 'DC_Lower', 'BB_Upper', 'BB_Lower']
+# Columns that scale with the inverse of the price level after a split (dividends leave them unchanged)
+VOLUME_COLUMNS = ['Volume']
+
+def download(symbols, start=None, chunk_size=CHUNK_SIZE):
+    '''Downloads daily bars from yfinance, the full history if start is None.
+    Returns a long frame indexed by Date with a Symbol column, sorted by Symbol.'''
+    frames = [df for df in iter_download(symbols, start, chunk_size) if not df.empty]
+    return pd.concat(frames) if frames else pd.DataFrame()
+
+def iter_download(symbols, start=None, chunk_size=CHUNK_SIZE):
+    '''Downloads chunk_size symbols at a time and yields their long frames (see download), so only
+    one chunk's wide frame is held at a time.'''
+    symbols = sorted(symbols)
+    for i in range(0, len(symbols), chunk_size):
+        chunk = symbols[i:i + chunk_size]
+        if start is None:
+            data = yf.download(chunk, group_by="Ticker", period="max", auto_adjust=True)
+        else:
+            data = yf.download(chunk, group_by="Ticker", start=start, end=datetime.datetime.now(), auto_adjust=True)
+        if data.empty:
+            yield pd.DataFrame()
+            continue
+
+        df = data.stack(level=0).rename_axis(['Date', 'Symbol']).reset_index(level=1)
+        del data
+        yield df.sort_values(by='Symbol',axis='index',kind='stable')
+
+def iter_payloads(df, payload=adb.WritePayload):
+    '''Lazily yields one payload per symbol of df, sliced by group index.'''
+    for symbol, rows in df.groupby('Symbol', sort=False).indices.items():
+        yield payload(symbol, df.iloc[rows])
+
+def write_in_chunks(method, payloads, chunk_size=CHUNK_SIZE, **kwargs):
+    '''Passes the payloads to a batch method of a library (write_batch, update_batch, ...) chunk_size at a time.'''
+    payloads = iter(payloads)
+    while chunk := list(islice(payloads, chunk_size)):
+        method(chunk, **kwargs)
+
+def add_metadata(df, univ_df):
+    '''Inserts Name, Sector and Market Cap columns from the universe.'''
+    df["Name"] = df["Symbol"].map(dict(zip(univ_df["Symbol"], univ_df["Name"])))
+    df['Sector'] = df['Symbol'].map(dict(zip(univ_df["Symbol"], univ_df["Sector"])))
+    df['Market Cap'] = df['Symbol'].map(dict(zip(univ_df["Symbol"], univ_df["Market Cap"])))
+    return df
+
+def compute_indicators(df):
+    '''Computes all indicators of a frame sorted by Symbol (and by Date within each symbol).'''
+    return indicators.compute_indicators(df)
+
+def continue_indicators(stored, new, seeded):
+    '''Computes the indicators of new bars from the stored tail of their symbols.
+
+    stored: stored rows per symbol (sorted by Symbol), new: downloaded bars that follow them.
+    seeded: symbols whose stored tail does not reach back to their first bar; their EMAs and ATR are
+            continued from the last stored value instead of being recomputed over the window.
+    Returns stored and new rows, sorted by Symbol; the stored rows keep their stored values.'''
+    df = pd.concat([stored.assign(_new=False), new.assign(_new=True)])
+    df = df.iloc[np.lexsort((df.index.values, df['Symbol'].values))]
+    is_new = df.pop('_new').to_numpy(dtype=bool)
+
+    # Window-based indicators are exact over the lookback window
+    result = compute_indicators(df.copy())
+    for column in result.columns.intersection(stored.columns):
+        result[column] = np.where(is_new, result[column].to_numpy(), df[column].to_numpy())
+
+    # RS Rank is only ranked for the new dates; the rank MA continues the stored ranks
+    symbols = result['Symbol'].to_numpy()
+    segments = indicators.Segments(symbols)
+    result["RS Rank 20D MA"] = indicators.rolling(result["RS Rank"].to_numpy(dtype=float), segments, indicators.WINDOW, 'mean')
+
+    # Recursive indicators continue from their last stored value (the row before the first new row)
+    rows = np.flatnonzero(is_new & np.isin(symbols, list(seeded)) & ~is_new[segments.row_starts])
+    if len(rows):
+        continued = indicators.Segments(symbols[rows])
+        previous = rows[continued.starts] - 1
+        close = result['Close'].to_numpy(dtype=float)
+        for column, length in EMA_LENGTHS.items():
+            values = result[column].to_numpy(dtype=float).copy()
+            values[rows] = indicators.ema(close[rows], continued, length, initial=values[previous])
+            result[column] = values
+        atr = result['ATR'].to_numpy(dtype=float).copy()
+        atr[rows] = indicators.atr(result['High'].to_numpy(dtype=float)[rows], result['Low'].to_numpy(dtype=float)[rows],
+                                   close[rows], continued, ATR_PERIOD, initial=atr[previous], initial_close=close[previous])
+        result['ATR'] = atr
+
+    # Channels of the new rows depend on the previous row of the same symbol
+    previous = {column: indicators.shift(result[column].to_numpy(dtype=float), segments, 1) for column in ['20D_EMA', 'ATR', 'STD']}
+    channels = {'KC_Upper': previous['20D_EMA'] + previous['ATR'] * 1.5,
+                'KC_Lower': previous['20D_EMA'] - previous['ATR'] * 1.5,
+                'BB_Upper': previous['20D_EMA'] + previous['STD'] * 2,
+                'BB_Lower': previous['20D_EMA'] - previous['STD'] * 2}
+    for column, values in channels.items():
+        result[column] = np.where(is_new, values, result[column].to_numpy())
+    return result
+
+def read_tails(stock_lib, symbols, rows=LOOKBACK):
+    '''Reads the last rows of every symbol in one batch.'''
+    items = stock_lib.read_batch([adb.ReadRequest(symbol, row_range=(-rows, None)) for symbol in symbols])
+    return {symbol: item.data for symbol, item in zip(symbols, items) if hasattr(item, 'data') and not item.data.empty}
+
+def adjustment_factor(stored, downloaded):
+    '''Ratio between re-downloaded and stored closes on the overlapping dates: 1.0 if unchanged,
+    None if the ratio is not constant (the stored history can't just be rescaled).'''
+    overlap = stored.index.intersection(downloaded.index)
+    if len(overlap) == 0:
+        return 1.0
+    ratio = downloaded.loc[overlap, 'Close'].to_numpy(dtype=float) / stored.loc[overlap, 'Close'].to_numpy(dtype=float)
+    ratio = ratio[~np.isnan(ratio)]
+    if len(ratio) == 0 or np.allclose(ratio, 1.0, rtol=0, atol=1e-6):
+        return 1.0
+    if np.ptp(ratio) > 1e-6 * ratio.mean():
+        return None
+    return float(ratio.mean())
+
+def volume_factor(stored, downloaded, factor):
+    '''1 / factor if the re-downloaded volumes show that a split caused the price adjustment, else 1.0.'''
+    if factor == 1.0 or 'Volume' not in stored.columns or 'Volume' not in downloaded.columns:
+        return 1.0
+    overlap = stored.index.intersection(downloaded.index)
+    ratio = downloaded.loc[overlap, 'Volume'].to_numpy(dtype=float) / stored.loc[overlap, 'Volume'].to_numpy(dtype=float)
+    ratio = ratio[np.isfinite(ratio) & (ratio > 0)]
+    # A split scales the volumes by about 1 / factor, a dividend leaves them as they were
+    if len(ratio) == 0 or abs(np.log(np.median(ratio) * factor)) >= abs(np.log(np.median(ratio))):
+        return 1.0
+    return 1 / factor
+
+def rescale(df, factor, volume_factor=1.0):
+    '''Applies a re-adjustment to stored bars in place: prices times factor, volumes times volume_factor.'''
+    df[PRICE_COLUMNS] = df[PRICE_COLUMNS] * factor
+    if volume_factor != 1.0:
+        for column in [column for column in VOLUME_COLUMNS if column in df.columns]:
+            volume = df[column] * volume_factor
+            # Keeps the stored dtype, integer volumes stay integers
+            df[column] = volume.round().astype(df[column].dtype) if pd.api.types.is_integer_dtype(df[column]) else volume
+    return df
+
+@dataclass
+class SectorBatch:
+    '''Data of (a chunk of) one sector passed through the fetch, compute and write stages of an update.'''
+    sector: str
+    symbols: list
+    metadata: pd.DataFrame                               # universe rows of the sector (Name, Sector, Market Cap)
+    tails: dict = field(default_factory=dict)            # symbol -> stored tail, for symbols updated incrementally
+    data: pd.DataFrame = None                            # bars downloaded since the stored tails
+    factors: dict = field(default_factory=dict)          # symbol -> price adjustment factor vs. the stored tail
+    volume_factors: dict = field(default_factory=dict)   # symbol -> volume adjustment factor (splits only)
+    full_reload: list = field(default_factory=list)      # symbols of the sector downloaded in full
+    full_data: pd.DataFrame = None                       # full history of a chunk of them
+    last: bool = True                                    # last batch of the sector, its write updates the sector frame
+    updates: pd.DataFrame = None                         # computed rows from the first new bar on
+    reloaded: pd.DataFrame = None                        # computed full history of the chunk of reloaded symbols
+    timings: dict = field(default_factory=dict)          # stage -> seconds
+
+def fetch_sector(sector, symbols, univ_df, stock_lib, stored_symbols=None, chunk_size=CHUNK_SIZE):
+    '''I/O stage: reads the stored tails of the sector, downloads the missing bars and yields SectorBatches.
+
+    Symbols with stored data only get the bars since their last stored date (that bar is downloaded
+    again, it may have been written intraday); they make up the first batch. New and stale symbols, and
+    symbols whose prices were re-adjusted in a way that can't be rescaled, are downloaded in full and
+    follow in batches of chunk_size symbols, so the memory needed doesn't grow with the sector.'''
+    start_time = time.perf_counter()
+    stored_symbols = set(stored_symbols if stored_symbols is not None else stock_lib.list_symbols())
+    metadata = univ_df[univ_df['Symbol'].isin(symbols)][['Symbol', 'Name', 'Sector', 'Market Cap']]
+    batch = SectorBatch(sector, symbols, metadata)
+    tails = read_tails(stock_lib, [symbol for symbol in symbols if symbol in stored_symbols])
+
+    if tails:
+        last_dates = pd.Series({symbol: tail.index[-1] for symbol, tail in tails.items()})
+        stale = last_dates[last_dates < last_dates.max() - pd.Timedelta(days=STALE_DAYS)].index
+        tails = {symbol: tail for symbol, tail in tails.items() if symbol not in stale}
+    full_reload = [symbol for symbol in symbols if symbol not in tails]
+
+    if tails:
+        start = min(tail.index[-1] for tail in tails.values()) - pd.Timedelta(days=OVERLAP_DAYS)
+        batch.data = download(list(tails), start=start, chunk_size=chunk_size)
+        print(f'{datetime.datetime.now()}: {sector}: {len(batch.data)} bars downloaded for {len(tails)} symbols since {start.date()}')
+
+        groups = batch.data.groupby('Symbol').indices if not batch.data.empty else {}
+        for symbol in list(tails):
+            if symbol not in groups:
+                continue
+            downloaded = batch.data.iloc[groups[symbol]]
+            factor = adjustment_factor(tails[symbol], downloaded)
+            if factor is None:
+                full_reload.append(symbol)
+                del tails[symbol]
+            else:
+                batch.factors[symbol] = factor
+                batch.volume_factors[symbol] = volume_factor(tails[symbol], downloaded, factor)
+
+    chunks = [full_reload[i:i + chunk_size] for i in range(0, len(full_reload), chunk_size)]
+    batch.tails, batch.full_reload, batch.last = tails, full_reload, not chunks
+    batch.timings['fetch'] = time.perf_counter() - start_time
+    if tails or not chunks:
+        yield batch
+
+    for i, chunk in enumerate(chunks):
+        start_time = time.perf_counter()
+        batch = SectorBatch(sector, symbols, metadata, full_reload=full_reload, last=i == len(chunks) - 1)
+        batch.full_data = download(chunk, chunk_size=chunk_size)
+        print(f'{datetime.datetime.now()}: {sector}: full history of {len(chunk)} symbols downloaded ({i + 1}/{len(chunks)})')
+        batch.timings['fetch'] = time.perf_counter() - start_time
+        yield batch
+
+def compute_sector(batch):
+    '''CPU stage: computes the indicators of the downloaded bars. Touches no database, so it can run
+    in a worker process; the inputs are dropped from the returned batch.'''
+    start_time = time.perf_counter()
+    seeded, stored_rows, new_rows = [], [], []
+    groups = batch.data.groupby('Symbol').indices if batch.data is not None and not batch.data.empty else {}
+    for symbol, tail in batch.tails.items():
+        if symbol not in groups:
+            stored_rows.append(tail)
+            continue
+        downloaded = batch.data.iloc[groups[symbol]]
+        factor = batch.factors[symbol]
+        if factor != 1.0:
+            tail = rescale(tail.copy(), factor, batch.volume_factors.get(symbol, 1.0))
+
+        last_date = tail.index[-1]
+        new = downloaded[downloaded.index >= last_date]
+        if new.empty:
+            stored_rows.append(tail)
+            continue
+        stored_rows.append(tail[tail.index < last_date])
+        new_rows.append(add_metadata(new.copy(), batch.metadata))
+        if len(tail) >= LOOKBACK:
+            seeded.append(symbol)
+
+    if new_rows:
+        df = continue_indicators(pd.concat(stored_rows), pd.concat(new_rows), seeded)
+        # All rows of the sector from the first new bar on, so the sector frame can be updated in place
+        first_new = min(new.index[0] for new in new_rows)
+        batch.updates = df[df.index >= first_new]
+
+    if batch.full_data is not None and not batch.full_data.empty:
+        batch.reloaded = compute_indicators(add_metadata(batch.full_data, batch.metadata))
+
+    batch.tails, batch.data, batch.full_data = {}, None, None
+    batch.timings['compute'] = time.perf_counter() - start_time
+    return batch
+
+def write_sector(batch, sector_lib, stock_lib):
+    '''Write stage: rescales re-adjusted histories and writes the computed rows. sector_lib: library of
+    the legacy sector frames to keep up to date, None to store the per-symbol data only.'''
+    start_time = time.perf_counter()
+    rescaled = {symbol: factor for symbol, factor in batch.factors.items() if factor != 1.0}
+    for symbol, factor in rescaled.items():
+        history = rescale(stock_lib.read(symbol).data, factor, batch.volume_factors.get(symbol, 1.0))
+        stock_lib.write(symbol, history, prune_previous_versions=True)
+
+    reloaded = 0
+    if batch.reloaded is not None:
+        write_in_chunks(stock_lib.write_batch, iter_payloads(batch.reloaded))
+        reloaded = batch.reloaded['Symbol'].nunique()
+
+    updates = batch.updates
+    if updates is not None:
+        write_in_chunks(stock_lib.update_batch, iter_payloads(updates, adb.UpdatePayload))
+
+    # The sector is reranked / its frame updated once all batches of the sector are written
+    if batch.last:
+        if batch.full_reload or (sector_lib is not None and (rescaled or not sector_lib.has_symbol(batch.sector))):
+            rebuild_sector(batch.sector, batch.symbols, sector_lib, stock_lib, rerank=bool(batch.full_reload))
+        elif updates is not None and sector_lib is not None:
+            sector_lib.update(batch.sector, updates.sort_index(kind='stable'))
+    batch.timings['write'] = time.perf_counter() - start_time
+    print(f'{datetime.datetime.now()}: {batch.sector}: {len(updates) if updates is not None else 0} rows updated, '
+          f'{len(rescaled)} symbols rescaled, {reloaded} symbols reloaded')
+    batch.updates, batch.reloaded = None, None
+    return batch
+
+def update_sector(sector, symbols, univ_df, sector_lib, stock_lib, stored_symbols=None, chunk_size=CHUNK_SIZE):
+    '''Brings the stored data of one sector up to date: fetch, compute and write in sequence.'''
+    return [write_sector(compute_sector(batch), sector_lib, stock_lib)
+            for batch in fetch_sector(sector, symbols, univ_df, stock_lib, stored_symbols, chunk_size)]
+
+def update_sectors(sectors, univ_df, sector_lib, stock_lib, workers=None, stored_symbols=None, chunk_size=CHUNK_SIZE):
+    '''Updates many sectors as a pipeline: the main thread fetches batch after batch while a process
+    pool computes the indicators of the batches already fetched, and a writer thread stores the results
+    in order. At most 2 * workers fetched batches wait for the writer, which bounds the memory.
+
+    sectors: dictionary sector -> symbols. Returns the written SectorBatches, with their timings.'''
+    workers = workers or os.cpu_count()
+    stored_symbols = set(stored_symbols if stored_symbols is not None else stock_lib.list_symbols())
+    pending = queue.Queue(maxsize=2 * workers)
+    done, sectors_done = [], 0
+
+    def writer():
+        nonlocal sectors_done
+        while True:
+            item = pending.get()
+            if item is None:
+                return
+            sector, future = item
+            try:
+                batch = write_sector(future.result(), sector_lib, stock_lib)
+                done.append(batch)
+                if batch.last:
+                    sectors_done += 1
+                    print(f'{datetime.datetime.now()}: [{sectors_done}/{len(sectors)}] {sector} written')
+            except Exception as e:
+                print(f'Error updating {sector}: {e}')
+
+    writer_thread = threading.Thread(target=writer, name='sector-writer', daemon=True)
+    writer_thread.start()
+    # Workers are spawned, not forked: the parent has an open LMDB environment and a running writer thread
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+        for sector, symbols in sectors.items():
+            try:
+                for batch in fetch_sector(sector, symbols, univ_df, stock_lib, stored_symbols, chunk_size):
+                    pending.put((sector, pool.submit(compute_sector, batch)))
+            except Exception as e:
+                print(f'Error fetching {sector}: {e}')
+        pending.put(None)
+        writer_thread.join()
+    return done
+
+def timing_report(batches, wall_time=None):
+    '''Prints the seconds spent per stage and sector.'''
+    timings = pd.DataFrame([{'sector': batch.sector, **batch.timings} for batch in batches], columns=['sector', 'fetch', 'compute', 'write'])
+    report = timings.groupby('sector', sort=False).sum()
+    report.loc['Total'] = report.sum()
+    print(report.round(2).to_string())
+    if wall_time is not None:
+        print(f'Wall time: {wall_time:.2f} s (stages sum to {report.loc["Total"].sum():.2f} s)')
+    return report
+
+def rebuild_sector(sector, symbols, sector_lib, stock_lib, rerank=False):
+    '''Rewrites the sector frame (if sector_lib is given) from the per-symbol data. With rerank, the RS Rank
+    is recomputed across the sector (needed when its members changed) and written back to the symbols.'''
+    if sector_lib is None and not rerank:
+        return
+    df = read_symbols(stock_lib, symbols, by_symbol=True)
+    if df.empty:
+        return
+
+    if rerank:
+        df['RS Rank'] = df.groupby(df.index)['RS IBD'].rank(pct=True)
+        df["RS Rank 20D MA"] = df.groupby("Symbol")["RS Rank"].rolling(window=20).mean().reset_index(level=0, drop=True)
+        write_in_chunks(stock_lib.write_batch, iter_payloads(df), prune_previous_versions=True)
+    if sector_lib is not None:
+        sector_lib.write(sector, df.sort_index(kind='stable'), prune_previous_versions=True)
+
+########################### QUERY LAYER ###########################
+
+def read_symbols(stock_lib, symbols, columns=None, date_range=None, query_builder=None, by_symbol=False):
+    '''Reads many symbols in one batch and returns a long frame with a Symbol column.
+
+    columns, date_range and query_builder (an ArcticDB QueryBuilder, e.g. q[q['Close'] > 5]) are applied
+    by ArcticDB while reading. The rows are sorted by Date and Symbol like the former sector frames, or by
+    Symbol and Date with by_symbol.'''
+    if columns is not None and 'Symbol' not in columns:
+        columns = ['Symbol'] + list(columns)
+    requests = [adb.ReadRequest(symbol, columns=columns, date_range=date_range, query_builder=query_builder) for symbol in symbols]
+    items = stock_lib.read_batch(requests) if requests else []
+    frames = [item.data for item in items if hasattr(item, 'data') and not item.data.empty]
+    if not frames:
+        return pd.DataFrame(columns=columns)
+    df = pd.concat(frames)
+    df = df.iloc[np.lexsort((df.index.values, df['Symbol'].values))]
+    return df if by_symbol else df.sort_index(kind='stable')
+
+def read_sector(stock_lib, univ_df, sector, columns=None, date_range=None, query_builder=None):
+    '''The sector view: all symbols of a sector of the universe, as the former 'us_sectors' frame.'''
+    symbols = univ_df[univ_df['Sector'] == sector]['Symbol'].tolist()
+    return read_symbols(stock_lib, symbols, columns, date_range, query_builder)
+
+def read_cross_section(stock_lib, symbols, date, columns=None, query_builder=None):
+    '''The rows of all symbols on one date, indexed by Symbol.'''
+    date = pd.Timestamp(date)
+    df = read_symbols(stock_lib, symbols, columns, (date, date), query_builder)
+    return df.set_index('Symbol')
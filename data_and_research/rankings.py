@@ -0,0 +1,67 @@
+# ATS/data_and_research/rankings.py
+# Cross-sectional RS Rank of the whole US equity universe. The percentile rank of every symbol's RS IBD
+# among all symbols on the same date is stored as one Date x Symbol matrix (symbol 'rs_rank' of the
+# 'us_ranks' library). Each update only ranks the dates after the last ranked one, and screeners read
+# a single row of the matrix instead of the history of every symbol.
+
+import numpy as np
+import pandas as pd
+
+from data_and_research.utils import LIBRARY_OPTIONS
+from data_and_research.ohlcv import read_symbols
+
+RANK_LIBRARY = 'us_ranks'
+RANK_SYMBOL = 'rs_rank'
+
+def get_rank_library(ac):
+    # Dynamic schema: symbols entering the universe add columns to the matrix
+    return ac.get_library(RANK_LIBRARY, create_if_missing=True, library_options=LIBRARY_OPTIONS)
+
+def rank_matrix(df):
+    '''Percentile ranks of RS IBD across all symbols per date, from a long frame (Date index, Symbol, RS IBD).'''
+    matrix = df.set_index('Symbol', append=True)['RS IBD'].unstack('Symbol')
+    matrix = matrix.rank(axis=1, pct=True).astype(np.float32)
+    matrix.index.name = 'Date'
+    matrix.columns.name = None
+    return matrix.dropna(how='all')
+
+def last_ranked_date(rank_lib):
+    if not rank_lib.has_symbol(RANK_SYMBOL):
+        return None
+    last_row = rank_lib.read(RANK_SYMBOL, row_range=(-1, None), columns=[]).data
+    return last_row.index[-1] if len(last_row.index) else None
+
+def update_rs_ranks(stock_lib, rank_lib, symbols, full=False):
+    '''Ranks the dates from the last ranked date on (that date is ranked again, its bars may have been
+    written intraday) and writes them to the matrix. With full, or without matrix, all dates are ranked.
+
+    The ranks of past dates are kept when symbols join the universe later; use full to re-rank them.
+    Returns the number of dates ranked.'''
+    start = None if full else last_ranked_date(rank_lib)
+    df = read_symbols(stock_lib, symbols, columns=['RS IBD'], date_range=(start, None) if start is not None else None)
+    if df.empty:
+        return 0
+
+    matrix = rank_matrix(df)
+    if start is None:
+        rank_lib.write(RANK_SYMBOL, matrix, prune_previous_versions=True)
+    else:
+        rank_lib.update(RANK_SYMBOL, matrix, prune_previous_versions=True)
+    return len(matrix)
+
+def read_rs_ranks(rank_lib, date=None, symbols=None):
+    '''RS Ranks of one date (the last ranked date if None) as a Series indexed by Symbol.'''
+    if not rank_lib.has_symbol(RANK_SYMBOL):
+        return pd.Series(dtype=np.float32, name='RS Rank')
+    if date is None:
+        row = rank_lib.read(RANK_SYMBOL, row_range=(-1, None), columns=symbols).data
+    else:
+        date = pd.Timestamp(date)
+        row = rank_lib.read(RANK_SYMBOL, date_range=(date, date), columns=symbols).data
+    if row.empty:
+        return pd.Series(dtype=np.float32, name='RS Rank')
+    return row.iloc[-1].dropna().rename('RS Rank')
+
+def read_rs_rank_history(rank_lib, symbols=None, date_range=None):
+    '''The Date x Symbol matrix of RS Ranks, optionally restricted to symbols and dates.'''
+    return rank_lib.read(RANK_SYMBOL, columns=symbols, date_range=date_range).data
@@ -0,0 +1,410 @@
+# ATS/data_and_research/storage.py
+# Storage layer of the ArcticDB connection:
+#  - the LMDB map size is configurable (ATS_LMDB_MAP_SIZE) and grows automatically (up to ATS_LMDB_MAX_MAP_SIZE)
+#    when a write fails because the store is full,
+#  - LazyArctic connects on first use and hands out cached library handles,
+#  - AppendBatcher groups many small appends (portfolio deltas, account PnL) into batched writes.
+
+import os, re, gc, time, atexit, threading
+import pandas as pd
+import arcticdb as adb
+from arcticdb import ErrorCode
+from arcticdb.exceptions import ErrorCategory
+from arcticdb.exceptions import LmdbMapFullError
+
+DEFAULT_MAP_SIZE = '512MB'
+DEFAULT_MAX_MAP_SIZE = '64GB'
+UNITS = {'': 1, 'B': 1, 'KB': 2**10, 'MB': 2**20, 'GB': 2**30, 'TB': 2**40}
+
+def parse_size(size):
+    '''Bytes of a size given as number or string like '5MB' or '2GB'.'''
+    if isinstance(size, (int, float)):
+        return int(size)
+    match = re.fullmatch(r'\s*(\d+(?:\.\d+)?)\s*([KMGT]?B?)\s*', str(size).upper())
+    if not match:
+        raise ValueError(f"Invalid size: {size}")
+    return int(float(match.group(1)) * UNITS[match.group(2)])
+
+def format_size(size):
+    '''Size in the format of the LMDB URI (whole MB).'''
+    return f"{max(parse_size(size) // 2**20, 1)}MB"
+
+def configured_map_size():
+    return parse_size(os.environ.get('ATS_LMDB_MAP_SIZE', DEFAULT_MAP_SIZE))
+
+def configured_max_map_size():
+    return parse_size(os.environ.get('ATS_LMDB_MAX_MAP_SIZE', DEFAULT_MAX_MAP_SIZE))
+
+def lmdb_uri(path, map_size=None):
+    return f"lmdb://{path}?map_size={format_size(map_size or configured_map_size())}"
+
+# Errors of the data itself: writing the same rows again fails again
+DATA_ERROR_CATEGORIES = {ErrorCategory.USER_INPUT, ErrorCategory.SORTING, ErrorCategory.SCHEMA, ErrorCategory.NORMALIZATION}
+
+def is_data_error(error):
+    '''True for a DataError or exception caused by the written data (unsorted index, schema mismatch, ...).'''
+    category = getattr(error, 'error_category', None)
+    if category is None:
+        category = getattr(getattr(error, 'error_code', None), 'category', None)
+    return category in DATA_ERROR_CATEGORIES or isinstance(error, (adb.exceptions.SortingException, adb.exceptions.SchemaException,
+                                                                   adb.exceptions.NormalizationException, adb.exceptions.UserInputException))
+
+def is_map_full(result):
+    '''True for the DataError a batch method returns for a symbol that failed because the LMDB map is full.'''
+    return (getattr(result, 'error_code', None) == ErrorCode.E_LMDB_MAP_FULL
+            or 'MDB_MAP_FULL' in str(getattr(result, 'exception_string', '')))
+
+########################### LAZY CONNECTION ###########################
+
+class LazyArctic:
+    '''Stands in for the Arctic connection: connect(map_size=...) only runs on first use, so importing
+    data_and_research (and everything importing it) doesn't open the database. Library handles are cached.
+
+    When an LMDB write fails because the map is full, the connection is reopened with twice the map size
+    (up to max_map_size) and the write retried. Reopening waits until no other call is using the store,
+    as LMDB must not be opened twice in one process.'''
+
+    def __init__(self, connect, map_size=None, max_map_size=None):
+        self._connect = connect
+        self._arctic = None
+        self._libraries = {}    # name -> GrowingLibrary
+        self._handles = {}      # name -> library of the current connection
+        self._lock = threading.RLock()
+        self._condition = threading.Condition()
+        self._active = 0        # library calls in progress
+        self._growing = False
+        self.map_size = parse_size(map_size) if map_size else configured_map_size()
+        self.max_map_size = parse_size(max_map_size) if max_map_size else configured_max_map_size()
+        self.grow_count = 0
+
+    def connection(self):
+        if self._arctic is None:
+            with self._lock:
+                if self._arctic is None:
+                    self._arctic = self._connect(map_size=self.map_size)
+        return self._arctic
+
+    def get_library(self, name, create_if_missing=False, library_options=None, **kwargs):
+        library = self._libraries.get(name)
+        if library is None:
+            with self._lock:
+                library = self._libraries.get(name)
+                if library is None:
+                    self.connection().get_library(name, create_if_missing=create_if_missing,
+                                                  library_options=library_options, **kwargs)
+                    library = self._libraries[name] = GrowingLibrary(self, name)
+        return library
+
+    def library_handle(self, name):
+        '''The ArcticDB library of the current connection (changes when the map grows).'''
+        handle = self._handles.get(name)
+        if handle is None:
+            with self._lock:
+                handle = self._handles[name] = self.connection().get_library(name)
+        return handle
+
+    def delete_library(self, name):
+        with self._lock:
+            self._libraries.pop(name, None)
+            self._handles.pop(name, None)
+            return self.connection().delete_library(name)
+
+    def is_lmdb(self):
+        return self.connection().get_uri().startswith('lmdb')
+
+    def enter(self):
+        with self._condition:
+            while self._growing:
+                self._condition.wait()
+            self._active += 1
+
+    def exit(self):
+        with self._condition:
+            self._active -= 1
+            self._condition.notify_all()
+
+    def grow(self, failed_map_size):
+        '''Reopens the store with twice the map size, unless another thread already did.'''
+        with self._condition:
+            if self.map_size > failed_map_size:
+                return
+            while self._growing:
+                self._condition.wait()
+                if self.map_size > failed_map_size:
+                    return
+            if self.map_size >= self.max_map_size:
+                raise MemoryError(f"LMDB map size limit of {format_size(self.max_map_size)} reached (ATS_LMDB_MAX_MAP_SIZE)")
+            self._growing = True
+            while self._active:
+                self._condition.wait()
+
+        try:
+            with self._lock:
+                if hasattr(self._arctic, 'close'):
+                    self._arctic.close()  # e.g. TieredArctic: finish the replication to S3
+                self._arctic, self._handles = None, {}
+                gc.collect()  # the LMDB environment is closed when the last handle is gone
+                self.map_size = min(self.map_size * 2, self.max_map_size)
+                self.grow_count += 1
+                print(f"LMDB map full, reopening with map size {format_size(self.map_size)}")
+                self.connection()
+        finally:
+            with self._condition:
+                self._growing = False
+                self._condition.notify_all()
+
+    def __getattr__(self, name):
+        return getattr(self.connection(), name)
+
+class GrowingLibrary:
+    '''Library proxy of a LazyArctic: calls go to the library of the current connection and writes
+    that fail because the LMDB map is full are retried after growing the map. Batch methods don't raise
+    but return a DataError per failed symbol; those payloads are retried.'''
+
+    def __init__(self, arctic, name):
+        self._arctic = arctic
+        self._name = name
+
+    def __getattr__(self, attribute):
+        value = getattr(self._arctic.library_handle(self._name), attribute)
+        if not callable(value):
+            return value
+
+        def call(*args, **kwargs):
+            while True:
+                map_size = self._arctic.map_size
+                self._arctic.enter()
+                try:
+                    return getattr(self._arctic.library_handle(self._name), attribute)(*args, **kwargs)
+                except LmdbMapFullError:
+                    if not self._arctic.is_lmdb():
+                        raise
+                finally:
+                    self._arctic.exit()
+                self._arctic.grow(map_size)
+
+        def call_batch(payloads, *args, **kwargs):
+            payloads = list(payloads)
+            results = [None] * len(payloads)
+            positions = range(len(payloads))
+            while True:
+                map_size = self._arctic.map_size
+                batch = call([payloads[i] for i in positions], *args, **kwargs)
+                for i, result in zip(positions, batch):
+                    results[i] = result
+                positions = [i for i, result in zip(positions, batch) if is_map_full(result)]
+                if not positions:
+                    return results
+                self._arctic.grow(map_size)
+
+        return call_batch if attribute in ('write_batch', 'append_batch', 'update_batch') else call
+
+    def __repr__(self):
+        return f"GrowingLibrary({self._name})"
+
+########################### WRITE BATCHING ###########################
+
+class AppendBatcher:
+    '''Collects small appends and writes them per library as one append_batch (a write for symbols that
+    don't exist yet). Pending rows are written once max_rows are pending, max_delay seconds after the
+    first pending append, on flush() and at exit.
+
+    Rows stamped before the end of the stored index are dropped with a message, where a direct append with
+    validate_index would have failed. Rows that failed because of the store (e.g. an LMDB or S3 error) are
+    queued again and retried with the next flush; rows the store rejects as invalid are dropped.'''
+
+    def __init__(self, max_rows=1000, max_delay=5.0):
+        self.max_rows = max_rows
+        self.max_delay = max_delay
+        self.pending = {}   # (library, symbol) -> [frames]
+        self.index_end = {} # (library, symbol) -> last stored index value
+        self.rows = 0
+        self.first_pending = None
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.wakeup = threading.Event()
+        threading.Thread(target=self.run, name='append-batcher', daemon=True).start()
+        atexit.register(self.flush)
+
+    def append(self, library, symbol, df):
+        if df is None or df.empty:
+            return
+        with self.lock:
+            self.pending.setdefault((library, symbol), []).append(df)
+            self.rows += len(df)
+            if self.first_pending is None:
+                self.first_pending = time.monotonic()
+            full = self.rows >= self.max_rows
+        if full:
+            self.flush()
+        else:
+            self.wakeup.set()
+
+    def run(self):
+        while True:
+            self.wakeup.wait()
+            self.wakeup.clear()
+            with self.lock:
+                first_pending = self.first_pending
+            if first_pending is None:
+                continue
+            remaining = first_pending + self.max_delay - time.monotonic()
+            if remaining > 0:
+                time.sleep(remaining)
+            self.flush()
+
+    def flush(self):
+        '''Writes all pending rows.'''
+        with self.flush_lock:
+            with self.lock:
+                pending, self.pending = self.pending, {}
+                self.rows, self.first_pending = 0, None
+            if not pending:
+                return
+
+            by_library = {}
+            for (library, symbol), frames in pending.items():
+                df = pd.concat(frames) if len(frames) > 1 else frames[0]
+                df = self.validate_index(library, symbol, df.sort_index(kind='stable'))
+                if not df.empty:
+                    by_library.setdefault(library, []).append((symbol, df))
+
+            failed = []
+            for library, items in by_library.items():
+                payloads = []
+                for symbol, df in items:
+                    try:
+                        if (library, symbol) in self.index_end or library.has_symbol(symbol):
+                            payloads.append(adb.WritePayload(symbol, df))
+                        else:
+                            library.write(symbol, df, validate_index=True)
+                            self.index_end[(library, symbol)] = df.index[-1]
+                    except Exception as e:
+                        failed.append(self.failure(library, symbol, df, e))
+                if not payloads:
+                    continue
+                try:
+                    results = library.append_batch(payloads, validate_index=True)
+                except Exception as e:
+                    failed.extend(self.failure(library, payload.symbol, payload.data, e) for payload in payloads)
+                    continue
+                for payload, result in zip(payloads, results):
+                    if hasattr(result, 'version'):
+                        self.index_end[(library, payload.symbol)] = payload.data.index[-1]
+                    else:
+                        failed.append(self.failure(library, payload.symbol, payload.data, result))
+            self.requeue([item for item in failed if item])
+
+    def validate_index(self, library, symbol, df):
+        '''Drops the rows stamped before the end of the stored index, an append can't insert them.'''
+        if not isinstance(df.index, pd.DatetimeIndex):
+            return df
+        key = (library, symbol)
+        if key not in self.index_end:
+            try:
+                if not library.has_symbol(symbol):
+                    return df
+                self.index_end[key] = library.get_description(symbol).date_range[1]
+            except Exception as e:
+                print(f"Could not read the index of {symbol}: {e}")
+                return df
+        end = self.index_end[key]
+        try:
+            late = df.index < end
+        except TypeError:  # e.g. tz-aware rows for a tz-naive index, the append reports it
+            return df
+        if late.any():
+            print(f"Dropped {late.sum()} rows appended to {symbol}: stamped before the stored index ending at {end}")
+            df = df[~late]
+        return df
+
+    def failure(self, library, symbol, df, error):
+        '''The (key, rows) to retry after a failed write, None if the rows themselves were rejected.'''
+        if is_data_error(error):
+            print(f"Dropped {len(df)} rows appended to {symbol}: {error}")
+            return None
+        print(f"Error appending to {symbol}, retrying with the next flush: {error}")
+        return (library, symbol), df
+
+    def requeue(self, failed):
+        '''Puts failed rows back in front of the rows appended in the meantime.'''
+        if not failed:
+            return
+        with self.lock:
+            for key, df in failed:
+                self.pending[key] = [df] + self.pending.get(key, [])
+            if self.first_pending is None:
+                self.first_pending = time.monotonic()
+        self.wakeup.set()
+
+_append_batcher = None
+_batcher_lock = threading.Lock()
+
+def get_append_batcher():
+    '''Returns the append batcher of the process.'''
+    global _append_batcher
+    with _batcher_lock:
+        if _append_batcher is None:
+            _append_batcher = AppendBatcher()
+    return _append_batcher
+
+########################### STRESS BENCHMARK ###########################
+
+def stress_benchmark(years=2, fills_per_day=50, initial_map_size='8MB', sample=500):
+    '''Writes years of minute account PnL and fills into a temporary LMDB store that starts with a small
+    map, through an AppendBatcher. One append per row (the former behaviour) is timed on a sample.'''
+    import tempfile, shutil
+    import numpy as np
+
+    path = tempfile.mkdtemp(prefix='ats_storage_')
+    try:
+        arctic = LazyArctic(lambda map_size: adb.Arctic(lmdb_uri(path, map_size)), map_size=initial_map_size)
+        pnl_lib = arctic.get_library('pnl', create_if_missing=True)
+        portfolio_lib = arctic.get_library('portfolio', create_if_missing=True, library_options=adb.LibraryOptions(dynamic_schema=True))
+
+        rng = np.random.default_rng(0)
+        days = pd.bdate_range(end=pd.Timestamp.today().normalize(), periods=252 * years)
+        minutes = (days.values[:, None] + pd.to_timedelta(np.arange(570, 960), unit='min').values[None, :]).ravel()
+        equity = 1e6 * np.exp(np.cumsum(rng.normal(0, 1e-4, len(minutes))))
+        fill_times = np.sort(rng.choice(minutes, size=len(days) * fills_per_day)) + rng.integers(0, 60e9, len(days) * fills_per_day).astype('timedelta64[ns]')
+        fills = pd.DataFrame({'symbol': rng.choice(['SPY', 'QQQ', 'VIX', 'ES', 'NQ'], len(fill_times)), 'strategy': 'BENCH',
+                              'position': rng.integers(-10, 10, len(fill_times)).astype(float),
+                              'averageCost': rng.uniform(10, 500, len(fill_times))}, index=pd.DatetimeIndex(fill_times, name='timestamp'))
+        fills = fills[~fills.index.duplicated()]
+
+        # Former behaviour: one append per row
+        start = time.perf_counter()
+        for i in range(sample):
+            row = pd.DataFrame({'total_equity': [equity[i]], 'account_id': ['BENCH']}, index=[minutes[i]])
+            if i == 0:
+                pnl_lib.write('unbatched', row)
+            else:
+                pnl_lib.append('unbatched', row)
+        unbatched = (time.perf_counter() - start) / sample
+
+        batcher = AppendBatcher(max_rows=5000, max_delay=3600)
+        start = time.perf_counter()
+        rows = 0
+        fill_position = 0
+        for i in range(0, len(minutes), 390):  # one trading day of appends at a time, row by row
+            for j in range(i, min(i + 390, len(minutes))):
+                batcher.append(pnl_lib, 'BENCH', pd.DataFrame({'total_equity': [equity[j]], 'account_id': ['BENCH']}, index=[minutes[j]]))
+            day_end = minutes[min(i + 389, len(minutes) - 1)]
+            day_fills = fills.iloc[fill_position:fills.index.searchsorted(day_end, side='right')]
+            fill_position += len(day_fills)
+            for k in range(len(day_fills)):
+                batcher.append(portfolio_lib, 'BENCH', day_fills.iloc[k:k + 1])
+            rows += min(390, len(minutes) - i) + len(day_fills)
+        batcher.flush()
+        batched = time.perf_counter() - start
+
+        assert len(pnl_lib.read('BENCH').data) == len(minutes)
+        print(f"{years} years: {len(minutes):,} minute PnL rows + {len(fills):,} fills = {rows:,} appends")
+        print(f"  one append per row: {unbatched * 1000:.2f} ms/row -> {unbatched * rows:.0f} s extrapolated")
+        print(f"  batched appends:    {batched:.2f} s ({rows / batched:,.0f} rows/s)")
+        print(f"  LMDB map grew {arctic.grow_count} times from {format_size(initial_map_size)} to {format_size(arctic.map_size)}")
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
+
+if __name__ == "__main__":
+    stress_benchmark()
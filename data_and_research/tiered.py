@@ -0,0 +1,486 @@
+# ATS/data_and_research/tiered.py
+# Tiered storage for S3 deployments: the hot libraries (settings/strategies, portfolio, PnL) are mirrored to
+# a local LMDB store that serves all reads and takes the writes, which are replicated to S3 in the background
+# (write-behind). The other (research) libraries stay on S3 and are read through a local cache that is
+# refreshed when the S3 version of a symbol changed.
+
+import os, time, atexit, threading, queue
+from urllib.parse import urlparse
+import numpy as np
+import pandas as pd
+from arcticdb import Arctic
+from arcticdb.version_store.library import DataError
+
+from data_and_research.storage import lmdb_uri
+
+HOT_LIBRARIES = ('general', 'portfolio', 'pnl')
+STATE_LIBRARY = 'tiered_state'
+STATE_SYMBOL = 'versions'
+
+def s3_uri(region, bucket_name, access_id, access_key, endpoint=None):
+    '''ArcticDB URI of the bucket. endpoint (setting 's3_endpoint' or ATS_S3_ENDPOINT) points to another
+    S3 compatible store, e.g. http://127.0.0.1:9000 for a local minio or moto server.'''
+    endpoint = endpoint or os.environ.get('ATS_S3_ENDPOINT')
+    if not endpoint:
+        return f's3://s3.{region}.amazonaws.com:{bucket_name}?region={region}&access={access_id}&secret={access_key}'
+    url = urlparse(endpoint if '://' in endpoint else f'https://{endpoint}')
+    scheme = 's3' if url.scheme == 'http' else 's3s'
+    port = f'&port={url.port}' if url.port else ''
+    return f'{scheme}://{url.hostname}:{bucket_name}?region={region}&access={access_id}&secret={access_key}{port}'
+
+def s3_mode():
+    '''ATS_S3_MODE: 'tiered' (default) or 'direct' (every read and write goes to S3).'''
+    return os.environ.get('ATS_S3_MODE', 'tiered').lower()
+
+def hot_libraries():
+    value = os.environ.get('ATS_S3_HOT_LIBRARIES')
+    return tuple(name.strip() for name in value.split(',') if name.strip()) if value else HOT_LIBRARIES
+
+def symbol_of(item):
+    return item if isinstance(item, str) else item.symbol
+
+def write_any(library, symbol, data, metadata=None):
+    '''Writes what was read from another library (DataFrames natively, other objects pickled).'''
+    if isinstance(data, (pd.DataFrame, pd.Series, np.ndarray)):
+        return library.write(symbol, data, metadata=metadata, prune_previous_versions=True)
+    return library.write_pickle(symbol, data, metadata=metadata, prune_previous_versions=True)
+
+def latest_versions(library, symbols):
+    '''Latest version per symbol, None where the symbol doesn't exist.'''
+    symbols = list(symbols)
+    if not symbols:
+        return {}
+    items = library.read_metadata_batch(symbols)
+    return {symbol: None if isinstance(item, DataError) else item.version for symbol, item in zip(symbols, items)}
+
+class SyncState:
+    '''Local and S3 version of every mirrored or cached symbol when both were last in sync,
+    kept in the local store so the sync survives restarts.'''
+
+    def __init__(self, local):
+        self.library = local.get_library(STATE_LIBRARY, create_if_missing=True)
+        self.lock = threading.Lock()
+        self.versions = {}  # (library, symbol) -> (local version, remote version)
+        if self.library.has_symbol(STATE_SYMBOL):
+            df = self.library.read(STATE_SYMBOL).data
+            self.versions = {(row.library, row.symbol): (int(row.local_version), int(row.remote_version)) for row in df.itertuples()}
+
+    def get(self, library, symbol):
+        return self.versions.get((library, symbol), (None, None))
+
+    def set(self, library, symbol, local_version, remote_version):
+        with self.lock:
+            if local_version is None or remote_version is None:
+                self.versions.pop((library, symbol), None)
+            else:
+                self.versions[(library, symbol)] = (local_version, remote_version)
+
+    def drop_library(self, library):
+        with self.lock:
+            self.versions = {key: value for key, value in self.versions.items() if key[0] != library}
+
+    def save(self):
+        with self.lock:
+            rows = [(library, symbol, local_version, remote_version) for (library, symbol), (local_version, remote_version) in self.versions.items()]
+        if rows:
+            df = pd.DataFrame(rows, columns=['library', 'symbol', 'local_version', 'remote_version'])
+            self.library.write(STATE_SYMBOL, df, prune_previous_versions=True)
+        elif self.library.has_symbol(STATE_SYMBOL):
+            self.library.delete(STATE_SYMBOL)
+
+########################### WRITE-BEHIND ###########################
+
+class Replicator:
+    '''Replays the writes of the mirrored libraries on S3, in order, in a background thread. Failed writes are
+    retried with backoff; after max_attempts the latest local version of the symbol is written instead.'''
+
+    def __init__(self, tiered, max_attempts=5, max_backoff=60.0):
+        self.tiered = tiered
+        self.max_attempts = max_attempts
+        self.max_backoff = max_backoff
+        self.queue = queue.Queue()
+        self.stopped = False
+        self.thread = threading.Thread(target=self.run, name='s3-replicator', daemon=True)
+        self.thread.start()
+
+    def put(self, library, method, args, kwargs, local_versions):
+        self.queue.put((self.replicate, (library, method, args, kwargs, local_versions)))
+
+    def push(self, library, symbol):
+        '''Queues writing the latest local version of the symbol to S3 (see push_latest).'''
+        self.queue.put((self.push_latest, (library, symbol)))
+
+    def pending(self):
+        return self.queue.unfinished_tasks
+
+    def run(self):
+        while True:
+            op = self.queue.get()
+            try:
+                if op is None:
+                    return
+                function, args = op
+                function(*args)
+            finally:
+                self.queue.task_done()
+
+    def replicate(self, library, method, args, kwargs, local_versions):
+        attempt = 0
+        while True:
+            try:
+                result = getattr(self.tiered.remote_library(library), method)(*args, **kwargs)
+                break
+            except Exception as e:
+                attempt += 1
+                print(f"Replicating {method} of {library}/{', '.join(local_versions)} to S3 failed ({attempt}): {e}")
+                if attempt >= self.max_attempts:
+                    for symbol in local_versions:
+                        self.push_latest(library, symbol)
+                    return
+                time.sleep(min(2 ** attempt, self.max_backoff))
+
+        results = result if method.endswith('_batch') else [result] * len(local_versions)
+        for (symbol, local_version), item in zip(local_versions.items(), results):
+            if method.startswith('delete'):
+                self.tiered.state.set(library, symbol, None, None)
+            elif isinstance(item, DataError):
+                self.push_latest(library, symbol)
+            else:
+                self.tiered.state.set(library, symbol, local_version, getattr(item, 'version', None))
+        self.tiered.state.save()
+
+    def push_latest(self, library, symbol):
+        '''Writes the latest local version of the symbol to S3 (retried until S3 accepts it).'''
+        local = self.tiered.local_library(library)
+        attempt = 0
+        while not self.stopped:
+            try:
+                if not local.has_symbol(symbol):
+                    self.tiered.remote_library(library).delete(symbol)
+                    self.tiered.state.set(library, symbol, None, None)
+                else:
+                    item = local.read(symbol)
+                    remote_item = write_any(self.tiered.remote_library(library), symbol, item.data, item.metadata)
+                    self.tiered.state.set(library, symbol, item.version, remote_item.version)
+                self.tiered.state.save()
+                return
+            except Exception as e:
+                attempt += 1
+                print(f"Writing {library}/{symbol} to S3 failed ({attempt}): {e}")
+                time.sleep(min(2 ** attempt, self.max_backoff))
+
+    def flush(self, timeout=None):
+        '''Waits until all queued writes reached S3. Returns False on timeout.'''
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.queue.all_tasks_done:
+            while self.queue.unfinished_tasks:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.queue.all_tasks_done.wait(remaining)
+        return True
+
+    def stop(self, timeout=None):
+        flushed = self.flush(timeout)
+        self.stopped = True
+        self.queue.put(None)
+        if flushed:
+            self.thread.join()
+        return flushed
+
+########################### LIBRARIES ###########################
+
+WRITE_METHODS = ('write', 'write_pickle', 'append', 'update', 'delete', 'write_metadata', 'delete_data_in_range')
+BATCH_WRITE_METHODS = ('write_batch', 'write_pickle_batch', 'append_batch', 'update_batch', 'write_metadata_batch', 'delete_batch')
+
+class MirroredLibrary:
+    '''Hot library: reads and writes go to the local mirror, writes are queued for replication to S3.'''
+
+    def __init__(self, tiered, name, local, remote):
+        self.tiered = tiered
+        self.name = name
+        self.local = local
+        self.remote = remote
+
+    def __getattr__(self, attribute):
+        if attribute in WRITE_METHODS:
+            return lambda *args, **kwargs: self.write_through(attribute, args, kwargs)
+        if attribute in BATCH_WRITE_METHODS:
+            return lambda items, *args, **kwargs: self.write_batch_through(attribute, items, args, kwargs)
+        return getattr(self.local, attribute)
+
+    def write_through(self, method, args, kwargs):
+        result = getattr(self.local, method)(*args, **kwargs)
+        symbol = args[0] if args else kwargs['symbol']
+        self.tiered.replicator.put(self.name, method, args, kwargs, {symbol: getattr(result, 'version', None)})
+        return result
+
+    def write_batch_through(self, method, items, args, kwargs):
+        items = list(items)
+        results = getattr(self.local, method)(items, *args, **kwargs)
+        results = results if results is not None else [None] * len(items)
+        written = [(item, result) for item, result in zip(items, results) if not isinstance(result, DataError)]
+        if written:
+            self.tiered.replicator.put(self.name, method, ([item for item, _ in written],) + args, kwargs,
+                                       {symbol_of(item): getattr(result, 'version', None) for item, result in written})
+        return results
+
+    def __repr__(self):
+        return f"MirroredLibrary({self.name})"
+
+class ReadThroughLibrary:
+    '''Cold library: S3 stays the store, reads of the latest version are served from a local copy of the
+    symbol that is refreshed when its S3 version changed (checked at most every check_interval seconds).'''
+
+    def __init__(self, tiered, name, local, remote, check_interval=60.0):
+        self.tiered = tiered
+        self.name = name
+        self.local = local
+        self.remote = remote
+        self.check_interval = check_interval
+        self.checked = {}   # symbol -> time of the last version check
+        self.lock = threading.Lock()
+
+    def __getattr__(self, attribute):
+        if attribute in WRITE_METHODS or attribute in BATCH_WRITE_METHODS:
+            def write(*args, **kwargs):
+                self.checked.clear()    # check the versions again on the next read
+                return getattr(self.remote, attribute)(*args, **kwargs)
+            return write
+        return getattr(self.remote, attribute)
+
+    def ensure_cached(self, symbols):
+        '''Copies the symbols whose S3 version changed since they were cached.'''
+        now = time.monotonic()
+        with self.lock:
+            symbols = [symbol for symbol in dict.fromkeys(symbols) if now - self.checked.get(symbol, -np.inf) >= self.check_interval]
+            if not symbols:
+                return
+            remote_versions = latest_versions(self.remote, symbols)
+            stale = [symbol for symbol in symbols if self.tiered.state.get(self.name, symbol)[1] != remote_versions[symbol]]
+            for symbol in stale:
+                if remote_versions[symbol] is None:
+                    if self.local.has_symbol(symbol):
+                        self.local.delete(symbol)
+                    self.tiered.state.set(self.name, symbol, None, None)
+            stale = [symbol for symbol in stale if remote_versions[symbol] is not None]
+            for symbol, item in zip(stale, self.remote.read_batch(stale) if stale else []):
+                if isinstance(item, DataError):
+                    continue
+                local_item = write_any(self.local, symbol, item.data, item.metadata)
+                self.tiered.state.set(self.name, symbol, local_item.version, item.version)
+            if stale:
+                self.tiered.state.save()
+            self.checked.update(dict.fromkeys(symbols, time.monotonic()))
+
+    def read(self, symbol, as_of=None, **kwargs):
+        if as_of is not None:
+            return self.remote.read(symbol, as_of=as_of, **kwargs)
+        self.ensure_cached([symbol])
+        return self.local.read(symbol, **kwargs)
+
+    def head(self, symbol, n=5, as_of=None, **kwargs):
+        if as_of is not None:
+            return self.remote.head(symbol, n, as_of=as_of, **kwargs)
+        self.ensure_cached([symbol])
+        return self.local.head(symbol, n, **kwargs)
+
+    def tail(self, symbol, n=5, as_of=None, **kwargs):
+        if as_of is not None:
+            return self.remote.tail(symbol, n, as_of=as_of, **kwargs)
+        self.ensure_cached([symbol])
+        return self.local.tail(symbol, n, **kwargs)
+
+    def read_batch(self, symbols, **kwargs):
+        if any(getattr(symbol, 'as_of', None) is not None for symbol in symbols):
+            return self.remote.read_batch(symbols, **kwargs)
+        self.ensure_cached([symbol_of(symbol) for symbol in symbols])
+        return self.local.read_batch(symbols, **kwargs)
+
+    def __repr__(self):
+        return f"ReadThroughLibrary({self.name})"
+
+########################### CONNECTION ###########################
+
+class TieredArctic:
+    '''Arctic-like connection over a local LMDB store (mirror and cache) and an S3 store.'''
+
+    def __init__(self, local, remote, hot=None, check_interval=60.0):
+        self.local = local
+        self.remote = remote
+        self.hot = hot_libraries() if hot is None else tuple(hot)
+        self.check_interval = check_interval
+        self.state = SyncState(local)
+        self.replicator = Replicator(self)
+        self._libraries = {}
+        self._remote_libraries = {}
+        self._local_libraries = {}
+        self._lock = threading.RLock()
+        atexit.register(self.close, timeout=30)
+
+    def remote_library(self, name):
+        '''The S3 library, opened on first use if S3 was unreachable when the library was opened.'''
+        remote = self._remote_libraries.get(name)
+        if remote is None:
+            remote = self._remote_libraries[name] = self.remote.get_library(name)
+        return remote
+
+    def local_library(self, name):
+        return self._local_libraries[name]
+
+    def get_library(self, name, create_if_missing=False, library_options=None, **kwargs):
+        library = self._libraries.get(name)
+        if library is not None:
+            return library
+        with self._lock:
+            if name in self._libraries:
+                return self._libraries[name]
+            try:
+                remote = self.remote.get_library(name, create_if_missing=create_if_missing, library_options=library_options, **kwargs)
+            except Exception as e:
+                # A hot library can run on its local mirror while S3 is unreachable
+                if name not in self.hot or name not in self.local.list_libraries():
+                    raise
+                print(f"Warning: S3 unreachable ({e}), using the local mirror of '{name}'")
+                remote = None
+            local = self.local.get_library(name, create_if_missing=True, library_options=remote.options() if remote else None)
+            self._remote_libraries[name], self._local_libraries[name] = remote, local
+            if name in self.hot:
+                self.sync_library(name)
+                library = MirroredLibrary(self, name, local, remote)
+            else:
+                library = ReadThroughLibrary(self, name, local, remote, self.check_interval)
+            self._libraries[name] = library
+            return library
+
+    def sync_library(self, name):
+        '''Brings the local mirror and S3 in sync when a hot library is opened: symbols changed on S3 are
+        copied to the mirror (S3 wins), symbols only changed locally (e.g. writes not replicated before the
+        last exit) are queued for S3. If S3 is unreachable the mirror is used as it is, it is synced on the next start.'''
+        local, remote = self._local_libraries[name], self._remote_libraries[name]
+        if remote is None:
+            return
+        try:
+            remote_versions = latest_versions(remote, remote.list_symbols())
+        except Exception as e:
+            print(f"Warning: could not list '{name}' on S3 ({e}), using the local mirror without syncing it")
+            return
+        local_versions = latest_versions(local, local.list_symbols())
+        pulled = pushed = 0
+        for symbol in sorted(set(remote_versions) | set(local_versions)):
+            local_version, remote_version = local_versions.get(symbol), remote_versions.get(symbol)
+            synced_local, synced_remote = self.state.get(name, symbol)
+            if remote_version != synced_remote:
+                if remote_version is None:
+                    local.delete(symbol)
+                    self.state.set(name, symbol, None, None)
+                else:
+                    item = remote.read(symbol)
+                    local_item = write_any(local, symbol, item.data, item.metadata)
+                    self.state.set(name, symbol, local_item.version, item.version)
+                pulled += 1
+            elif local_version != synced_local:
+                self.replicator.push(name, symbol)
+                pushed += 1
+        self.state.save()
+        if pulled or pushed:
+            print(f"Synced library '{name}' with S3: {pulled} symbols pulled, {pushed} queued to push")
+
+    def list_libraries(self):
+        return self.remote.list_libraries()
+
+    def delete_library(self, name):
+        with self._lock:
+            self.flush()
+            self._libraries.pop(name, None)
+            self._remote_libraries.pop(name, None)
+            self._local_libraries.pop(name, None)
+            if name in self.local.list_libraries():
+                self.local.delete_library(name)
+            self.state.drop_library(name)
+            self.state.save()
+            return self.remote.delete_library(name)
+
+    def get_uri(self):
+        # The local store, so that LazyArctic grows the mirror when it is full
+        return self.local.get_uri()
+
+    def flush(self, timeout=None):
+        '''Waits until all writes of the mirrored libraries reached S3.'''
+        return self.replicator.flush(timeout)
+
+    def close(self, timeout=None):
+        atexit.unregister(self.close)
+        if not self.replicator.stopped:
+            if not self.replicator.stop(timeout):
+                print(f"{self.replicator.pending()} writes not replicated to S3, they are written on the next start")
+
+    def __getattr__(self, name):
+        return getattr(self.remote, name)
+
+def connect_s3(settings_df, mirror_path, map_size=None):
+    '''Arctic connection of the S3 settings: tiered (local mirror at mirror_path) or direct.'''
+    settings = settings_df["Value"]
+    remote = Arctic(s3_uri(settings.get("region"), settings.get("bucket_name"), settings.get("aws_access_id"),
+                           settings.get("aws_access_key"), settings.get("s3_endpoint")))
+    if s3_mode() == 'direct':
+        return remote
+    os.makedirs(mirror_path, exist_ok=True)
+    return TieredArctic(Arctic(lmdb_uri(mirror_path, map_size)), remote)
+
+def benchmark(endpoint, bucket, access_id='test', access_key='test', region='us-east-1', rows=390, reads=50):
+    '''Times portfolio/PnL/settings reads and appends on S3 directly and in tiered mode, and checks that the
+    replicated S3 data equals the local mirror. Run against a local S3 stand-in, e.g.
+    moto_server -p 5055 (create the bucket first) and python -m data_and_research.tiered http://127.0.0.1:5055 ats'''
+    import tempfile, shutil, uuid
+
+    prefix = uuid.uuid4().hex[:8]
+    remote = Arctic(s3_uri(region, bucket, access_id, access_key, endpoint))
+    path = tempfile.mkdtemp(prefix='ats_tiered_')
+    libraries = [f'{prefix}_{name}' for name in HOT_LIBRARIES] + [f'{prefix}_research']
+    try:
+        tiered = TieredArctic(Arctic(lmdb_uri(path, '256MB')), remote, hot=libraries[:3])
+        index = pd.date_range('2024-01-02 09:30', periods=rows, freq='min')
+        pnl = pd.DataFrame({'total_equity': np.linspace(1e6, 1.01e6, rows), 'account_id': 'BENCH'}, index=index)
+        research = pd.DataFrame(np.random.default_rng(0).normal(size=(5000, 8)), columns=list('abcdefgh'),
+                                index=pd.date_range('2000-01-01', periods=5000, freq='D'))
+
+        results = {}
+        for mode, connection in (('direct', remote), ('tiered', tiered)):
+            general, _, pnl_lib, research_lib = (connection.get_library(name, create_if_missing=True) for name in libraries)
+            symbol = f'{mode}_account'
+            general.write('settings', pd.DataFrame({'Value': ['7497', 'True']}, index=['port', 's3_db_management']))
+            remote.get_library(libraries[3]).write(f'{mode}_prices', research)
+
+            start = time.perf_counter()
+            for i in range(rows):
+                (pnl_lib.append if i else pnl_lib.write)(symbol, pnl.iloc[i:i + 1])
+            results[(mode, 'append')] = (time.perf_counter() - start) / rows
+            if connection is tiered:
+                start = time.perf_counter()
+                tiered.flush()
+                replicated = time.perf_counter() - start
+            for name, read in (('settings read', lambda: general.read('settings')),
+                               ('pnl read', lambda: pnl_lib.read(symbol)),
+                               ('research read', lambda: research_lib.read(f'{mode}_prices', date_range=(pd.Timestamp('2010-01-01'), None)))):
+                start = time.perf_counter()
+                for _ in range(reads):
+                    read()
+                results[(mode, name)] = (time.perf_counter() - start) / reads
+
+        assert remote.get_library(libraries[2]).read('tiered_account').data.equals(tiered.get_library(libraries[2]).read('tiered_account').data)
+
+        print(f"{'':<16}{'direct S3':>12}{'tiered':>12}")
+        for name in ('append', 'settings read', 'pnl read', 'research read'):
+            print(f"{name:<16}{results[('direct', name)] * 1000:>10.2f}ms{results[('tiered', name)] * 1000:>10.2f}ms")
+        print(f"write-behind caught up {replicated:.2f} s after the last append; S3 copy equals the mirror")
+        tiered.close()
+    finally:
+        for name in libraries:
+            if name in remote.list_libraries():
+                remote.delete_library(name)
+        shutil.rmtree(path, ignore_errors=True)
+
+if __name__ == "__main__":
+    import sys
+    benchmark(*sys.argv[1:3])
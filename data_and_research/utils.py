@@ -5,17 +5,23 @@ from datetime import datetime
 import importlib.util
 from pathlib import Path
 from arcticdb import Arctic, QueryBuilder, LibraryOptions
-import os
+from arcticdb.exceptions import NoDataFoundException
+import os, copy, time, threading
+
+from .storage import LazyArctic, lmdb_uri
+from .tiered import connect_s3
 
 # Create LibraryOptions with dynamic_schema enabled
 LIBRARY_OPTIONS = LibraryOptions(dynamic_schema=True)
 
-def initialize_db(db_path=None):
+def initialize_db(db_path=None, map_size=None):
     """
     Generalized ArcticDB connection handler.
     
     db_path : str, optional
         Custom path to the Arctic database. If not provided, default paths will be checked.
+    map_size : int or str, optional
+        LMDB map size (e.g. '2GB'). Defaults to ATS_LMDB_MAP_SIZE or storage.DEFAULT_MAP_SIZE.
         
     Returns
     -------
@@ -36,11 +42,12 @@ def initialize_db(db_path=None):
     
     for path in db_paths:
         if os.path.exists(path):
-            ac_local = Arctic(f'lmdb://{path}?map_size=5MB')
+            ac_local = Arctic(lmdb_uri(path, map_size))
             print(f"Connected to ArcticDB at {path}")
             break
     else:
-        ac_local = Arctic(f'lmdb://data_and_research/db?map_size=5MB')
+        path = 'data_and_research/db'
+        ac_local = Arctic(lmdb_uri(path, map_size))
 
     if not "general" in ac_local.list_libraries():
         print("Creating library 'general' where *settings and *strategies will be stored")
@@ -65,14 +72,9 @@ def initialize_db(db_path=None):
         library = ac_local.get_library('general', create_if_missing=True)
         settings_df = library.read("settings").data
         
-        # if S3 is set, change ac from local to s3
+        # if S3 is set, change ac from local to s3 (tiered: hot libraries mirrored to a local store, see tiered.py)
         if settings_df.loc["s3_db_management","Value"] == str(True):
-            region = settings_df.loc["region","Value"]
-            bucket_name = settings_df.loc["bucket_name","Value"]
-            id = settings_df.loc["aws_access_id","Value"]
-            key = settings_df.loc["aws_access_key","Value"]
-        
-            ac =Arctic(f's3://s3.{region}.amazonaws.com:{bucket_name}?region={region}&access={id}&secret={key}')
+            ac = connect_s3(settings_df, f"{path.rstrip('/')}_s3_mirror", map_size)
 
             # check if "settings" exists in s3 ac
             if not "general" in ac.list_libraries():
@@ -94,34 +96,97 @@ def initialize_db(db_path=None):
     # Create other libraries here later (e.g. universe, stocks, futures etc.) 
     return ac
 
-ac = initialize_db()
+# Connects on first use; the LMDB map grows automatically when full
+ac = LazyArctic(initialize_db)
+
+class CachedTable:
+    '''Keeps a table (symbol) of a library ('general' by default) in memory, parsed by parse(df).
+
+    The symbol version is checked at most every check_interval seconds (a metadata read) and the table
+    is only read and parsed again when the version changed. Writes of this process call invalidate().'''
+
+    def __init__(self, symbol, parse=None, library='general', check_interval=1.0, arctic=None):
+        self.symbol = symbol
+        self.arctic = arctic
+        self.parse = parse or (lambda df: df)
+        self.library = library
+        self.check_interval = check_interval
+        self.version = None
+        self.value = None
+        self.checked = None
+        self.lock = threading.Lock()
+
+    def get(self):
+        '''The parsed table, or None if the symbol doesn't exist.'''
+        now = time.monotonic()
+        if self.checked is not None and now - self.checked < self.check_interval:
+            return self.value
+        with self.lock:
+            if self.checked is None or now - self.checked >= self.check_interval:
+                lib = (self.arctic or ac).get_library(self.library, create_if_missing=True)
+                try:
+                    version = lib.read_metadata(self.symbol).version
+                except NoDataFoundException:
+                    version = None
+                if version is None:
+                    self.value = None
+                elif version != self.version:
+                    item = lib.read(self.symbol)
+                    self.value = self.parse(item.data)
+                    version = item.version
+                self.version, self.checked = version, time.monotonic()
+            return self.value
+
+    def invalidate(self):
+        with self.lock:
+            self.version = self.checked = None
+
+def parse_params(params):
+    if not params:
+        return None
+    try:
+        return eval(params)  # Converts string to dictionary
+    except:
+        return params # returns params on error as params is probably a string (Error Code)
+
+def parse_allocation_bounds(row):
+    try:
+        return float(row["target_weight"] or 0), float(row["min_weight"] or 0), float(row["max_weight"] or 0)
+    except (ValueError, TypeError, KeyError):
+        return None
+
+def parse_strategies(strat_df):
+    '''The strategies table with params parsed and lookups by symbol and filename.'''
+    filenames = {}
+    if "filename" in strat_df.columns:
+        for symbol, filename in strat_df["filename"].items():
+            filenames.setdefault(filename, []).append(symbol)
+    return {
+        "df": strat_df,
+        "params": {symbol: parse_params(params) for symbol, params in strat_df.get("params", pd.Series(dtype=object)).items()},
+        "bounds": {symbol: parse_allocation_bounds(row) for symbol, row in strat_df.iterrows()},
+        "symbols": {filename: symbols[0] for filename, symbols in filenames.items() if len(symbols) == 1},
+    }
+
+strategies_table = CachedTable("strategies", parse_strategies)
+settings_table = CachedTable("settings")
 
 def fetch_strategies():
-    lib = ac.get_library('general', create_if_missing=True)
-    if lib.has_symbol("strategies"):
-        strat_df = lib.read("strategies").data
-        # print("library 'strategies' cols: ",strat_df.columns)
-        strategies = strat_df.index.to_list()
-        # print("strategies:" , strategies)
-    else:
-        strategies = []
-        strat_df = pd.DataFrame()
-    return strategies, strat_df
+    strategies_cache = strategies_table.get()
+    if strategies_cache is None:
+        return [], pd.DataFrame()
+    strat_df = strategies_cache["df"].copy()
+    return strat_df.index.to_list(), strat_df
 
 def fetch_strategy_params(strategy_symbol):
-    lib = ac.get_library('general', create_if_missing=True)
-    if lib.has_symbol("strategies"):
-        strat_df = lib.read("strategies").data
-        params = strat_df.loc[strategy_symbol,"params"]
+    strategies_cache = strategies_table.get()
+    if strategies_cache is not None:
+        params = strategies_cache["params"][strategy_symbol]
         if params:
-            try:
-                params_dict = eval(params)  # Converts string to dictionary
-                print("loaded params from our db")
-                return params_dict
-            except:
-                return params # returns params on error as params is probably a string (Error Code)
+            print("loaded params from our db")
+            return copy.deepcopy(params)  # strategies may modify their params
         else:
-            strategy_file = strat_df.loc[strategy_symbol,"filename"]
+            strategy_file = strategies_cache["df"].loc[strategy_symbol,"filename"]
             print(f"Fetching PARAMS from {strategy_file}")
             params = load_params_from_module(strategy_file)
 
@@ -166,6 +231,7 @@ def update_params_in_db(strategy_symbol, params):
     if strategy_symbol in strat_df.index:
         strat_df.at[strategy_symbol, "params"] = str(params)  # Update the params
         lib.write("strategies", strat_df, metadata={'source': 'manual update'})
+        strategies_table.invalidate()
         #lib.update("strategies", strat_df.loc[[strategy_symbol]], metadata={'source': 'manual update'})
         print(f"Updated params for {strategy_symbol} in the database.")
     else:
@@ -173,29 +239,22 @@ def update_params_in_db(strategy_symbol, params):
 
 def get_strategy_symbol(filename):
     try:
-        lib = ac.get_library('general')
-        df = lib.read("strategies").data
-        symbol = df[df.filename == filename].index.item()  # Using .item() to get the actual symbol
+        symbol = strategies_table.get()["symbols"][filename]
         return symbol
     except Exception as e:
-        print(f"Retrieved symbol: {symbol}")  # Add this line before returning
-        print(f"Error retrieving strategy symbol: {e}")
+        print(f"Error retrieving strategy symbol for {filename}: {e!r}")
         return None
 
 def get_strategy_allocation_bounds(strategy_symbol):
-    lib = ac.get_library('general')
-    strat_df = lib.read("strategies").data
-    if strategy_symbol in strat_df.index:
-        try:
-            target_weight = strat_df.loc[strategy_symbol, "target_weight"] or 0
-            min_weight = strat_df.loc[strategy_symbol, "min_weight"] or 0
-            max_weight = strat_df.loc[strategy_symbol, "max_weight"] or 0
-        except ValueError:
+    strategies_cache = strategies_table.get()
+    if strategies_cache is not None and strategy_symbol in strategies_cache["bounds"]:
+        bounds = strategies_cache["bounds"][strategy_symbol]
+        if bounds is None:
             print(f"Invalid weight values for strategy {strategy_symbol}")
             return 0.0, 0.0, 0.0  # Default values
 
         # print(f"The Allocation bounds are target:{target_weight}, min:{min_weight}, max:{max_weight}")
-        return float(target_weight), float(min_weight), float(max_weight)
+        return bounds
     else:
         print(f"Strategy {strategy_symbol} not found in the database.")
         return 0.0, 0.0, 0.0  # Default values
@@ -208,6 +267,32 @@ def update_weights(strategy_symbol,target_weight,min_weight,max_weight):
         strat_df.at[strategy_symbol, "min_weight"] = str(min_weight)
         strat_df.at[strategy_symbol, "max_weight"] = str(max_weight)
         lib.write("strategies", strat_df, metadata={'source': 'manual update'})
+        strategies_table.invalidate()
         print(f"Updated weights for {strategy_symbol} in the database.")
     else:
-        print(f"Strategy {strategy_symbol} not found in the database.")
\ No newline at end of file
+        print(f"Strategy {strategy_symbol} not found in the database.")
+
+def benchmark_imports(modules=('data_and_research', 'broker', 'strategy_manager', 'main'), runs=5):
+    """Times the import of each module in fresh interpreters (main = main.py startup up to the GUI)
+    and reports whether the import connected to ArcticDB."""
+    import subprocess, sys, json
+    root = Path(__file__).resolve().parent.parent
+    code = ("import time, json; start = time.perf_counter(); import {module}; elapsed = time.perf_counter() - start; "
+            "from data_and_research.utils import ac; print(json.dumps([elapsed, ac._arctic is not None]))")
+    results = {}
+    for module in modules:
+        timings, connected = [], False
+        for _ in range(runs):
+            output = subprocess.run([sys.executable, '-c', code.format(module=module)], cwd=root, capture_output=True, text=True)
+            if output.returncode != 0:
+                print(f"{module}: import failed: {output.stderr.strip().splitlines()[-1]}")
+                break
+            elapsed, connected = json.loads(output.stdout.strip().splitlines()[-1])
+            timings.append(elapsed)
+        if timings:
+            results[module] = float(np.median(timings))
+            print(f"{module:<20} {results[module]:.3f} s (median of {len(timings)}), database {'connected' if connected else 'not connected'}")
+    return results
+
+if __name__ == "__main__":
+    benchmark_imports()
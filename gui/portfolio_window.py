@@ -71,9 +71,10 @@ def show_pnl_graph(strategy_manager, window):
 
 def create_info_bar(strategy_manager,tab_control):
     # Fetch the account values
-    cash = sum(float(entry.value) for entry in strategy_manager.ib_client.accountSummary() if entry.tag == "TotalCashValue")
-    total_equity = sum(float(entry.value) for entry in strategy_manager.ib_client.accountSummary() if entry.tag == "EquityWithLoanValue")
-    margin = sum(float(entry.value) for entry in strategy_manager.ib_client.accountSummary() if entry.tag == "InitMarginReq")
+    account = strategy_manager.portfolio_manager.account_state.snapshot
+    cash = account.cash
+    total_equity = account.equity
+    margin = account.init_margin
 
     account_info_frame = tk.Frame(tab_control)
     account_info_frame.pack(side=tk.BOTTOM, fill=tk.X)
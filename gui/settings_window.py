@@ -2,14 +2,14 @@ from tkinter import Toplevel, ttk, Frame, Label, Text, Entry, Button, Checkbutto
 from arcticdb import Arctic
 import pandas as pd
 from data_and_research import ac, fetch_strategies, fetch_strategy_params, update_params_in_db, get_strategy_allocation_bounds, update_weights
+from data_and_research.utils import strategies_table, settings_table
 
 changes_made = False
 overview_tab = None
 details_tab = None
 
 def get_settings_from_db():
-    lib = ac.get_library("general")
-    df = lib.read("settings").data
+    df = settings_table.get()
     settings_dict = df.to_dict()
     
     return settings_dict['Value']
@@ -180,6 +180,7 @@ def save_general_settings(port, db_local, db_s3, aws_access_id, aws_access_key,
     try:
         lib = ac.get_library("general")
         lib.write("settings", settings_df, metadata={'source': 'gui'})
+        settings_table.invalidate()
         messagebox.showinfo("Success", "Settings saved successfully. Restart Application to make changes effective.")
         changes_made = False
     except Exception as e:
@@ -273,6 +274,7 @@ def populate_overview_tab(tab_frame, details_tab):
         strat_df = lib.read("strategies").data
         strat_df.loc[strategy_symbol, "active"] = str(new_state)
         lib.write("strategies", strat_df, metadata={'source': 'gui update'})
+        strategies_table.invalidate()
         print(f"Updated 'active' state for {strategy_symbol} to {new_state}")
 
 def add_strategy_window(tab_frame,details_tab):
@@ -349,6 +351,7 @@ def add_strategy_window(tab_frame,details_tab):
             try:
                 lib = ac.get_library('general', create_if_missing=True)
                 lib.append(f"strategies", details_df)#, metadata={'source': 'gui'})
+                strategies_table.invalidate()
                 messagebox.showinfo("Success", f"{name_entry.get()} saved successfully.")
                 
             except Exception as e:
@@ -454,6 +457,7 @@ def populate_details_tab(tab_frame):
                     # Delete the strategy
                     strat_df = strat_df.drop(strategy_symbol)
                     lib.write("strategies", strat_df, metadata={'source': 'gui delete'})
+                    strategies_table.invalidate()
                     messagebox.showinfo("Success", f"Strategy '{strategy_symbol}' has been successfully deleted.")
 
                     # Update the Strategy tabs
@@ -251,7 +251,7 @@ class Strategy:
 
     def calculate_position_size(self):
         """Calculate the position size based on the strategy's target weight"""
-        self.total_equity =  sum(float(entry.value) for entry in self.ib.accountSummary() if entry.tag == "EquityWithLoanValue")
+        self.total_equity = self.strategy_manager.portfolio_manager.account_state.snapshot.equity
         target_value = self.total_equity * float(self.target_weight)
 
         
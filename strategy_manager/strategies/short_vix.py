@@ -7,6 +7,7 @@ from data_and_research import get_strategy_allocation_bounds, get_strategy_symbo
 from broker.trademanager import TradeManager
 from broker import connect_to_IB, disconnect_from_IB
 from broker.functions import get_term_structure
+from broker.contracts import qualify_contracts
 from broker import connect_to_IB, disconnect_from_IB
 from gui.log import add_log, start_event
 
@@ -87,8 +88,9 @@ class Strategy:
 
     def update_investment_status(self):
         """ Update the investment status of the strategy """
-        self.equity = sum(float(entry.value) for entry in self.ib.accountSummary() if entry.tag == "EquityWithLoanValue")
-        self.cash = sum(float(entry.value) for entry in self.ib.accountSummary() if entry.tag == "AvailableFunds")
+        account = self.strategy_manager.portfolio_manager.account_state.snapshot
+        self.equity = account.equity
+        self.cash = account.available_funds
         self.current_weight = self.check_investment_weight(self, symbol=self.instrument_symbol)
         self.invested = bool(self.current_weight)
 
@@ -98,7 +100,7 @@ class Strategy:
             invested_contracts = [pos.contract for pos in self.ib.portfolio() if pos.contract.symbol == self.instrument_symbol]
             self.invested_contract = invested_contracts[0] if invested_contracts else None
             if self.invested_contract:
-                self.ib.qualifyContracts(self.invested_contract)
+                qualify_contracts(self.ib, self.invested_contract)
 
     def download_vix_and_spy_data(self):
         """ Fetch historical data from Yahoo Finance """
@@ -170,7 +172,7 @@ class Strategy:
         """ Check the trading conditions and execute trades """
         # Determine optimal Future to short
         symbol_to_short = self.choose_future_to_short()
-        contract_to_short = self.ib.qualifyContracts(Future(localSymbol=symbol_to_short))[0]
+        contract_to_short = qualify_contracts(self.ib, Future(localSymbol=symbol_to_short))[0]
 
         if not self.invested:
             if self.vrp_df["VRP"].iloc[-1] > 0:
@@ -221,8 +223,9 @@ class Strategy:
 
     def update_investment_status(self):
         """ Update the investment status of the strategy """
-        self.equity = sum(float(entry.value) for entry in self.ib.accountSummary() if entry.tag == "EquityWithLoanValue")
-        self.cash = sum(float(entry.value) for entry in self.ib.accountSummary() if entry.tag == "AvailableFunds")
+        account = self.strategy_manager.portfolio_manager.account_state.snapshot
+        self.equity = account.equity
+        self.cash = account.available_funds
         self.current_weight = self.check_investment_weight(self, symbol=self.instrument_symbol)
         self.invested = bool(self.current_weight)
 
@@ -233,11 +236,11 @@ class Strategy:
             invested_contracts = [pos.contract for pos in self.ib.portfolio() if pos.contract.symbol == self.instrument_symbol]
             self.invested_contract = invested_contracts[0] if invested_contracts else None
             if self.invested_contract:
-                self.ib.qualifyContracts(self.invested_contract)
+                qualify_contracts(self.ib, self.invested_contract)
 
     def get_next_contract(self, current_contract):
         """Find the next contract."""
-        self.ib.qualifyContracts(current_contract)
+        qualify_contracts(self.ib, current_contract)
 
         # Extract year and month from the current contract's lastTradeDateOrContractMonth
         expiration = current_contract.lastTradeDateOrContractMonth
@@ -253,7 +256,7 @@ class Strategy:
         next_month_str = f"{next_year}{next_month:02}"
         # Create the next contract
         next_contract = Future(symbol=current_contract.symbol, lastTradeDateOrContractMonth=next_month_str)
-        self.ib.qualifyContracts(next_contract)
+        qualify_contracts(self.ib, next_contract)
 
         return next_contract
 
@@ -280,7 +283,7 @@ class Strategy:
         """ Get the current future contract in the portfolio """
         if self.ib.portfolio():
             self.invested_contract = [pos.contract for pos in self.ib.portfolio() if pos.contract.symbol==self.instrument_symbol][0]
-            self.ib.qualifyContracts(self.invested_contract)
+            qualify_contracts(self.ib, self.invested_contract)
             return self.invested_contract
         else:
             return None
@@ -9,6 +9,7 @@ from gui.log import add_log
 from broker import connect_to_IB,disconnect_from_IB
 from broker.trademanager import TradeManager
 from broker.portfoliomanager import PortfolioManager
+from broker.riskmanager import RiskManager
 
 from data_and_research.utils import fetch_strategies
 from data_and_research.data_manager import DataManager
@@ -21,8 +22,10 @@ class StrategyManager:
         self.strategy_threads = []
         self.strategy_loops = {}  # New dictionary to store event loops
         self.strategies = []
-        self.trade_manager = TradeManager(ib_client=self.ib_client,strategy_manager=self)
         self.portfolio_manager = PortfolioManager(ib_client=self.ib_client)
+        # One risk manager for all strategies: their orders are checked against the same book and reservations
+        self.risk_manager = RiskManager(self.ib_client, self.portfolio_manager)
+        self.trade_manager = TradeManager(ib_client=self.ib_client,strategy_manager=self)
         self.data_manager = DataManager(ib_client= self.ib_client)
         
         self.message_queue = queue.Queue()
@@ -150,6 +153,7 @@ class StrategyManager:
     
     def disconnect(self):
         self.stop_all()
+        self.portfolio_manager.flush()  # the latest position changes are still queued for ArcticDB
 
     def stop_message_queue(self):
         """Stop the message processing loop and close the event loop."""